@@ -1,10 +1,13 @@
 import gc
 import logging
 from collections import namedtuple
+from collections.abc import MutableMapping
 from datetime import datetime
 
 import eccodes
 
+from .util.generics import SizedLRUCache
+
 version = (3, 1, 0)
 __authors__ = "Domenico Nappo"
 __version__ = 'v' + '.'.join(list(map(str, version)))
@@ -135,6 +138,65 @@ class GribGridDetails(Loggable):
         return str(self._geo_keys)
 
 
+class LazyValues(MutableMapping):
+    """
+    Values of messages decoded only when accessed (streaming mode).
+    Decoded arrays are kept in a LRU cache with a memory ceiling, so that memory usage is bounded by
+    the aggregation window instead of the number of messages. Evicted arrays are decoded again if needed.
+    Values set explicitly (e.g. arrays created during aggregation) are kept out of the cache.
+    """
+
+    def __init__(self, loaders, cache, functions=()):
+        # loaders: dict of key -> callable returning values; functions are applied in order after loading
+        self._loaders = dict(loaders)
+        self._cache = cache if isinstance(cache, SizedLRUCache) else SizedLRUCache(cache)
+        self._functions = tuple(functions)
+        self._keys = list(self._loaders)
+        self._set_values = {}
+
+    def __getitem__(self, key):
+        if key in self._set_values:
+            return self._set_values[key]
+        cache_key = (id(self), key)
+        values = self._cache.get(cache_key)
+        if values is None:
+            values = self._loaders[key]()
+            for func in self._functions:
+                values = func(values)
+            self._cache.put(cache_key, values)
+        return values
+
+    def __setitem__(self, key, values):
+        if key not in self._set_values and key not in self._loaders:
+            self._keys.append(key)
+        self._set_values[key] = values
+
+    def __delitem__(self, key):
+        self._keys.remove(key)
+        self._set_values.pop(key, None)
+        self._loaders.pop(key, None)
+        self._cache.pop((id(self), key))
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __del__(self):
+        for key in self._loaders:
+            self._cache.pop((id(self), key))
+
+    def map(self, func):
+        # same messages, with func applied to values (e.g. unit conversion)
+        return LazyValues(self._loaders, self._cache, self._functions + (func,))
+
+    def rekey(self, key_func):
+        # same messages with new keys, ordered by new key
+        loaders = {key_func(k): loader for k, loader in self._loaders.items()}
+        return LazyValues(sorted(loaders.items(), key=lambda item: item[0]), self._cache, self._functions)
+
+
 class Messages(Loggable):
 
     def __init__(self, values, mv, unit, type_of_level, type_of_step, grid_details, val_2nd=None, data_date=None):
@@ -192,9 +254,16 @@ class Messages(Loggable):
         converter.set_missing_value(self.missing_value)
         # convert all values
         self._log(converter, 'INFO')
-        self.values_first_or_single_res = {key: converter.convert(values) for key, values in self.values_first_or_single_res.items()}
-        self.values_second_res = {key: converter.convert(values) for key, values in self.values_second_res.items()}
+        self.values_first_or_single_res = self._convert(self.values_first_or_single_res, converter)
+        self.values_second_res = self._convert(self.values_second_res, converter)
         gc.collect()
 
+    @staticmethod
+    def _convert(values, converter):
+        if isinstance(values, LazyValues):
+            # streaming mode: conversion happens when values are decoded
+            return values.map(converter.convert)
+        return {key: converter.convert(v) for key, v in values.items()}
+
     def __len__(self):
         return len(self.values_first_or_single_res) + len(self.values_second_res)
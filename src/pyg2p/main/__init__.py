@@ -5,6 +5,7 @@ from .config import Configuration
 from .controller import Controller
 
 from .context import ExecutionContext
+from .interpolation.prebuild import prebuild_intertables
 
 logging.basicConfig(format='[%(asctime)s][%(name)s] : %(levelname)s %(message)s')
 logger = logging.getLogger()
@@ -56,7 +57,7 @@ def execute(exc_ctx):
 
 
 def config_command(exc_ctx):
-    """Executes one of the commands -W, -K, -g"""
+    """Executes one of the commands -W, -K, -g, -z, -b"""
     conf = exc_ctx.configuration
     if exc_ctx.to_download_conf:  # -W
         # download configuration
@@ -73,3 +74,16 @@ def config_command(exc_ctx):
     elif exc_ctx.to_check_conf:  # -K
         # check unused intertables (intertables that are not in configuration and can be deleted
         conf.to_check_conf()
+
+    elif exc_ctx.to_convert_intertables:  # -z
+        # convert .npy.gz intertables to memory mappable .npy files
+        folder = exc_ctx.get('convert_intertables')
+        converted = conf.convert_intertables(folder)
+        logger.info(f'Converted {len(converted)} intertables in {folder}')
+
+    elif exc_ctx.to_prebuild_intertables:  # -b
+        # create missing intertables of a catalogue of source grids and target maps
+        catalogue = exc_ctx.get('prebuild_intertables')
+        prebuild_intertables(catalogue, configuration=conf, intertable_dir=exc_ctx.get('interpolation.dir'),
+                             geopotential_dir=exc_ctx.get('geopotential.dir'), workers=exc_ctx.get('interpolation.workers'),
+                             dry_run=exc_ctx.get('prebuild.dry_run'))
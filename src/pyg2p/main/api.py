@@ -1,16 +1,19 @@
 import collections
+import collections.abc
 from functools import partial
 from pathlib import Path
 from types import MethodType
 
+import numpy as np
 import numpy.ma as ma
 
 from . import Controller, Configuration
 from .context import Context
 from .interpolation import Interpolator
+from .interpolation.prebuild import prebuild_intertables
 from .manipulation.aggregator import ACCUMULATION
 from .manipulation.correction import Corrector
-from .readers import GRIBReader, PCRasterReader
+from .readers import PCRasterReader
 from ..main import pyg2p_exe
 from ..util import strings
 from ..util.strings import to_argv, to_argdict
@@ -43,7 +46,9 @@ class Command:
                 'eps': '-m', 'tend': '-e', 'tstart': '-s', 'datatime': '-T', 'datadate': '-D',
                 'ext': '-x', 'fmap': '-f', 'outdir': '-o', 'nameprefix': '-n',
                 'log_level': '-l', 'log_dir': '-d', 'out_format': '-F',
-                'create_intertable': '-B', 'parallel': '-X', 'intertable_dir': '-N'}
+                'create_intertable': '-B', 'parallel': '-X', 'intertable_dir': '-N', 'max_memory': '-M',
+                'workers': '-w', 'interpolation_workers': '-P',
+                'prebuild_intertables': '-b', 'dry_run': '-y', 'cache_memory': '-Q', 'members': '-E'}
 
     def _a(self, opt, param=''):
         self._d[opt] = param
@@ -105,11 +110,15 @@ class ApiContext(Context):
         self._vars['geopotential.dir'] = self.api_conf.get('geopotentialDir')
         self._vars['interpolation.create'] = self.api_conf.get('createIntertable', False)
         self._vars['interpolation.parallel'] = self.api_conf.get('interpolationParallel', True)
+        self._vars['interpolation.workers'] = self.api_conf.get('interpolationWorkers')
+        self._vars['execution.cacheMemory'] = self._number(self.api_conf.get('cacheMemory'), int, 'cacheMemory')
+        self._vars['execution.maxMemory'] = self._number(self.api_conf.get('maxMemory'), int, 'maxMemory')
         self._vars['outMaps.fmap'] = self.api_conf.get('fmap')
         self._vars['outMaps.ext'] = self.api_conf.get('ext')
         self._vars['outMaps.namePrefix'] = self.api_conf.get('namePrefix')
         self._vars['outMaps.outDir'] = './'  # not used
         self._vars['parameter.perturbationNumber'] = self.api_conf.get('perturbationNumber')
+        self._vars['parameter.members'] = self._members(self.api_conf.get('members'))
         self._vars['input.file2'] = self.api_conf.get('inputFile2')
         self._vars['input.two_resolution'] = bool(self._vars['input.file2'])
         self._vars['geopotential'] = self.api_conf.get('addGeopotential')
@@ -160,6 +169,8 @@ class ApiContext(Context):
         interpolation_conf = self.api_conf['OutMaps']['Interpolation']
         self._vars['interpolation.mode'] = interpolation_conf.get('mode', self.default_values['interpolation.mode'])
         self._vars['interpolation.rotated_target'] = interpolation_conf.get('rotated_target', False)
+        self._vars['interpolation.nnear'] = self._number(interpolation_conf.get('nnear'), int, 'Interpolation nnear')
+        self._vars['interpolation.power'] = self._number(interpolation_conf.get('power'), float, 'Interpolation power')
         if not self._vars['interpolation.dir'] and self.api_conf.get('intertableDir'):
             self._vars['interpolation.dirs']['user'] = self.api_conf['intertableDir']
 
@@ -191,6 +202,7 @@ class ApiContext(Context):
         if self.api_conf.get('Aggregation'):
             self._vars['aggregation.step'] = self.api_conf['Aggregation'].get('step')
             self._vars['aggregation.type'] = self.api_conf['Aggregation'].get('type')
+            self._vars['aggregation.percentile'] = self._number(self.api_conf['Aggregation'].get('percentile'), float, 'Aggregation percentile')
 
             self._vars['execution.doAggregation'] = bool(self._vars.get('aggregation.step')) and bool(self._vars.get('aggregation.type'))
             self._vars['aggregation.forceZeroArray'] = self._vars.get('aggregation.type') == ACCUMULATION and self.api_conf['Aggregation'].get('forceZeroArray', 'False').lower() not in strings.FALSE_STRINGS
@@ -230,6 +242,21 @@ class Pyg2pApi:
             out += f"Conversion id: {c['@id']} unit {c['@unit']} {c['@function']} [cut negative: {c['@cutOffNegative']}]"
         return out
 
+    @classmethod
+    def prebuild_intertables(cls, catalogue, intertable_dir=None, geopotential_dir=None, workers=None, dry_run=False):
+        """
+        Creates missing intertables for all source grids and target maps of a catalogue, in parallel.
+
+        :param catalogue: path to JSON catalogue or dict with 'sources' and 'targets' lists
+        :param dry_run: only report intertables to create, with estimated cost
+        :return: list of IntertableJob, with intertables existing before the call flagged by job.exists
+        """
+        return prebuild_intertables(catalogue, intertable_dir=intertable_dir, geopotential_dir=geopotential_dir,
+                                    workers=workers, dry_run=dry_run)
+
+    # memory in bytes of a stack of timesteps interpolated at once, if maxMemory is not set
+    stack_max_memory = 512 * 1024 ** 2
+
     def __init__(self, api_ctx):
         """
         :param api_ctx: ApiContext instance
@@ -242,6 +269,7 @@ class Pyg2pApi:
         clone = PCRasterReader(self.context.get('outMaps.clone'))
         self.mv = clone.mv
         rs = ma.masked_values(clone.values, self.mv)
+        self._target_size = rs.size
         self._mask = ma.getmask(rs)
 
     def _mask_values(self, values):
@@ -255,34 +283,67 @@ class Pyg2pApi:
     def execute(self):
         """
         Main method
-        :return: dict of numpy values, keys are instances of  pyg2p.Step
+        :return: dict of numpy values, keys are instances of  pyg2p.Step.
+                 In ensemble batch mode (members parameter), dict of eps member -> dict of values
         """
-        grib_reader = GRIBReader(self.context.get('input.file'), w_perturb=self.context.has_perturbation_number)
-        grib_info = grib_reader.get_grib_info(self.context.create_select_cmd_for_aggregation_attrs())
         ctrl = Controller(self.context)
         ctrl.log_execution_context()
+        if self.context.is_ensemble_batch:
+            out = collections.OrderedDict()
+            # each member is interpolated before its messages are released by the controller
+            for member, (values, messages, change_res_step) in ctrl.iter_members(write_results=False):
+                out[member] = self._interpolate(ctrl, values, messages, change_res_step)
+            self.values = out
+            return out
         values, self.messages, self.change_res_step = ctrl.execute(write_results=False)
-        # need interpolation and correction
-        self.interpolator = Interpolator(self.context, grib_info.mv)
-        is_second_res = False
-        lats, longs = self.messages.latlons
-        geodetic_info = self.messages.grid_details
-        grid_id = self.messages.grid_id
+        out = self._interpolate(ctrl, values, self.messages, self.change_res_step)
+        self.values = out
+        return out
+
+    def _interpolate(self, ctrl, values, messages, change_res_step):
+        """
+        Interpolates and corrects values: dict of Step -> values or, in streaming mode (maxMemory),
+        (Step, values) pairs ordered by end step, decoded and aggregated while they are consumed.
+        Timesteps of the same resolution are interpolated in stacks, each one within the memory budget
+        (maxMemory, or stack_max_memory if not in streaming mode).
+        """
+        if self.interpolator is None:
+            self.interpolator = Interpolator(self.context, ctrl.grib_info.mv)
+        budget = self.context.max_memory_bytes or self.stack_max_memory
+        items = values.items() if isinstance(values, collections.abc.Mapping) else values
         out = {}
-        for i, (timestep, v) in enumerate(values.items()):
-            # note: timestep and change_res_step are instances of pyg2p.Step class
-            if self.messages.have_resolution_change() and timestep == self.change_res_step:
-                # Switching to second resolution
-                lats, longs = self.messages.latlons_2nd
-                geodetic_info = self.messages.grid_details.get_2nd_resolution()
-                grid_id = self.messages.grid2_id
-                is_second_res = True
-            out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
+        stack = []
+        max_steps = None
+        is_second_res = False
+        for timestep, v in items:
+            # note: timesteps and change_res_step are instances of pyg2p.Step class
+            if messages.have_resolution_change() and timestep == change_res_step:
+                self._interpolate_stack(stack, messages, is_second_res, out)
+                stack, max_steps, is_second_res = [], None, True
+            if max_steps is None:
+                # source values, their stack and interpolated values of a timestep, as float64
+                max_steps = max(1, budget // ((2 * np.size(v) + self._target_size) * 8))
+            stack.append((timestep, v))
+            if len(stack) >= max_steps:
+                self._interpolate_stack(stack, messages, is_second_res, out)
+                stack = []
+        self._interpolate_stack(stack, messages, is_second_res, out)
+        return collections.OrderedDict(sorted(out.items(), key=lambda item: int(item[0].end_step)))
+
+    def _interpolate_stack(self, stack, messages, is_second_res, out):
+        if not stack:
+            return
+        if is_second_res:
+            (lats, longs), geodetic_info, grid_id = messages.latlons_2nd, messages.grid_details.get_2nd_resolution(), messages.grid2_id
+        else:
+            (lats, longs), geodetic_info, grid_id = messages.latlons, messages.grid_details, messages.grid_id
+        timesteps, stack_values = zip(*stack)
+        stack_values = ma.stack(stack_values) if any(isinstance(v, ma.core.MaskedArray) for v in stack_values) else np.stack(stack_values)
+        out_stack = self.interpolator.interpolate_many(stack_values, grid_id, lats, longs, geodetic_info, is_second_res=is_second_res)
+        del stack_values
+        if self.context.must_do_correction:
+            corrector = Corrector.get_instance(self.context, grid_id)
+        for timestep, out_v in zip(timesteps, out_stack):
             if self.context.must_do_correction:
-                corrector = Corrector.get_instance(self.context, grid_id)
                 out_v = corrector.correct(out_v)
-            out_v = self._mask_values(out_v)
-            out[timestep] = out_v
-        out = collections.OrderedDict(sorted(out.items(), key=lambda item: int(item[0].end_step)))
-        self.values = out
-        return out
+            out[timestep] = self._mask_values(out_v)
@@ -1,6 +1,8 @@
+import fcntl
 import json
 import os
 import re
+from contextlib import contextmanager
 from copy import deepcopy
 from ftplib import FTP
 import itertools
@@ -8,6 +10,7 @@ from pkg_resources import resource_stream
 
 import pyg2p
 from ..main.readers import GRIBReader
+from .interpolation import intertables
 from ..exceptions import (
     ApplicationException,
     SHORTNAME_NOT_FOUND,
@@ -140,9 +143,28 @@ class BaseConfiguration(pyg2p.Loggable):
             f.close()
 
     def dump(self):
-        with open(self.config_file, 'w') as f:
+        # written with a temporary name and then renamed, so other processes never read a partial file
+        tmp_file = f'{self.config_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
             user_vars = self.user_vars or '{}'
             f.write(json.dumps(user_vars, sort_keys=True, indent=4))
+        os.replace(tmp_file, self.config_file)
+
+    @contextmanager
+    def lock(self):
+        # exclusive lock on <config_file>.lock, to read-modify-write user configuration with concurrent processes
+        with open(f'{self.config_file}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reload(self):
+        # reads user configuration again, with items added by other processes
+        if file_util.exists(self.config_file):
+            self.user_vars = self._load()
+            self.vars.update(self.user_vars)
 
     def check_write(self):
         if not self.data_path:
@@ -274,6 +296,34 @@ class IntertablesConfiguration(BaseConfiguration):
     data_path_var = UserConfiguration.intertables_path_var
     global_data_path_var = GlobalConf.intertables_path_var
     description = 'Config file for intertables. Do NOT edit this file!'
+    _mtime = None
+
+    def get(self, intertable_id):
+        """
+        Configuration item of intertable_id, or None.
+        If it's not found, user configuration is read again, in case another process has just added it.
+        """
+        if intertable_id not in self.vars and self._modified():
+            self.reload()
+        return self.vars.get(intertable_id)
+
+    def _modified(self):
+        return file_util.exists(self.config_file) and os.stat(self.config_file).st_mtime_ns != self._mtime
+
+    def _load(self, config_file=None):
+        if not config_file:
+            self._mtime = os.stat(self.config_file).st_mtime_ns
+        return super()._load(config_file)
+
+    def add(self, intertable_id, item):
+        # items added by other processes since user configuration was read are kept
+        with self.lock():
+            self.reload()
+            # update global configuration
+            self.vars[intertable_id] = item
+            # Dumps only user configuration to ~/.pyg2p/intertables.json
+            self.user_vars[intertable_id] = item
+            self.dump()
 
 
 class Configuration(pyg2p.Loggable):
@@ -331,6 +381,15 @@ class Configuration(pyg2p.Loggable):
         self._log(f'=== Download finished: {remote_path}')
         client.quit()  # close FTP connection
 
+    def convert_intertables(self, folder):
+        # converts .npy.gz intertables to .npy (memory mapped when loaded). Configuration is unchanged:
+        # .npy files are preferred to .npy.gz ones with the same name
+        converted = []
+        for f in file_util.ls(folder, '.npy.gz'):
+            self._log(f'Converting {f}', level='INFO')
+            converted.append(intertables.convert(f))
+        return converted
+
     def check_conf(self):
         # it logs all files in intertables and geopotentials paths that are not used in configuration
 
@@ -349,10 +408,12 @@ class Configuration(pyg2p.Loggable):
             if file_util.filename(f) not in used_geopotentials:
                 self._log(f'Geopotential file is not in configuration: {f} - You could delete it')
 
-        user_intertables = deepcopy(self.intertables.user_vars)
-        for k, i in user_intertables.items():
-            fullpath = os.path.join(self.intertables.data_path, i['filename'])
-            if not file_util.exists(fullpath):
-                self._log(f'{fullpath} - Non existing. Removing item from intertables.json')
-                del self.intertables.user_vars[k]
-        self.intertables.dump()
+        with self.intertables.lock():
+            self.intertables.reload()
+            user_intertables = deepcopy(self.intertables.user_vars)
+            for k, i in user_intertables.items():
+                fullpath = os.path.join(self.intertables.data_path, i['filename'])
+                if not file_util.exists(fullpath):
+                    self._log(f'{fullpath} - Non existing. Removing item from intertables.json')
+                    del self.intertables.user_vars[k]
+            self.intertables.dump()
@@ -4,7 +4,7 @@ import os
 
 from . import Configuration
 from .. import __version__
-from ..util import files, strings
+from ..util import files, strings, generics as utils
 from .manipulation.aggregator import ACCUMULATION
 from ..exceptions import (ApplicationException, INVALID_INTERPOL_METHOD,
                           WRONG_ARGS, NOT_A_NUMBER, NOT_EXISTING_MAPS, MISSING_INPUT_GRIB, NOT_EXISTING_INPUT_GRIB)
@@ -20,10 +20,10 @@ class Context:
     def __setitem__(self, param, value):
         self._vars[param] = value
 
-    def __init__(self):
+    def __init__(self, configuration=None):
         # contains main configuration
         # (parameters, geopotentials, intertables, custom user paths, ftp to download test dataset, static data paths)
-        self.configuration = Configuration()
+        self.configuration = configuration or Configuration()
         # init vars
         self.to_add_geopotential = False
         self.input_file_with_geopotential = None
@@ -36,6 +36,11 @@ class Context:
     def has_perturbation_number(self):
         return 'parameter.perturbationNumber' in self._vars and self._vars['parameter.perturbationNumber'] is not None
 
+    @property
+    def is_ensemble_batch(self):
+        # all (or a list of) eps members are processed in one execution
+        return self._vars.get('parameter.members') is not None
+
     def get(self, param, default=None):
         return self._vars.get(param, default)
 
@@ -58,6 +63,15 @@ class Context:
     def must_do_conversion(self):
         return self._vars['execution.doConversion']
 
+    @property
+    def is_streaming(self):
+        # values are decoded, aggregated and written one step at a time, within a memory ceiling
+        return bool(self._vars.get('execution.maxMemory'))
+
+    @property
+    def max_memory_bytes(self):
+        return self._vars['execution.maxMemory'] * 1024 ** 2 if self.is_streaming else None
+
     @property
     def is_2_input_files(self):
         return self._vars['input.two_resolution']
@@ -74,6 +88,14 @@ class Context:
     def to_check_conf(self):
         return self._vars.get('check_conf')
 
+    @property
+    def to_convert_intertables(self):
+        return bool(self._vars.get('convert_intertables'))
+
+    @property
+    def to_prebuild_intertables(self):
+        return bool(self._vars.get('prebuild_intertables'))
+
     def __str__(self):
         mess = f"\n\n============ pyg2p: Execution parameters: {self._vars.get('execution.name') or ''} {strings.now_string()} ============\n\n"
         params_str = [f'{par}={self._vars[par]}' for par in sorted(self._vars.keys()) if self._vars[par]]
@@ -86,6 +108,16 @@ class Context:
             if not files.exists(self._vars['geopotential']):
                 raise ApplicationException.get_exc(7001, self._vars['geopotential'])
 
+        elif self.to_convert_intertables:
+
+            if not files.exists(self._vars['convert_intertables'], is_folder=True):
+                raise ApplicationException.get_exc(WRONG_ARGS, f"Not existing folder {self._vars['convert_intertables']}")
+
+        elif self.to_prebuild_intertables:
+
+            if not files.exists(self._vars['prebuild_intertables']):
+                raise ApplicationException.get_exc(WRONG_ARGS, f"Not existing catalogue {self._vars['prebuild_intertables']}")
+
         else:
 
             if not self._vars.get('input.file'):
@@ -106,6 +138,16 @@ class Context:
             if not self._vars['interpolation.mode'] in self.allowed_interp_methods:
                 raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, details=self._vars['interpolation.mode'])
 
+            if self.is_ensemble_batch and self.has_perturbation_number:
+                raise ApplicationException.get_exc(WRONG_ARGS, details='Use either a single eps member (-m) or ensemble batch mode (-E)')
+
+            # number of neighbours and distance exponent are only for scipy inverse distance
+            nnear, power = self._vars.get('interpolation.nnear'), self._vars.get('interpolation.power')
+            if (nnear is not None or power is not None) and self._vars['interpolation.mode'] != 'invdist':
+                raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, details=f"nnear and power are not used by {self._vars['interpolation.mode']} mode")
+            if (nnear is not None and nnear < 2) or (power is not None and power <= 0):
+                raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, details=f'invdist needs nnear >= 2 and power > 0 (nnear={nnear}, power={power})')
+
             # create out dir if not existing
             try:
                 if self._vars['outMaps.outDir'] != './':
@@ -136,17 +178,60 @@ class Context:
             if self._vars['execution.doCorrection'] and not files.exists(self._vars['correction.demMap']):
                 raise ApplicationException.get_exc(4200, self._vars['correction.demMap'])
 
+    @staticmethod
+    def _number(value, type_, name):
+        # optional numeric parameter from execution JSON or API dict
+        if value is None:
+            return None
+        try:
+            return type_(value)
+        except (TypeError, ValueError):
+            raise ApplicationException.get_exc(NOT_A_NUMBER, name)
+
+    @staticmethod
+    def _members(value):
+        # eps members from command line ('all' or e.g. '0-10,20') or API ('all', list of numbers or same string)
+        if value is None or value == 'all':
+            return value
+        try:
+            if isinstance(value, str):
+                members = set()
+                for item in value.split(','):
+                    first, _, last = item.strip().partition('-')
+                    members.update(range(int(first), int(last or first) + 1))
+                return sorted(members)
+            return sorted({int(member) for member in value})
+        except (TypeError, ValueError):
+            raise ApplicationException.get_exc(NOT_A_NUMBER, f'Ensemble members {value}')
+
     def geo_file(self, grid_id):
         path = self.input_file_with_geopotential
         if not path:
             path = self.configuration.geopotentials.get_filepath(grid_id, additional=self._vars['geopotential.dirs'].get('user'))
         return path
 
-    def create_select_cmd_for_reader(self, start_, end_):
+    def _perturbation_number_condition(self, member=None):
+        # member selected in ensemble batch mode, -m member or list of members to scan (None for all messages)
+        if member is not None:
+            return member
+        if self.has_perturbation_number:
+            return self._vars['parameter.perturbationNumber']
+        if self.is_ensemble_batch and self._vars['parameter.members'] != 'all':
+            return self._vars['parameter.members']
+        return None
+
+    def create_select_cmd_for_scan(self, member=None):
         # 'var' suffix is for multiresolution 240 step message (global EUE files)
         reader_args = {
             'shortName': [self._vars['parameter.shortName'], self._vars['parameter.shortName'].upper(),
                           self._vars['parameter.shortName'] + 'var']}
+        perturbation_number = self._perturbation_number_condition(member)
+        if perturbation_number is not None:
+            reader_args['perturbationNumber'] = perturbation_number
+        return reader_args
+
+    def create_select_cmd_for_reader(self, start_, end_, member=None):
+        reader_args = self.create_select_cmd_for_scan(member)
 
         if self._vars['parameter.level'] is not None:
             reader_args['level'] = self._vars['parameter.level']
@@ -155,23 +240,21 @@ class Context:
         if self._vars['parameter.dataDate'] is not None:
             reader_args['dataDate'] = self._vars['parameter.dataDate']
 
-        if self.has_perturbation_number:
-            reader_args['perturbationNumber'] = self._vars['parameter.perturbationNumber']
-
         # start_step, end_step
         if start_ == end_:
             reader_args['endStep'] = end_
             reader_args['startStep'] = start_
         else:
-            reader_args['endStep'] = lambda s: s <= end_
-            reader_args['startStep'] = lambda s: s >= start_
+            reader_args['endStep'] = utils.Range(max_=end_)
+            reader_args['startStep'] = utils.Range(min_=start_)
         return reader_args
 
-    def create_select_cmd_for_aggregation_attrs(self):
+    def create_select_cmd_for_aggregation_attrs(self, member=None):
 
         reader_arguments = {'shortName': str(self._vars['parameter.shortName'])}
-        if self.has_perturbation_number:
-            reader_arguments['perturbationNumber'] = self._vars['parameter.perturbationNumber']
+        perturbation_number = self._perturbation_number_condition(member)
+        if perturbation_number is not None:
+            reader_arguments['perturbationNumber'] = perturbation_number
         return reader_arguments
 
 
@@ -225,12 +308,17 @@ class ExecutionContext(Context):
         self._vars['geopotential.dir'] = parsed_args['geopotentialDir']
         self._vars['interpolation.create'] = parsed_args['createIntertable']
         self._vars['interpolation.parallel'] = parsed_args['interpolationParallel']
+        self._vars['interpolation.workers'] = parsed_args['interpolationWorkers']
+        self._vars['execution.maxMemory'] = parsed_args['maxMemory']
+        self._vars['execution.workers'] = parsed_args['workers']
+        self._vars['execution.cacheMemory'] = parsed_args['cacheMemory']
         self._vars['outMaps.fmap'] = parsed_args['fmap']
         self._vars['outMaps.format'] = parsed_args['format']
         self._vars['outMaps.ext'] = parsed_args['ext']
         self._vars['outMaps.namePrefix'] = parsed_args['namePrefix']
         self._vars['outMaps.outDir'] = parsed_args['outDir']
         self._vars['parameter.perturbationNumber'] = parsed_args['perturbationNumber']
+        self._vars['parameter.members'] = self._members(parsed_args['members'])
         self._vars['input.file2'] = parsed_args['inputFile2']
         self._vars['input.two_resolution'] = bool(self._vars['input.file2'])
         self._vars['geopotential'] = parsed_args['addGeopotential']
@@ -238,13 +326,17 @@ class ExecutionContext(Context):
         self._vars['download_configuration'] = parsed_args['downloadConf']
         self._vars['under_api'] = parsed_args['underApi']
         self._vars['check_conf'] = parsed_args['checkConf']
+        self._vars['convert_intertables'] = parsed_args['convertIntertables']
+        self._vars['prebuild_intertables'] = parsed_args['prebuildIntertables']
+        self._vars['prebuild.dry_run'] = parsed_args['dryRun']
         user_intertables = self._vars['interpolation.dir'] or self.configuration.default_interpol_dir
         user_geopotentials = self._vars['geopotential.dir'] or self.configuration.default_geopotential_dir
         self._vars['interpolation.dirs'] = {'global': self.configuration.intertables.global_data_path,
                                             'user': user_intertables}
         self._vars['geopotential.dirs'] = {'global': self.configuration.geopotentials.global_data_path,
                                            'user': user_geopotentials}
-        self.is_config_command = self.to_add_geopotential or self.to_download_conf or self.to_check_conf
+        self.is_config_command = self.to_add_geopotential or self.to_download_conf or self.to_check_conf \
+            or self.to_convert_intertables or self.to_prebuild_intertables
 
     @staticmethod
     def add_args(parser):
@@ -261,6 +353,10 @@ class ExecutionContext(Context):
         parser.add_argument('-e', '--end', help='Grib timestep end. It overwrites the tend in json execution file.',
                             type=int, metavar='tend')
         parser.add_argument('-m', '--perturbationNumber', help='eps member number', type=int, metavar='eps_member')
+        parser.add_argument('-E', '--members',
+                            help='Ensemble batch mode: process all eps members of input GRIB (all) or a list of them '
+                                 '(e.g. 0-10,20) in one run. Outputs of each member are written in <outDir>/<member>/',
+                            metavar='eps_members')
         parser.add_argument('-T', '--dataTime', help='To select messages by dataTime key value', type=int,
                             choices=['0', '1200'], metavar='data_time')
         parser.add_argument('-D', '--dataDate', help='<YYYYMMDD> to select messages by dataDate key value',
@@ -291,6 +387,24 @@ class ExecutionContext(Context):
                                  'If -B option is not passed or intertable already exists'
                                  ' it does not have any effect.',
                             action='store_true', default=False)
+        parser.add_argument('-P', '--interpolationWorkers',
+                            help='Number of processes creating GRIB intertables with -X option '
+                                 '(threads of KD tree queries for scipy intertables). Default: number of CPUs.',
+                            type=int, metavar='interpolation_workers')
+
+        parser.add_argument('-M', '--maxMemory',
+                            help='Streaming mode: messages are decoded, aggregated, interpolated and written '
+                                 'one step at a time, keeping at most max_memory MB of decoded input values.',
+                            type=int, metavar='max_memory')
+
+        parser.add_argument('-w', '--workers',
+                            help='Number of threads interpolating, correcting and preparing output maps in parallel.',
+                            type=int, default=1, metavar='workers')
+
+        parser.add_argument('-Q', '--cacheMemory',
+                            help='Memory budget in MB for intertables, interpolation operators and correction data '
+                                 'kept in memory by the process. Default: 2048.',
+                            type=int, metavar='cache_memory')
 
         parser.add_argument('-g', '--addGeopotential', help='''Add the file to geopotentials.json configuration file, to use for correction.
         \nThe file will be copied into the right folder (configuration/geopotentials)
@@ -298,6 +412,17 @@ class ExecutionContext(Context):
         parser.add_argument('-W', '--downloadConf',
                             help='Download intertables and geopotentials (FTP settings defined in ftp.json)',
                             metavar='dataset', choices=['geopotentials', 'intertables'])
+        parser.add_argument('-z', '--convertIntertables',
+                            help='Convert compressed intertables (.npy.gz) in intertables_dir '
+                                 'to the uncompressed format (.npy), which is memory mapped when read',
+                            metavar='intertables_dir')
+        parser.add_argument('-b', '--prebuildIntertables',
+                            help='Create all missing intertables for source grids and target maps listed in catalogue_json, '
+                                 'using -P processes (see README)',
+                            metavar='catalogue_json')
+        parser.add_argument('-y', '--dryRun',
+                            help='With -b option, only report intertables to create and their estimated cost',
+                            action='store_true', default=False)
         parser.add_argument('-A', '--underApi', help=argparse.SUPPRESS,
                             action='store_true', default=False)
         parser.add_argument('-K', '--checkConf', help=argparse.SUPPRESS,  # mostly used in development
@@ -349,6 +474,8 @@ class ExecutionContext(Context):
         interpolation_conf = exec_conf['OutMaps']['Interpolation']
         self._vars['interpolation.mode'] = interpolation_conf.get('@mode', self.default_values['interpolation.mode'])
         self._vars['interpolation.rotated_target'] = interpolation_conf.get('@rotated_target', False)
+        self._vars['interpolation.nnear'] = self._number(interpolation_conf.get('@nnear'), int, 'Interpolation nnear')
+        self._vars['interpolation.power'] = self._number(interpolation_conf.get('@power'), float, 'Interpolation power')
         if not self._vars['interpolation.dir'] and interpolation_conf.get('@intertableDir'):
             # get from JSON
             self._vars['interpolation.dirs']['user'] = interpolation_conf['@intertableDir']
@@ -388,6 +515,7 @@ class ExecutionContext(Context):
         if exec_conf.get('Aggregation'):
             self._vars['aggregation.step'] = exec_conf['Aggregation'].get('@step')
             self._vars['aggregation.type'] = exec_conf['Aggregation'].get('@type')
+            self._vars['aggregation.percentile'] = self._number(exec_conf['Aggregation'].get('@percentile'), float, 'Aggregation percentile')
 
             self._vars['execution.doAggregation'] = bool(self._vars.get('aggregation.step')) \
                 and bool(self._vars.get('aggregation.type'))
@@ -1,6 +1,8 @@
 import collections
+import itertools
 
 from .. import Loggable
+from ..exceptions import ApplicationException, NO_MESSAGES
 from ..main.manipulation.aggregator import Aggregator
 from ..main.readers.grib import GRIBReader
 from ..main.writers import OutputWriter
@@ -18,6 +20,7 @@ class Controller(Loggable):
         self.grib_reader2 = None
         self._firstMap = True
         self._writer = None
+        self.grib_info = None
 
     def log_execution_context(self):
         self._log(f'[!] Intertables user path as defined in {self.ctx.configuration.user.intertables_path_var}: {self.ctx.configuration.user.geopotentials_path}', 'INFO')
@@ -29,19 +32,30 @@ class Controller(Loggable):
 
         self._log(str(self.ctx), 'INFO')
 
-    def init_execution(self):
+    def _open_reader(self):
+        # in ensemble batch mode, messages of all requested members are scanned together
+        w_perturb = self.ctx.has_perturbation_number or self.ctx.is_ensemble_batch
+        self.grib_reader = GRIBReader(self.ctx.get('input.file'), w_perturb=w_perturb,
+                                      max_memory=self.ctx.max_memory_bytes)
+        # input file is read only once: messages scanned here are used for both grib info and values
+        self.grib_reader.scan_messages(**self.ctx.create_select_cmd_for_scan())
+        if self.ctx.must_do_correction and self.grib_reader.has_geopotential():
+            self.ctx.set_input_file_with_geopotential()
+
+    def init_execution(self, member=None):
         aggregator = None
-        self.grib_reader = GRIBReader(self.ctx.get('input.file'), w_perturb=self.ctx.has_perturbation_number)
-        grib_info = self.grib_reader.get_grib_info(self.ctx.create_select_cmd_for_aggregation_attrs())
-        self._writer = OutputWriter(self.ctx, grib_info)
+        if self.grib_reader is None:
+            self._open_reader()
+        grib_info = self.grib_reader.get_grib_info(self.ctx.create_select_cmd_for_aggregation_attrs(member))
+        self.grib_info = grib_info
+        if self._writer is None:
+            # writer (with its interpolator and target coordinates) is shared by all members of a batch
+            self._writer = OutputWriter(self.ctx, grib_info)
 
         # read grib messages
         start_step = self.ctx.get('parameter.tstart') or 0
         end_step = self.ctx.get('parameter.tend') or grib_info.end
 
-        if self.ctx.must_do_correction and self.grib_reader.has_geopotential():
-            self.ctx.set_input_file_with_geopotential()
-
         if self.ctx.must_do_aggregation:
             aggregator = Aggregator(aggr_step=self.ctx.get('aggregation.step'),
                                     aggr_type=self.ctx.get('aggregation.type'),
@@ -51,12 +65,13 @@ class Controller(Loggable):
                                     mv_grib=grib_info.mv,
                                     end_step=end_step,
                                     unit_time=self.ctx.get('outMaps.unitTime'),
-                                    force_zero_array=self.ctx.get('aggregation.forceZeroArray'))
+                                    force_zero_array=self.ctx.get('aggregation.forceZeroArray'),
+                                    percentile=self.ctx.get('aggregation.percentile'))
             start_step, end_step = aggregator.get_real_start_end_steps()
-        selector_params = self.ctx.create_select_cmd_for_reader(start_step, end_step)
+        selector_params = self.ctx.create_select_cmd_for_reader(start_step, end_step, member)
         return grib_info, selector_params, end_step, aggregator
 
-    def second_res_manipulation(self, start_step, end_step, input_step, messages, mv_grib, values):
+    def second_res_manipulation(self, start_step, end_step, input_step, messages, mv_grib, values, streaming=False):
 
         # manipulation of second resolution messages
         step_type = messages.step_type
@@ -64,7 +79,13 @@ class Controller(Loggable):
                         aggr_type=self.ctx.get('aggregation.type'),
                         input_step=input_step, step_type=step_type, start_step=start_step,
                         end_step=end_step, unit_time=self.ctx.get('outMaps.unitTime'), mv_grib=mv_grib,
-                        force_zero_array=self.ctx.get('aggregation.forceZeroArray'))
+                        force_zero_array=self.ctx.get('aggregation.forceZeroArray'),
+                        percentile=self.ctx.get('aggregation.percentile'))
+        if streaming:
+            # values are (step, values) pairs ordered by end step: second resolution ones come after the first
+            values2 = m2.iter_manipulation(messages.second_resolution_values())
+            first = next(values2)
+            return first[0], itertools.chain(values, [first], values2)
         values2 = m2.do_manipulation(messages.second_resolution_values())
         values.update(values2)
         # overwrite change_step resolution because of manipulation
@@ -72,15 +93,49 @@ class Controller(Loggable):
         return change_step, values
 
     def read_2nd_res_messages(self, cmd_args, messages):
-        # append messages
-        self.grib_reader2 = GRIBReader(self.ctx.get('input.file2'), w_perturb=self.ctx.has_perturbation_number)
+        # append messages (second reader is reused by all members of a batch)
+        if self.grib_reader2 is None:
+            w_perturb = self.ctx.has_perturbation_number or self.ctx.is_ensemble_batch
+            self.grib_reader2 = GRIBReader(self.ctx.get('input.file2'), w_perturb=w_perturb,
+                                           max_memory=self.ctx.max_memory_bytes)
         # messages.change_resolution() returns True after Messages.append_2nd_res_messages()
         mess_2nd_res = self.grib_reader2.select_messages(**cmd_args)
         messages.append_2nd_res_messages(mess_2nd_res)
 
     def execute(self, write_results=True):
+        if self.ctx.is_ensemble_batch:
+            for _ in self.iter_members(write_results=write_results):
+                pass
+            return None
+        return self._execute(write_results=write_results)
+
+    def iter_members(self, write_results=True):
+        """
+        Ensemble batch mode: all (or requested) eps members are processed in one execution.
+        Input file is scanned once, while intertables, correctors and the output writer are shared by all members.
+        Generator of (member, (values, messages, change_res_step)), as returned by execute() for a single member.
+        Messages of a member are released when the next one is requested, so their values must be used before.
+        """
+        if self.grib_reader is None:
+            self._open_reader()
+        members = self.grib_reader.members(self.ctx.create_select_cmd_for_aggregation_attrs())
+        if not members:
+            raise ApplicationException.get_exc(NO_MESSAGES, details=f'No eps members found for {self.ctx.get("parameter.members")}')
+        self._log(f'Ensemble batch mode: {len(members)} members {members}', 'INFO')
+        for member in members:
+            self._log(f'******** **** EPS MEMBER {member} **** *************', 'INFO')
+            yield member, self._execute(write_results=write_results, member=member)
+            self.grib_reader.release_selected()
+            if self.grib_reader2:
+                self.grib_reader2.release_selected()
+
+    def _execute(self, write_results=True, member=None):
         converter = None
-        grib_info, grib_select_cmd, end_step, aggregator = self.init_execution()
+        # in streaming mode, values flow as (step, values) pairs from reader to writer, one step at a time
+        streaming = self.ctx.is_streaming
+        grib_info, grib_select_cmd, end_step, aggregator = self.init_execution(member)
+        if member is not None and write_results:
+            self._writer.set_member(member)
         mv_grib = grib_info.mv
         input_step = grib_info.input_step
 
@@ -114,7 +169,9 @@ class Controller(Loggable):
                 change_res_step = messages.change_resolution_step()
                 # First resolution manipulation by setting end step as start step of the first message at 2nd resolution
                 aggregator.change_end_step(int(change_res_step.start_step))
-            values = aggregator.do_manipulation(values)
+            values = aggregator.iter_manipulation(values) if streaming else aggregator.do_manipulation(values)
+        elif streaming:
+            values = ((k, values[k]) for k in sorted(values, key=lambda k: int(k.end_step)))
 
         change_res_step = None
         if messages.have_resolution_change():
@@ -123,15 +180,23 @@ class Controller(Loggable):
             # we need GRIB lats and lons only for scipy interpolation
             if self.ctx.must_do_aggregation and end_step > start_step2:
                 # second resolution manipulation
-                change_res_step, values = self.second_res_manipulation(start_step2, end_step, input_step, messages, mv_grib, values)
+                change_res_step, values = self.second_res_manipulation(start_step2, end_step, input_step, messages, mv_grib, values, streaming)
 
         # cutoff after interpolation
-        if converter and converter.must_cut_off:
-            values = converter.cut_off_negative(values)
-        values = collections.OrderedDict(sorted(values.items(), key=lambda k: int(k[0].end_step)))
+        if streaming:
+            if converter and converter.must_cut_off:
+                values = ((k, converter.cut_off_negative(v)) for k, v in values)
+            # without writing results (API), values are returned as (Step, values) pairs to consume once
+        else:
+            if converter and converter.must_cut_off:
+                values = converter.cut_off_negative(values)
+            values = collections.OrderedDict(sorted(values.items(), key=lambda k: int(k[0].end_step)))
         if write_results:
             self._log('******** **** WRITING OUT MAPS (Interpolation, correction) **** *************')
             self._writer.write_maps(values, messages, change_res_step=change_res_step)
+            if streaming:
+                # values were consumed by the writer and are not kept in memory
+                values = None
         # ! return non interpolated values
         return values, messages, change_res_step
 
@@ -1,27 +1,31 @@
-import gzip
 import os
 import logging
 from functools import partial
 
 import numpy as np
-import numpy.ma as ma
 from pyg2p import Loggable
 
-from . import grib_interpolation_lib
+from . import grib_interpolation_lib, intertables
 from .latlong import LatLong
+from .operators import SparseInterpolation
 from .scipy_interpolation_lib import InverseDistance
 from ...exceptions import ApplicationException, NO_INTERTABLE_CREATED
 import pyg2p.util.files
 import pyg2p.util.numeric
+from pyg2p.util.generics import SizedLRUCache
 
 
 class Interpolator(Loggable):
-    _LOADED_INTERTABLES = {}
+    # intertables, interpolation operators and correctors of the process, within a memory budget
+    cache = SizedLRUCache(2048 * 1024 ** 2)
     _prefix = 'I'
     scipy_modes_nnear = {'nearest': 1, 'invdist': 4}
+    # target points in each checkpointed block of a new intertable
+    checkpoint_cells = 200000
+    default_power = 2
     suffixes = {'grib_nearest': 'grib_nearest', 'grib_invdist': 'grib_invdist',
                 'nearest': 'scipy_nearest', 'invdist': 'scipy_invdist'}
-    _format_intertable = 'tbl{prognum}_{source_file}_{target_size}_{suffix}.npy.gz'.format
+    _format_intertable = 'tbl{prognum}_{source_file}_{target_size}_{suffix}.npy'.format
 
     def __init__(self, exec_ctx, mv_input):
         super().__init__()
@@ -30,11 +34,22 @@ class Interpolator(Loggable):
         self._mode = exec_ctx.get('interpolation.mode')
         self._source_filename = pyg2p.util.files.filename(exec_ctx.get('input.file'))
         self._suffix = self.suffixes[self._mode]
+        self._nnear = self.scipy_modes_nnear.get(self._mode)
+        self._power = self.default_power
+        if self._mode == 'invdist':
+            self._nnear = exec_ctx.get('interpolation.nnear') or self._nnear
+            self._power = exec_ctx.get('interpolation.power') or self._power
+            if (self._nnear, self._power) != (self.scipy_modes_nnear['invdist'], self.default_power):
+                # non default neighbours and power are part of intertable id and filename
+                self._suffix = '{}_k{}_p{:g}'.format(self._suffix, self._nnear, self._power)
         self._intertable_dirs = exec_ctx.get('interpolation.dirs')
         self._rotated_target_grid = exec_ctx.get('interpolation.rotated_target')
         self._target_coords = LatLong(exec_ctx.get('interpolation.latMap'), exec_ctx.get('interpolation.lonMap'))
         self.mv_out = self._target_coords.mv
         self.parallel = exec_ctx.get('interpolation.parallel')
+        self.workers = exec_ctx.get('interpolation.workers')
+        if exec_ctx.get('execution.cacheMemory'):
+            self.cache.resize(exec_ctx.get('execution.cacheMemory') * 1024 ** 2)
         self.format_intertablename = partial(self._format_intertable,
                                              source_file=pyg2p.util.files.normalize_filename(self._source_filename),
                                              target_size=self._target_coords.lats.size,
@@ -57,139 +72,145 @@ class Interpolator(Loggable):
             out_v = self.interpolate_scipy(lats, longs, v, grid_id, geodetic_info)
         return out_v
 
-    def _intertable_filename(self, grid_id):
+    def interpolate_many(self, values_stack, grid_id, lats=None, longs=None, geodetic_info=None, is_second_res=False):
+        """
+        Interpolates a stack of fields on the same grid (e.g. all timesteps of a parameter) in one operation.
+        Intertable is resolved and read only once for the whole stack.
+        Lats, longs and geodetic info are only needed to create a missing scipy intertable.
+        :param values_stack: array with shape (T, N), also masked
+        :return: array with shape (T, ny, nx)
+        """
+        if self.interpolate_with_grib:
+            # grib intertables index the last axis, so they are applied to all fields at once
+            return self.interpolate_grib(values_stack, -1, grid_id, is_second_res=is_second_res)
+        intertable_id, intertable_name = self._intertable_filename(grid_id)
+        if ('operator', intertable_name) not in self.cache and not intertables.exists(intertable_name):
+            # intertable is created (or an error is raised) interpolating the first field
+            self.interpolate_scipy(lats, longs, values_stack[0], grid_id, geodetic_info)
+            intertable_id, intertable_name = self._intertable_filename(grid_id)
+        result = self._scipy_operator(intertable_name, values_stack.shape[1]).apply(values_stack, self.mv_output)
+        return result.reshape((len(values_stack),) + self._target_coords.lons.shape)
+
+    def _intertable_filename(self, grid_id, reserved=(), reserve=True):
+        """
+        Intertable id and path of the intertable for grid_id. A new intertable has its filename reserved.
+        :param reserved: paths of other new intertables that are going to be created
+        :param reserve: if False, filename of a new intertable is not reserved (e.g. to only report it)
+        """
         intertable_id = '{}{}_{}{}'.format(self._prefix, grid_id.replace('$', '_'), self._target_coords.identifier, self._suffix)
-        if intertable_id not in self.intertables_config.vars:
-            # return a new intertable filename to create
+        item = self.intertables_config.get(intertable_id)
+        if not item:
             if not self.create_if_missing:
                 raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'Using {intertable_id}')
             self.intertables_config.check_write()
-            filename = self.format_intertablename(prognum='')
-            tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
-            i = 1
-            while pyg2p.util.files.exists(tbl_fullpath):
-                filename = self.format_intertablename(prognum='_{}'.format(i))
-                tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
-                i += 1
-            return intertable_id, tbl_fullpath
+            # new filename is chosen under lock, so that concurrent processes don't choose the same one
+            with self.intertables_config.lock():
+                item = self.intertables_config.get(intertable_id)
+                if not item:
+                    return intertable_id, self._new_intertable_path(intertable_id, reserved, reserve)
 
-        filename = self.intertables_config.vars[intertable_id]['filename']
+        filename = item['filename']
 
         # tbl_fullpath is taken from user path if defined, otherwise comes from global configuration
         tbl_fullpath = None if not self._intertable_dirs.get('user') else os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
         if self._logger.isEnabledFor(logging.DEBUG):
             self._logger.debug(f'Using {tbl_fullpath} for id {intertable_id}')
-        if not tbl_fullpath or not (pyg2p.util.files.exists(tbl_fullpath) or pyg2p.util.files.exists(tbl_fullpath + '.gz')):
+        if not tbl_fullpath or not intertables.exists(tbl_fullpath):
             tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['global'], filename))
-            if not (pyg2p.util.files.exists(tbl_fullpath) or pyg2p.util.files.exists(tbl_fullpath + '.gz')):
+            if not intertables.exists(tbl_fullpath):
                 # will create a new intertable but with same filename/id
                 # as an existing configuration was already found but file is missing for some reasons
                 if not self.create_if_missing:
                     raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'Tried to create {tbl_fullpath}')
                 self.intertables_config.check_write()
                 tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
-                tbl_fullpath = tbl_fullpath if tbl_fullpath.endswith('.gz') else tbl_fullpath + '.gz'
                 self._logger.warning(f'An entry in configuration was found for {filename} but intertable does not exist.')
         return intertable_id, tbl_fullpath
 
+    def _new_intertable_path(self, intertable_id, reserved, reserve):
+        i = 0
+        while True:
+            filename = self.format_intertablename(prognum='_{}'.format(i) if i else '')
+            tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
+            if not intertables.exists(tbl_fullpath) and tbl_fullpath not in reserved \
+                    and (not reserve or intertables.reserve(tbl_fullpath, intertable_id)):
+                return tbl_fullpath
+            i += 1
+
     def _read_intertable(self, tbl_fullpath):
 
-        if tbl_fullpath not in self._LOADED_INTERTABLES:
-            f = tbl_fullpath
-            if tbl_fullpath.endswith('.gz'):
-                f = gzip.GzipFile(tbl_fullpath, 'r')
-                intertable = np.load(f)
-                f.close()
-            else:
-                try:
-                    intertable = np.load(tbl_fullpath)
-                except FileNotFoundError:
-                    f = tbl_fullpath + '.gz'
-                    if not pyg2p.util.files.exists(f):
-                        raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'Tried to read both {tbl_fullpath} and {f} but none was found')
-                    f = gzip.GzipFile(f, 'r')
-                    intertable = np.load(f)
-                    f.close()
-            self._LOADED_INTERTABLES[tbl_fullpath] = intertable
+        intertable = self.cache.get(('intertable', tbl_fullpath))
+        if intertable is None:
+            try:
+                # .npy intertables are memory mapped
+                intertable = intertables.load(tbl_fullpath)
+            except FileNotFoundError as e:
+                raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=str(e))
+            self.cache.put(('intertable', tbl_fullpath), intertable)
             self._log(f'Using interpolation table: {tbl_fullpath}', 'INFO')
-        else:
-            intertable = self._LOADED_INTERTABLES[tbl_fullpath]
 
         if self._mode == 'grib_nearest':
             # grib nearest neighbour table
             return intertable[0], intertable[1], intertable[2]
         elif self._mode == 'grib_invdist':
-            # grib inverse distance table is a "recorded numpy array" with keys 'indexes' and 'coeffs'
+            # grib inverse distance table is a numpy record with keys 'indexes' and 'coeffs'
+            # (a record array with two padding rows of coeffs, for tables created before v3.2)
             indexes = intertable['indexes']  # first two arrays of this group are target xs and ys indexes
             coeffs = intertable['coeffs']
             return indexes[0], indexes[1], indexes[2], indexes[3], indexes[4], indexes[5], coeffs[0], coeffs[1], coeffs[2], coeffs[3]
         else:
             # self._mode in ('invdist', 'nearest'):
-            # return indexes and weighted distances (only used with nnear=4)
+            # return indexes and weighted distances (only used with nnear > 1)
             indexes = intertable['indexes']
             coeffs = intertable['coeffs']
             return indexes, coeffs
 
     # ####### SCIPY INTERPOLATION ###################################
-    def _interpolate_scipy_invdist(self, v, weights, indexes, nnear):
-        # append the MV efas value at the end because of how KDTree algo works
-        # It gives (last_index + 1) from original values when value can't be computed.
-        # These "last_index + 1" indexes are stored in intertable so we artificially add a missing value
-        # v[last_index + 1] = mv
-        v = np.append(v, self.mv_output)
-        orig_mask = False if not isinstance(v, ma.core.MaskedArray) else v.mask
-        if nnear == 1:
-            if isinstance(orig_mask, np.ndarray):
-                result = ma.masked_where(orig_mask[indexes], v[indexes], copy=False)
-            else:
-                result = v[indexes]
-        else:
-            result = np.einsum('ij,ij->i', weights, v[indexes])
-            if isinstance(orig_mask, np.ndarray):
-                # there are masks. logic sum of masks from all values used
-                mask = None
-                for i in range(0, indexes.shape[1]):
-                    mask = orig_mask[indexes.T[i]] if mask is None else mask | orig_mask[indexes.T[i]]
-                result = ma.masked_where(mask, result, copy=False)
-        return result
+    def _scipy_operator(self, tbl_fullpath, source_size):
+        # sparse interpolation operator, built once from intertable arrays
+        operator = self.cache.get(('operator', tbl_fullpath))
+        if operator is None or operator.shape[1] != source_size:
+            indexes, weights = self._read_intertable(tbl_fullpath)
+            operator = SparseInterpolation(indexes, weights, source_size)
+            self.cache.put(('operator', tbl_fullpath), operator)
+        return operator
 
-    def interpolate_scipy(self, latgrib, longrib, v, grid_id, grid_details=None):
+    def interpolate_scipy(self, latgrib, longrib, v, grid_id, grid_details=None, intertable_id=None, intertable_name=None):
 
-        intertable_id, intertable_name = self._intertable_filename(grid_id)
+        if not intertable_name:
+            intertable_id, intertable_name = self._intertable_filename(grid_id)
         lonefas = self._target_coords.lons
         latefas = self._target_coords.lats
 
-        nnear = self.scipy_modes_nnear[self._mode]
-
-        if pyg2p.util.files.exists(intertable_name) or pyg2p.util.files.exists(intertable_name + '.gz'):
-            indexes, weights = self._read_intertable(intertable_name)
-            result = self._interpolate_scipy_invdist(v, weights, indexes, nnear)
-
-        elif self.create_if_missing:
+        if ('operator', intertable_name) not in self.cache and not intertables.exists(intertable_name):
+            if not self.create_if_missing:
+                raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
             self.intertables_config.check_write()
             if latgrib is None:
                 self._log('Trying to interpolate without grib lat/lons. Probably a malformed grib!', 'ERROR')
                 raise ApplicationException.get_exc(5000)
 
-            self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
-            invdisttree = InverseDistance(longrib, latgrib, grid_details, v.ravel(), nnear, self.mv_out,
-                                          self._mv_grib, target_is_rotated=self._rotated_target_grid,
-                                          parallel=self.parallel)
-            _, weights, indexes = invdisttree.interpolate(lonefas, latefas)
-            result = self._interpolate_scipy_invdist(v, weights, indexes, nnear)
-
-            # saving interpolation lookup table
-            intertable = np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs'))
-            if intertable_name.endswith('.gz'):
-                f = gzip.GzipFile(intertable_name, 'w')
-                np.save(f, intertable)
-                f.close()
-            else:
-                np.save(intertable_name, intertable)
-            self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
-        else:
-            raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
-
+            with intertables.CreationLock(intertable_name, intertable_id):
+                # intertable could have been created by another process while waiting for the lock
+                if not intertables.exists(intertable_name):
+                    self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
+                    invdisttree = InverseDistance(longrib, latgrib, grid_details, v.ravel(), self._nnear, self.mv_out,
+                                                  self._mv_grib, target_is_rotated=self._rotated_target_grid,
+                                                  parallel=self.parallel, power=self._power, cache_dir=self._intertable_dirs['user'], cache=self.cache,
+                                                  workers=self.workers if self.parallel else None)
+
+                    def compute_block(start, end):
+                        # only the table is computed here: values are interpolated with it below
+                        _, block_weights, block_indexes = invdisttree.interpolate(lonefas[start:end], latefas[start:end], with_result=False)
+                        return block_weights, block_indexes
+                    weights, indexes = self._create_in_blocks(intertable_id, intertable_name, compute_block)
+                    # saving interpolation lookup table
+                    intertable = intertables.scipy_table(indexes, weights)
+                    intertables.save(intertable_name, intertable)
+                    self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
+
+        # interpolating with the compact table, also when just created
+        result = self._scipy_operator(intertable_name, v.size).apply(v.ravel(), self.mv_output)
         # reshape to target (e.g. efas, glofas...)
         grid_data = result.reshape(lonefas.shape)
         return grid_data
@@ -198,12 +219,43 @@ class Interpolator(Loggable):
     def interpolate_grib(self, v, gid, grid_id, is_second_res=False):
         return self.grib_methods[self._mode](v, gid, grid_id, is_second_res=is_second_res)
 
+    def _block_rows(self, cols):
+        return max(1, self.checkpoint_cells // cols)
+
+    def _create_in_blocks(self, intertable_id, intertable_name, compute_block):
+        # blocks of target rows are saved as they are computed, so that an interrupted creation resumes from them
+        rows, cols = self._target_coords.lons.shape
+        block_rows = self._block_rows(cols)
+        key = '{} {}x{} {}'.format(intertable_id, rows, cols, block_rows)
+        return intertables.build_in_blocks(intertable_name, key, rows, block_rows, compute_block)
+
+    def _grib_intertable_arrays(self, method, gid, intertable_id, intertable_name):
+        lats, lons, mv = self._target_coords.lats, self._target_coords.lons, self._target_coords.mv
+        # bulk nearest neighbours for supported grids, otherwise a query to ecCodes for each target point
+        if grib_interpolation_lib.supports_bulk(gid):
+            return getattr(grib_interpolation_lib, '{}_bulk'.format(method))(gid, lats, lons, mv)
+        if not self.parallel:
+            lib_function = getattr(grib_interpolation_lib, method)
+            return self._create_in_blocks(intertable_id, intertable_name, partial(self._grib_block, lib_function, gid))
+        # one pool of processes (started only if some block must be computed) for all blocks of the intertable
+        npoints = 1 if method == 'grib_nearest' else 4
+        capacity = min(lats.size, self._block_rows(lats.shape[1]) * lats.shape[1])
+        with grib_interpolation_lib.ParallelNearest(gid, npoints, capacity, self.workers) as pool:
+            lib_function = partial(getattr(grib_interpolation_lib, '{}_parallel'.format(method)), pool=pool)
+            return self._create_in_blocks(intertable_id, intertable_name, partial(self._grib_block, lib_function, gid))
+
+    def _grib_block(self, lib_function, gid, start, end):
+        # arrays of GRIB intertable for target rows from start to end
+        lats, lons, mv = self._target_coords.lats, self._target_coords.lons, self._target_coords.mv
+        xs, *arrays = lib_function(gid, lats[start:end], lons[start:end], mv)
+        return (xs + start, *arrays)
+
     def grib_nearest(self, v, gid, grid_id, is_second_res=False, intertable_id=None, intertable_name=None):
         if not intertable_name:
             intertable_id, intertable_name = self._intertable_filename(grid_id)
-        result = np.empty(self._target_coords.lons.shape)
+        result = np.empty(v.shape[:-1] + self._target_coords.lons.shape)
         result.fill(self.mv_out)
-        if gid == -1 and not pyg2p.util.files.exists(intertable_name):
+        if gid == -1 and not intertables.exists(intertable_name):
             # calling recursive grib_nearest
             # aux_gid and aux_values are only used to create the interlookuptable
             if is_second_res:
@@ -214,44 +266,42 @@ class Interpolator(Loggable):
                 self.grib_nearest(self._aux_val, self._aux_gid, grid_id,
                                   intertable_name=intertable_name, intertable_id=intertable_id)
 
-        if pyg2p.util.files.exists(intertable_name):
-            # interpolation using intertables
-            xs, ys, idxs = self._read_intertable(intertable_name)
-
-        elif self.create_if_missing:
+        if not intertables.exists(intertable_name) and self.create_if_missing:
             if gid == -1:
                 raise ApplicationException.get_exc(6000, details='GRIB message reference was not found.')
             self.intertables_config.check_write()
-            self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
-            xs, ys, idxs = getattr(grib_interpolation_lib, 'grib_nearest{}'.format('' if not self.parallel else '_parallel'))(gid, self._target_coords.lats, self._target_coords.lons, self._target_coords.mv)
-            intertable = np.asarray([xs, ys, idxs])
-            if intertable_name.endswith('.gz'):
-                f = gzip.GzipFile(intertable_name, 'w')
-                np.save(f, intertable)
-                f.close()
-            else:
-                np.save(intertable_name, intertable)
-            self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
+            with intertables.CreationLock(intertable_name, intertable_id):
+                # intertable could have been created by another process while waiting for the lock
+                if not intertables.exists(intertable_name):
+                    self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
+                    xs, ys, idxs = self._grib_intertable_arrays('grib_nearest', gid, intertable_id, intertable_name)
+                    intertable = intertables.grib_nearest_table(xs, ys, idxs)
+                    intertables.save(intertable_name, intertable)
+                    self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
+
+        if intertables.exists(intertable_name):
+            # interpolation using intertables (just created ones are read from memory)
+            xs, ys, idxs = self._read_intertable(intertable_name)
         else:
-            if intertable_id not in self.intertables_config.vars:
+            if self.intertables_config.get(intertable_id) is None:
                 d = {'filename': pyg2p.util.files.filename(intertable_name),
                      'method': self._mode,
                      'source_shape': v.shape,
                      'target_shape': self._target_coords.lons.shape}
                 self._log('If you already have an intertable file, add this configuration to intertables.json and change filename. {} {}'.format(intertable_id, d), 'INFO')
             raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
-        result[xs, ys] = pyg2p.util.numeric.result_masked(v[idxs], self.mv_output)
+        result[..., xs, ys] = pyg2p.util.numeric.result_masked(v[..., idxs], self.mv_output)
         return result
 
     def grib_inverse_distance(self, v, gid, grid_id, is_second_res=False, intertable_id=None, intertable_name=None):
         if not intertable_name:
             intertable_id, intertable_name = self._intertable_filename(grid_id)
 
-        result = np.empty(self._target_coords.lons.shape)
+        result = np.empty(v.shape[:-1] + self._target_coords.lons.shape)
         result.fill(self.mv_out)
 
         # check if gid is due to the recursive call
-        if gid == -1 and not pyg2p.util.files.exists(intertable_name):
+        if gid == -1 and not intertables.exists(intertable_name):
             # aux_gid and aux_values are only used to create the interlookuptable
             # since manipulated values messages don't have gid reference to grib file any longer
             aux_gid = self._aux_gid
@@ -262,34 +312,28 @@ class Interpolator(Loggable):
             self.grib_inverse_distance(aux_val, aux_gid, grid_id, intertable_name=intertable_name,
                                        intertable_id=intertable_id, is_second_res=is_second_res)
 
-        if pyg2p.util.files.exists(intertable_name):
-            # interpolation using intertables
-            xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = self._read_intertable(intertable_name)
-        elif self.create_if_missing:
+        if not intertables.exists(intertable_name) and self.create_if_missing:
             # assert...
             if gid == -1:
                 raise ApplicationException.get_exc(6000)
-
-            self._log('\nInterpolating table not found. Will create file: {}'.format(intertable_name), 'WARN')
-            lonefas = self._target_coords.lons
-            latefas = self._target_coords.lats
-            mv = self._target_coords.mv
-            intrp_result = getattr(grib_interpolation_lib, 'grib_invdist{}'.format('' if not self.parallel else '_parallel'))(gid, latefas, lonefas, mv)
-            xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = intrp_result
-            indexes = np.asarray([xs, ys, idxs1, idxs2, idxs3, idxs4])
-            coeffs = np.asarray([coeffs1, coeffs2, coeffs3, coeffs4, np.zeros(coeffs1.shape), np.zeros(coeffs1.shape)])
-            intertable = np.rec.fromarrays((indexes, coeffs), names=('indexes', 'coeffs'))
-            # saving interpolation lookup table
-            if intertable_name.endswith('.gz'):
-                f = gzip.GzipFile(intertable_name, 'w')
-                np.save(f, intertable)
-                f.close()
-            else:
-                np.save(intertable_name, intertable)
-            self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
-
+            self.intertables_config.check_write()
+            with intertables.CreationLock(intertable_name, intertable_id):
+                # intertable could have been created by another process while waiting for the lock
+                if not intertables.exists(intertable_name):
+                    self._log('\nInterpolating table not found. Will create file: {}'.format(intertable_name), 'WARN')
+                    intrp_result = self._grib_intertable_arrays('grib_invdist', gid, intertable_id, intertable_name)
+                    xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = intrp_result
+                    intertable = intertables.grib_invdist_table([xs, ys, idxs1, idxs2, idxs3, idxs4],
+                                                                [coeffs1, coeffs2, coeffs3, coeffs4])
+                    # saving interpolation lookup table
+                    intertables.save(intertable_name, intertable)
+                    self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
+
+        if intertables.exists(intertable_name):
+            # interpolation using intertables (just created ones are read from memory, with compact coefficients)
+            xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = self._read_intertable(intertable_name)
         else:
-            if intertable_id not in self.intertables_config.vars:
+            if self.intertables_config.get(intertable_id) is None:
                 d = {'filename': pyg2p.util.files.filename(intertable_name),
                      'method': self._mode,
                      'source_shape': v.shape,
@@ -297,22 +341,19 @@ class Interpolator(Loggable):
                 self._log('If you already have an intertable file, add this configuration to intertables.json and change filename. {} {}'.format(intertable_id, d), 'INFO')
             raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
 
-        res = v[idxs1] * coeffs1 + v[idxs2] * coeffs2 + v[idxs3] * coeffs3 + v[idxs4] * coeffs4
-        result[xs, ys] = pyg2p.util.numeric.result_masked(res, self.mv_output)
+        res = v[..., idxs1] * coeffs1 + v[..., idxs2] * coeffs2 + v[..., idxs3] * coeffs3 + v[..., idxs4] * coeffs4
+        result[..., xs, ys] = pyg2p.util.numeric.result_masked(res, self.mv_output)
         return result
 
+    def intertable_conf_item(self, intertable_name, source_shape):
+        return {'filename': pyg2p.util.files.filename(intertable_name),
+                'method': self._mode,
+                'source_shape': source_shape,
+                'target_shape': self._target_coords.lons.shape}
+
     def update_intertable_conf(self, intertable, intertable_id, intertable_name, source_shape):
-        self._LOADED_INTERTABLES[intertable_name] = intertable
-        new_intertable_conf_item = {'filename': pyg2p.util.files.filename(intertable_name),
-                                    'method': self._mode,
-                                    'source_shape': source_shape,
-                                    'target_shape': self._target_coords.lons.shape}
-        # update global configuration
-        self.intertables_config.vars[intertable_id] = new_intertable_conf_item
-
-        # Dumps only user configuration to ~/.pyg2p/intertables.json
-        self.intertables_config.user_vars[intertable_id] = new_intertable_conf_item
-        self.intertables_config.dump()
+        self.cache.put(('intertable', intertable_name), intertable)
+        self.intertables_config.add(intertable_id, self.intertable_conf_item(intertable_name, source_shape))
 
     # set aux gids for grib interlookup creation
     def aux_for_intertable_generation(self, aux_g, aux_v, aux_g2, aux_v2):
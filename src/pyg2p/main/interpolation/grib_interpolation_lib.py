@@ -4,15 +4,16 @@ Interpolating between global grids it takes 3 days on Intel(R) Core(TM) i7-3610Q
 Parallelized versions gives 4x gain at least.
 """
 
+import multiprocessing
+import os
 import warnings
-from functools import partial
+from multiprocessing import shared_memory
 from sys import stdout
 
 import eccodes
 import numexpr as ne
 import numpy as np
-from dask import bag
-from dask.diagnostics import ProgressBar
+from scipy.spatial import cKDTree
 
 from ...util.generics import progress_step_and_backchar
 from ...util.numeric import empty, int_fill_value
@@ -141,130 +142,350 @@ def _compute_coeffs_and_idxs(n_nearest):
 
 
 ##############################################
-# Pallel version of grib api nearest neighbour
-
-
-def apply_nearest_to_chunk(chunk, gid=None, mv=None):
-    return np.apply_along_axis(nearest_parallel_step, 0, chunk, gid, mv)
-
+# Bulk version of grib api nearest neighbour
+# Same tables as grib_nearest and grib_invdist, computed for all target points at once
+# by reproducing the ecCodes nearest algorithms with numpy (only for supported grids, see supports_bulk)
+
+# grids whose nearest points are the corners of the grid box containing the target point
+BOX_GRID_TYPES = ('regular_ll', 'rotated_ll', 'regular_gg')
+# grids whose nearest points are the four closest ones (ecCodes generic algorithm)
+KDTREE_GRID_TYPES = ('lambert', 'polar_stereographic', 'lambert_azimuthal_equal_area', 'mercator')
+DEFAULT_RADIUS_KM = 6371.229
+
+
+def supports_bulk(gid):
+    grid_type = eccodes.codes_get(gid, 'gridType')
+    if eccodes.codes_get(gid, 'numberOfDataPoints') < 4:
+        return False
+    if grid_type in KDTREE_GRID_TYPES:
+        return True
+    if grid_type not in BOX_GRID_TYPES:
+        return False
+    # box search relies on the standard scanning mode (rows of Ni points) and on rotations without angle
+    standard_scanning = not eccodes.codes_get(gid, 'iScansNegatively') and not eccodes.codes_get(gid, 'jPointsAreConsecutive')
+    return standard_scanning and (grid_type != 'rotated_ll' or eccodes.codes_get(gid, 'angleOfRotationInDegrees') == 0)
+
+
+def grib_nearest_bulk(gid, target_lats, target_lons, mv):
+    xs, ys, idxs, distances = _bulk_neighbours(gid, target_lats, target_lons, mv)
+    # as ecCodes, the last of the points at minimum distance
+    nearest = 3 - np.argmin(distances[:, ::-1], axis=1)
+    return xs, ys, idxs[np.arange(len(idxs)), nearest]
+
+
+def grib_invdist_bulk(gid, target_lats, target_lons, mv):
+    xs, ys, idxs, distances = _bulk_neighbours(gid, target_lats, target_lons, mv)
+    with np.errstate(divide='ignore'):
+        invs = 1 / distances
+    # exact positions as in _compute_coeffs_and_idxs: single index with weight 1, other indexes are 0
+    exact = distances == 0
+    exact_rows = np.flatnonzero(exact.any(axis=1))
+    idxs[exact_rows, 0] = idxs[exact_rows, np.argmax(exact[exact_rows], axis=1)]
+    idxs[exact_rows, 1:] = 0
+    invs[exact_rows] = (1, 0, 0, 0)
+    sums = invs[:, 0] + invs[:, 1] + invs[:, 2] + invs[:, 3]
+    coeffs = invs / sums[:, np.newaxis]
+    return (xs, ys) + tuple(idxs.T) + tuple(coeffs.T)
+
+
+def _bulk_neighbours(gid, target_lats, target_lons, mv):
+    """
+    Four nearest grid points of valid target points, in the order returned by codes_grib_find_nearest.
+    :return: target xs and ys, indexes and distances (km) with shape (n, 4). Target points out of grid are excluded.
+    """
+    stdout.write('Start interpolation: {}\n'.format(now_string()))
+    valid_target_coords = (target_lons > -1.0e+10) & (target_lons != mv)
+    xs, ys = np.nonzero(valid_target_coords)
+    lats = target_lats[valid_target_coords].astype(np.float64)
+    lons = target_lons[valid_target_coords].astype(np.float64)
+    if eccodes.codes_get(gid, 'gridType') in BOX_GRID_TYPES:
+        in_grid, idxs, distances = _box_neighbours(gid, lats, lons)
+    else:
+        in_grid, idxs, distances = _kdtree_neighbours(gid, lats, lons)
+    stdout.write('Bulk nearest neighbours: {}/{}  [outs: {}]\n'.format(len(lats), target_lons.size, len(lats) - len(idxs)))
+    stdout.write('End interpolation: {}\n\n'.format(now_string()))
+    stdout.flush()
+    return xs[in_grid], ys[in_grid], idxs, distances
+
+
+def _box_neighbours(gid, lats, lons):
+    # corners of grid box (ecCodes regular nearest)
+    ni, nj = eccodes.codes_get(gid, 'Ni'), eccodes.codes_get(gid, 'Nj')
+    first_lon = eccodes.codes_get_double(gid, 'longitudeOfFirstGridPointInDegrees')
+    last_lon = eccodes.codes_get_double(gid, 'longitudeOfLastGridPointInDegrees')
+    if last_lon < first_lon:
+        # grid crossing the meridian where longitudes restart
+        last_lon += 360
+    grid_lons = np.linspace(first_lon, last_lon, ni)
+    if eccodes.codes_get(gid, 'gridType') == 'regular_gg':
+        # gaussian latitudes, in scanning order
+        grid_lats = np.sort(eccodes.codes_get_array(gid, 'distinctLatitudes'))
+        if not eccodes.codes_get(gid, 'jScansPositively'):
+            grid_lats = grid_lats[::-1]
+    else:
+        grid_lats = np.linspace(eccodes.codes_get_double(gid, 'latitudeOfFirstGridPointInDegrees'),
+                                eccodes.codes_get_double(gid, 'latitudeOfLastGridPointInDegrees'), nj)
+    if eccodes.codes_get(gid, 'gridType') == 'rotated_ll':
+        # target points in rotated coordinates
+        lats, lons = _rotate(lats, lons, eccodes.codes_get_double(gid, 'latitudeOfSouthernPoleInDegrees'),
+                             eccodes.codes_get_double(gid, 'longitudeOfSouthernPoleInDegrees'))
+
+    outside_lons = (lons < first_lon) | (lons >= first_lon + 360)
+    lons = np.where(outside_lons, first_lon + np.mod(lons - first_lon, 360), lons)
+    is_global = ni > 1 and np.isclose(last_lon - first_lon + (last_lon - first_lon) / (ni - 1), 360)
+    in_grid = (lats >= grid_lats.min()) & (lats <= grid_lats.max())
+    if not is_global:
+        in_grid &= lons <= last_lon
+    lats, lons = lats[in_grid], lons[in_grid]
+
+    lower_j, upper_j = _binary_search(grid_lats, lats)
+    lower_i, upper_i = _binary_search(grid_lons, lons)
+    if is_global:
+        # between last and first longitude
+        wrapped = lons > last_lon
+        lower_i[wrapped], upper_i[wrapped] = ni - 1, 0
+    js = np.column_stack((upper_j, upper_j, lower_j, lower_j))
+    is_ = np.column_stack((upper_i, lower_i, upper_i, lower_i))
+    distances = _distance(_radius(gid), lats[:, np.newaxis], lons[:, np.newaxis], grid_lats[js], grid_lons[is_])
+    return in_grid, js * ni + is_, distances
+
+
+def _binary_search(values, x):
+    # indexes of the two consecutive values bracketing x (ecCodes grib_binary_search), with values sorted either way
+    n = len(values) - 1
+    if values[n] >= values[0]:
+        lower = np.searchsorted(values, x, side='right') - 1
+    else:
+        lower = np.searchsorted(-values, -x, side='left') - 1
+    lower = np.clip(lower, 0, n - 1)
+    return lower, lower + 1
+
+
+def _kdtree_neighbours(gid, lats, lons):
+    # four closest grid points (ecCodes generic nearest)
+    grid_lats = eccodes.codes_get_array(gid, 'latitudes')
+    grid_lons = eccodes.codes_get_array(gid, 'longitudes')
+    _, idxs = cKDTree(_to_xyz(grid_lats, grid_lons)).query(_to_xyz(lats, lons), k=4)
+    distances = _distance(_radius(gid), lats[:, np.newaxis], lons[:, np.newaxis], grid_lats[idxs], grid_lons[idxs])
+    return np.ones(lats.shape, dtype=bool), idxs, distances
+
+
+def _to_xyz(lats, lons):
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.column_stack((np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)))
+
+
+def _rotate(lats, lons, south_pole_lat, south_pole_lon):
+    lats, lons = np.radians(lats), np.radians(lons - south_pole_lon)
+    x, y, z = np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)
+    theta = np.radians(90 + south_pole_lat)
+    rotated_x = np.cos(theta) * x + np.sin(theta) * z
+    rotated_z = np.cos(theta) * z - np.sin(theta) * x
+    return np.degrees(np.arcsin(np.clip(rotated_z, -1, 1))), np.degrees(np.arctan2(y, rotated_x))
+
+
+def _radius(gid):
+    # earth radius in km, as used by ecCodes for distances
+    if eccodes.codes_is_defined(gid, 'radius') and not eccodes.codes_is_missing(gid, 'radius'):
+        return eccodes.codes_get_double(gid, 'radius') / 1000.
+    return DEFAULT_RADIUS_KM
+
+
+def _distance(radius, lats1, lons1, lats2, lons2):
+    # great circle distance as computed by ecCodes (geographic_distance_spherical)
+    same_point = (lats1 == lats2) & (lons1 == lons2)
+    lons1 = np.where(lons1 >= 360, lons1 - 360, lons1) * np.pi / 180
+    lons2 = np.where(lons2 >= 360, lons2 - 360, lons2) * np.pi / 180
+    lats1, lats2 = lats1 * np.pi / 180, lats2 * np.pi / 180
+    a = np.sin(lats1) * np.sin(lats2) + np.cos(lats1) * np.cos(lats2) * np.cos(lons2 - lons1)
+    return np.where(same_point, 0., radius * np.arccos(np.clip(a, -1, 1)))
 
-def nearest_parallel_step(chunk, gid, mv):
-    lat, lon, x, y = chunk
 
-    idx = int_fill_value
-    if not (lon <= -1.0e+10 or lon == mv):
-        try:
-            n_nearest = eccodes.codes_grib_find_nearest(gid, lat.item(), lon.item())
-        except eccodes.GribInternalError:
-            x = int_fill_value
-            y = int_fill_value
+##############################################
+# Parallel version of grib api nearest neighbour and inverse distance
+# Valid target points are split in contiguous blocks, processed by a pool of processes.
+# Each worker creates its own GRIB handle once and writes results for its blocks
+# into output arrays shared with the main process.
+
+# per process state, set by _init_worker
+_worker = {}
+
+
+class SharedArrays(object):
+    """
+    Numpy arrays backed by shared memory blocks.
+    Created in the main process (with shapes and dtypes) and attached by name in worker processes (with specs).
+    """
+
+    def __init__(self, shapes=None, specs=None):
+        self._shms = {}
+        self.arrays = {}
+        if shapes is not None:
+            for key, (shape, dtype) in shapes.items():
+                size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+                self._attach(key, shared_memory.SharedMemory(create=True, size=size), shape, dtype)
+            self._owner = True
         else:
-            idx = n_nearest[0]['index']
-    return int(x), int(y), idx
-
-
-def grib_nearest_parallel(gid, target_lats, target_lons, mv):
-    nchunks = target_lats.shape[0]
-    apply_to_chunk_part = partial(apply_nearest_to_chunk, gid=gid, mv=mv)
-    result = init_parallel(apply_to_chunk_part, mv, nchunks, target_lats, target_lons)
-    progress = ProgressBar(dt=10)
-    with progress:
-        result = result.compute()
-    idxs, xs, ys = concatenate_nearest_result(nchunks, result)
-    return xs, ys, idxs
+            for key, (name, shape, dtype) in specs.items():
+                self._attach(key, shared_memory.SharedMemory(name=name), shape, dtype)
+            self._owner = False
 
+    def _attach(self, key, shm, shape, dtype):
+        self._shms[key] = shm
+        self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
 
-def concatenate_nearest_result(nchunks, result):
-    xs = np.concatenate([result[i][0] for i in range(nchunks)])
-    ys = np.concatenate([result[i][1] for i in range(nchunks)])
-    idxs = np.concatenate([result[i][2] for i in range(nchunks)])
-    xs = xs[xs != int_fill_value]
-    ys = ys[ys != int_fill_value]
-    idxs = idxs[idxs != int_fill_value]
-    return idxs, xs, ys
+    @property
+    def specs(self):
+        return {key: (self._shms[key].name, array.shape, array.dtype.str) for key, array in self.arrays.items()}
 
+    def __getitem__(self, key):
+        return self.arrays[key]
 
-# Parallel version of grib api invdist
+    def close(self):
+        self.arrays = {}
+        for shm in self._shms.values():
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._shms = {}
 
 
-def apply_invdist_to_chunk(chunk, gid=None, mv=None):
-    return np.apply_along_axis(invdist_parallel_step, 0, chunk, gid, mv)
+def _init_worker(message, specs, npoints):
+    _worker['gid'] = eccodes.codes_new_from_message(message)
+    _worker['arrays'] = SharedArrays(specs=specs)
+    _worker['npoints'] = npoints
 
 
-def invdist_parallel_step(chunk, gid, mv):
-    lat, lon, x, y = chunk
-    idx1 = idx2 = idx3 = idx4 = int_fill_value
-    inv1 = inv2 = inv3 = inv4 = np.NaN
-    if not (lon < -1.0e+10 or lon == mv):
+def _find_nearest_block(block):
+    # nearest points of target points in block, written to shared idxs (and invs for inverse distance)
+    start, end = block
+    gid, arrays, npoints = _worker['gid'], _worker['arrays'], _worker['npoints']
+    lats, lons, idxs = arrays['lats'], arrays['lons'], arrays['idxs']
+    outs = 0
+    for i in range(start, end):
         try:
-            n_nearest = eccodes.codes_grib_find_nearest(gid, lat.item(), lon.item(), npoints=4)
+            n_nearest = eccodes.codes_grib_find_nearest(gid, lats[i].item(), lons[i].item(), npoints=npoints)
         except eccodes.GribInternalError:
             # tipically "out of grid" error
-            x = int_fill_value
-            y = int_fill_value
+            outs += 1
         else:
-            inv1, inv2, inv3, inv4, idx1, idx2, idx3, idx4 = _compute_coeffs_and_idxs(n_nearest)
-    return x, y, idx1, idx2, idx3, idx4, inv1, inv2, inv3, inv4
-
-
-def grib_invdist_parallel(gid, target_lats, target_lons, mv):
-
-    apply_to_chunk_part = partial(apply_invdist_to_chunk, gid=gid, mv=mv)
-    nchunks = target_lats.shape[0]
-    result = init_parallel(apply_to_chunk_part, mv, nchunks, target_lats, target_lons)
+            if npoints == 1:
+                idxs[i] = n_nearest[0]['index']
+            else:
+                inv1, inv2, inv3, inv4, idx1, idx2, idx3, idx4 = _compute_coeffs_and_idxs(n_nearest)
+                arrays['invs'][i] = inv1, inv2, inv3, inv4
+                idxs[i] = idx1, idx2, idx3, idx4
+    return end - start, outs
+
+
+class ParallelNearest(object):
+    """
+    Pool of `workers` processes (default: number of CPUs) querying ecCodes for nearest points of target points.
+    Pool and shared arrays (for at most `capacity` target points) are created once, at the first find,
+    and used by all following ones: each worker creates its GRIB handle only once,
+    also when an intertable is created in many (checkpointed) blocks of target rows.
+    """
+
+    def __init__(self, gid, npoints, capacity, workers=None):
+        self.npoints = npoints
+        self.capacity = capacity
+        self.workers = workers or os.cpu_count()
+        self._message = eccodes.codes_get_message(gid)
+        self._arrays = None
+        self._pool = None
+
+    def _start(self):
+        shape = (self.capacity,) if self.npoints == 1 else (self.capacity, self.npoints)
+        shapes = {'lats': ((self.capacity,), np.float64), 'lons': ((self.capacity,), np.float64), 'idxs': (shape, np.int64)}
+        if self.npoints > 1:
+            shapes['invs'] = (shape, np.float64)
+        self._arrays = SharedArrays(shapes)
+        self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                          initargs=(self._message, self._arrays.specs, self.npoints))
+
+    def find(self, target_lats, target_lons, mv, description='Nearest neighbour'):
+        """
+        :return: target xs and ys, indexes with shape (n,) or (n, 4) and inverse distances with shape (n, 4) (only if npoints is 4),
+        for target points in grid
+        """
+        valid_target_coords = (target_lons > -1.0e+10) & (target_lons != mv)
+        xs, ys = np.nonzero(valid_target_coords)
+        num_cells = len(xs)
+        if num_cells > self.capacity:
+            raise ValueError('{} target points exceed capacity of parallel nearest ({})'.format(num_cells, self.capacity))
+        if self._pool is None:
+            self._start()
+        arrays = self._arrays
+        arrays['lats'][:num_cells] = target_lats[valid_target_coords]
+        arrays['lons'][:num_cells] = target_lons[valid_target_coords]
+        arrays['idxs'][:num_cells].fill(int_fill_value)
+        # contiguous blocks, more than workers to balance load and to report progress
+        bounds = np.linspace(0, num_cells, min(num_cells, self.workers * 16) + 1, dtype=int)
+        blocks = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+        back_char, _ = progress_step_and_backchar(num_cells)
+        format_progress = ('{}' + description + ' interpolation: {}/{}  [outs: {}] ({:.1f}%) [workers: {}]').format
+        done = outs = 0
+        stdout.write('Start interpolation: {}\n'.format(now_string()))
+        stdout.write(format_progress(back_char, 0, num_cells, outs, 0, self.workers))
+        stdout.flush()
+        for block_cells, block_outs in self._pool.imap_unordered(_find_nearest_block, blocks):
+            done += block_cells
+            outs += block_outs
+            stdout.write(format_progress(back_char, done, num_cells, outs, done * 100. / max(num_cells, 1), self.workers))
+            stdout.flush()
+        stdout.write('\nEnd interpolation: {}\n\n'.format(now_string()))
+        stdout.flush()
+
+        idxs = arrays['idxs'][:num_cells].copy()
+        invs = arrays['invs'][:num_cells].copy() if self.npoints > 1 else None
+        in_grid = (idxs if self.npoints == 1 else idxs[:, 0]) != int_fill_value
+        return xs[in_grid], ys[in_grid], idxs[in_grid], invs[in_grid] if invs is not None else None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._arrays is not None:
+            self._arrays.close()
+            self._arrays = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def grib_nearest_parallel(gid, target_lats, target_lons, mv, workers=None, pool=None):
+    """
+    Parallel version of grib_nearest.
+    :param pool: ParallelNearest to use (with npoints 1), otherwise one is created for this call only
+    """
+    if pool is None:
+        with ParallelNearest(gid, 1, target_lons.size, workers) as pool:
+            return grib_nearest_parallel(gid, target_lats, target_lons, mv, pool=pool)
+    xs, ys, idxs, _ = pool.find(target_lats, target_lons, mv)
+    return xs, ys, idxs
 
-    progress = ProgressBar(dt=10)
-    with progress:
-        result = result.compute()
-    idxs1, idxs2, idxs3, idxs4, xs, ys, invs1, invs2, invs3, invs4 = concatenate_invdist_result(nchunks, result)
 
+def grib_invdist_parallel(gid, target_lats, target_lons, mv, workers=None, pool=None):
+    """
+    Parallel version of grib_invdist.
+    :param pool: ParallelNearest to use (with npoints 4), otherwise one is created for this call only
+    """
+    if pool is None:
+        with ParallelNearest(gid, 4, target_lons.size, workers) as pool:
+            return grib_invdist_parallel(gid, target_lats, target_lons, mv, pool=pool)
+    xs, ys, idxs, invs = pool.find(target_lats, target_lons, mv, description='Inverse distance')
+    # variables seems unused but they are in numexpress expressions (see ne.evaluate())
+    # DO NOT DELETE
+    invs1, invs2, invs3, invs4 = invs.T
     sums = ne.evaluate('invs1 + invs2 + invs3 + invs4')
     coeffs1 = ne.evaluate('invs1 / sums')
     coeffs2 = ne.evaluate('invs2 / sums')
     coeffs3 = ne.evaluate('invs3 / sums')
     coeffs4 = ne.evaluate('invs4 / sums')
-
-    xs = xs[xs != int_fill_value]
-    ys = ys[ys != int_fill_value]
-    idxs1 = idxs1[idxs1 != int_fill_value]
-    idxs2 = idxs2[idxs2 != int_fill_value]
-    idxs3 = idxs3[idxs3 != int_fill_value]
-    idxs4 = idxs4[idxs4 != int_fill_value]
+    idxs1, idxs2, idxs3, idxs4 = idxs.T
     return xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4
-
-
-def concatenate_invdist_result(nchunks, result):
-    xs = np.concatenate([result[i][0] for i in range(nchunks)])
-    ys = np.concatenate([result[i][1] for i in range(nchunks)])
-    idxs1 = np.concatenate([result[i][2] for i in range(nchunks)])
-    idxs2 = np.concatenate([result[i][3] for i in range(nchunks)])
-    idxs3 = np.concatenate([result[i][4] for i in range(nchunks)])
-    idxs4 = np.concatenate([result[i][5] for i in range(nchunks)])
-    invs1 = np.concatenate([result[i][6] for i in range(nchunks)])
-    invs2 = np.concatenate([result[i][7] for i in range(nchunks)])
-    invs3 = np.concatenate([result[i][8] for i in range(nchunks)])
-    invs4 = np.concatenate([result[i][9] for i in range(nchunks)])
-    xs = xs.astype(int, copy=False)
-    ys = ys.astype(int, copy=False)
-    idxs1 = idxs1.astype(int, copy=False)
-    idxs2 = idxs2.astype(int, copy=False)
-    idxs3 = idxs3.astype(int, copy=False)
-    idxs4 = idxs4.astype(int, copy=False)
-    invs1 = invs1[~np.isnan(invs1)]
-    invs2 = invs2[~np.isnan(invs2)]
-    invs3 = invs3[~np.isnan(invs3)]
-    invs4 = invs4[~np.isnan(invs4)]
-    return idxs1, idxs2, idxs3, idxs4, xs, ys, invs1, invs2, invs3, invs4
-
-
-def init_parallel(apply_to_chunk_part, mv, nchunks, target_lats, target_lons):
-    indices = np.indices(target_lons.shape)
-    npartitions = max(100, int(nchunks / 10))
-    valid_coords_mask = (target_lons > -1.0e+10) & (target_lons != mv)
-    xs = np.where(valid_coords_mask, indices[0], int_fill_value).ravel()
-    ys = np.where(valid_coords_mask, indices[1], int_fill_value).ravel()
-    stack = np.stack((target_lats.flat, target_lons.flat, xs.flat, ys.flat))
-    chunks = np.array_split(stack, nchunks, axis=1)
-    nearest_bag = bag.from_sequence(chunks, npartitions=npartitions)
-    result = nearest_bag.map(apply_to_chunk_part)
-    return result
@@ -0,0 +1,237 @@
+"""
+Reading and writing of interpolation tables.
+
+Intertables are saved as plain .npy files, so that they are memory mapped when loaded:
+no decompression is needed and concurrent processes share the same pages of the OS cache.
+Compressed tables (.npy.gz, pyg2p 3.1) are still readable and can be converted with convert().
+
+New tables have a compact layout: int32 indexes (when source grid allows it) and float32 weights.
+Tables are used as they are stored, without copies: numpy gathers with int32 indexes directly
+and float32 weights are promoted to float64 in the arithmetic with float64 values,
+so tables created by previous versions (int64/float64) work unchanged.
+
+Long intertable creations are done in blocks of target rows, saved in a <intertable>.partial folder
+as they are computed (see build_in_blocks), so that an interrupted creation resumes from the last saved block.
+
+Concurrent processes creating intertables coordinate with a <intertable>.lock file, holding the id of the intertable:
+it reserves the filename (see reserve) and it's locked while the intertable is created (see CreationLock),
+so a process needing the same intertable waits for it instead of creating it again.
+"""
+import fcntl
+import gzip
+import os
+import shutil
+from sys import stdout
+
+import numpy as np
+
+from ...util import files
+
+GZ_EXT = '.gz'
+PARTIAL_EXT = '.partial'
+LOCK_EXT = '.lock'
+WEIGHTS_DTYPE = np.float32
+
+
+def index_dtype(max_index):
+    # int32 unless the source grid is too big for it
+    return np.int32 if max_index < np.iinfo(np.int32).max else np.int64
+
+
+def compact_indexes(indexes):
+    return np.asarray(indexes, dtype=index_dtype(indexes.max() if indexes.size else 0))
+
+
+def scipy_table(indexes, weights):
+    # record array with fields 'indexes' and 'coeffs' (weights for invdist, distances for nearest)
+    return np.rec.fromarrays((compact_indexes(indexes), np.asarray(weights, dtype=WEIGHTS_DTYPE)),
+                             names=('indexes', 'coeffs'))
+
+
+def grib_nearest_table(xs, ys, idxs):
+    # rows: target xs, target ys, source indexes
+    return compact_indexes(np.asarray([xs, ys, idxs]))
+
+
+def grib_invdist_table(indexes, coeffs):
+    """
+    Single record with fields 'indexes' (target xs, ys and four source indexes) and 'coeffs' (four weights).
+    Fields have different shapes, so coefficients don't need padding rows (as in the record array used before).
+    """
+    indexes = compact_indexes(np.asarray(indexes))
+    coeffs = np.asarray(coeffs, dtype=WEIGHTS_DTYPE)
+    intertable = np.zeros((), dtype=[('indexes', indexes.dtype, indexes.shape), ('coeffs', coeffs.dtype, coeffs.shape)])
+    intertable['indexes'] = indexes
+    intertable['coeffs'] = coeffs
+    return intertable
+
+
+def native_path(path):
+    # path of the uncompressed, memory mappable intertable
+    return path[:-len(GZ_EXT)] if path.endswith(GZ_EXT) else path
+
+
+def compressed_path(path):
+    return native_path(path) + GZ_EXT
+
+
+def exists(path):
+    return files.exists(native_path(path)) or files.exists(compressed_path(path))
+
+
+def load(path):
+    """
+    Loads intertable from path, preferring the .npy file (memory mapped, read only) to the .npy.gz one.
+    :raise FileNotFoundError: if none of them exists
+    """
+    native = native_path(path)
+    if files.exists(native):
+        return np.load(native, mmap_mode='r')
+    compressed = compressed_path(path)
+    if files.exists(compressed):
+        with gzip.GzipFile(compressed, 'r') as f:
+            return np.load(f)
+    raise FileNotFoundError(f'Tried to read both {native} and {compressed} but none was found')
+
+
+def save(path, intertable):
+    """
+    Saves intertable as .npy file (.gz extension is removed from path) and removes partial results of its creation.
+    The file is written with a temporary name and then renamed, so other processes never map a partial table.
+    :return: path of the written file
+    """
+    native = native_path(path)
+    save_atomic(native, np.save, intertable)
+    Checkpoint.remove(native)
+    return native
+
+
+def save_atomic(path, save_function, *args):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            save_function(f, *args)
+        os.replace(tmp_path, path)
+    finally:
+        files.delete_file(tmp_path)
+
+
+class Checkpoint(object):
+    """
+    Arrays computed for blocks of an intertable being created, saved in <intertable>.partial folder.
+    Saved blocks are reused only by a creation with the same key (e.g. intertable id, target shape and block size),
+    otherwise they are discarded.
+    """
+    _key_file = 'key'
+
+    def __init__(self, path, key):
+        self.folder = native_path(path) + PARTIAL_EXT
+        key_path = os.path.join(self.folder, self._key_file)
+        if files.exists(key_path):
+            with open(key_path) as f:
+                if f.read() != key:
+                    self.remove(path)
+        if not files.exists(key_path):
+            files.create_dir(self.folder)
+            save_atomic(key_path, lambda f, k: f.write(k.encode()), key)
+
+    def _block_path(self, start):
+        return os.path.join(self.folder, f'block_{start:09d}.npz')
+
+    def load(self, start):
+        # arrays of block starting at row `start`, or None if it was not saved
+        block_path = self._block_path(start)
+        if not files.exists(block_path):
+            return None
+        with np.load(block_path) as block:
+            return tuple(block[f'arr_{i}'] for i in range(len(block.files)))
+
+    def save(self, start, arrays):
+        save_atomic(self._block_path(start), np.savez, *arrays)
+
+    @staticmethod
+    def remove(path):
+        shutil.rmtree(native_path(path) + PARTIAL_EXT, ignore_errors=True)
+
+
+def reserve(path, intertable_id):
+    """
+    Reserves path for a new intertable, creating its lock file.
+    :return: False if path is reserved for another intertable
+    """
+    lock_path = native_path(path) + LOCK_EXT
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with open(lock_path) as f:
+            # a lock file left by an interrupted creation of the same intertable is reused
+            return f.read() == intertable_id
+    with os.fdopen(fd, 'w') as f:
+        f.write(intertable_id)
+    return True
+
+
+class CreationLock(object):
+    """
+    Exclusive lock on <intertable>.lock file, held while the intertable is created.
+    Lock file is removed when the intertable is saved or its creation fails.
+    """
+
+    def __init__(self, path, intertable_id):
+        self.path = native_path(path) + LOCK_EXT
+        self.intertable_id = intertable_id
+        self._file = None
+
+    def __enter__(self):
+        while True:
+            f = open(self.path, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if files.exists(self.path) and os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+            # lock file was removed by the process that held the lock: lock the new one
+            f.close()
+        if not os.fstat(f.fileno()).st_size:
+            f.write(self.intertable_id)
+            f.flush()
+        self._file = f
+        return self
+
+    def __exit__(self, *args):
+        files.delete_file(self.path)
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def build_in_blocks(path, key, num_rows, block_rows, compute_block):
+    """
+    Computes the arrays of a new intertable for blocks of target rows, saving each block as it's computed.
+    Blocks saved by a previous (interrupted) creation with the same key are not computed again.
+    Partial results are removed when the intertable is saved (see save()).
+    :param compute_block: function of (start_row, end_row) returning a tuple of arrays for the target points in those rows
+    :return: tuple of arrays of all blocks, concatenated
+    """
+    checkpoint = Checkpoint(path, key)
+    blocks = []
+    for start in range(0, num_rows, block_rows):
+        arrays = checkpoint.load(start)
+        if arrays is not None:
+            stdout.write('Resuming intertable creation: rows {}-{} read from {}\n'.format(start, min(start + block_rows, num_rows), checkpoint.folder))
+        else:
+            arrays = compute_block(start, min(start + block_rows, num_rows))
+            checkpoint.save(start, arrays)
+        blocks.append(arrays)
+    return tuple(np.concatenate(block_arrays) for block_arrays in zip(*blocks))
+
+
+def convert(path, remove_compressed=False):
+    """
+    Converts a .npy.gz intertable to the memory mappable .npy format.
+    :return: path of the converted intertable
+    """
+    compressed = compressed_path(path)
+    with gzip.GzipFile(compressed, 'r') as f:
+        intertable = np.load(f)
+    native = save(compressed, intertable)
+    if remove_compressed:
+        files.delete_file(compressed)
+    return native
@@ -0,0 +1,62 @@
+"""
+Interpolation tables as sparse matrices.
+
+An intertable of scipy modes is a CSR matrix with a row for each target point and a column for each source point,
+so that interpolating a field is a sparse matrix-vector product and interpolating a stack of fields
+(one for each timestep) is a single sparse matrix-matrix product.
+"""
+import numpy as np
+import numpy.ma as ma
+from scipy.sparse import csr_matrix
+
+
+class SparseInterpolation(object):
+    """
+    Interpolation operator from scipy intertable arrays.
+
+    Source indexes equal to source size (KDTree result for neighbours not found) don't have entries in the matrix:
+    their weights are kept in `out_weights` and multiply the output missing value.
+    Masked source values are handled with a second product of the same matrix with the mask:
+    target points with a positive weight on masked source values are masked.
+    """
+
+    def __init__(self, indexes, weights, source_size):
+        indexes = np.asarray(indexes)
+        if indexes.ndim == 1:
+            # nearest neighbour: coeffs in intertable are distances, not weights
+            indexes = indexes[:, np.newaxis]
+            weights = np.ones(indexes.shape, dtype=np.float32)
+        else:
+            # weights keep the dtype of the intertable (float32): results are float64 as source values
+            weights = np.asarray(weights)
+        in_source = indexes < source_size
+        indptr = np.zeros(len(indexes) + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(in_source, axis=1), out=indptr[1:])
+        self.matrix = csr_matrix((weights[in_source], indexes[in_source], indptr), shape=(len(indexes), source_size))
+        out_weights = np.where(in_source, 0., weights).sum(axis=1, dtype=np.float64)
+        self.out_rows = np.flatnonzero(out_weights)
+        self.out_weights = out_weights[self.out_rows]
+        self.shape = self.matrix.shape
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes + self.out_rows.nbytes + self.out_weights.nbytes
+
+    def apply(self, values, mv):
+        """
+        Interpolates source values with shape (N,) or (T, N), returning an array with shape (M,) or (T, M).
+        :param values: source values, also masked
+        :param mv: missing value for target points that can't be interpolated
+        """
+        mask = ma.getmask(values)
+        data = (ma.getdata(values) if mask is ma.nomask else ma.filled(values, 0)).astype(np.float64, copy=False)
+        result = self.matrix.dot(data.T)
+        if self.out_rows.size:
+            out_values = self.out_weights * mv
+            result[self.out_rows] += out_values if result.ndim == 1 else out_values[:, np.newaxis]
+        result = result.T
+        if mask is ma.nomask or not mask.any():
+            return result
+        missing = self.matrix.dot(mask.T.astype(np.float64)).T > 0
+        result[missing] = mv
+        return ma.masked_where(missing, result, copy=False)
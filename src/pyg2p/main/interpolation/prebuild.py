@@ -0,0 +1,258 @@
+"""
+Creation of intertables ahead of conversion runs, for a catalogue of source grids and target maps.
+
+A catalogue is a JSON file (or a dict, from API) like:
+
+    {
+      "sources": ["/dataset/samples/eue_sample.grib", "-71$M$1$1$1$lambert"],
+      "targets": [{"latMap": "{EFAS_MAPS}/lat.map", "lonMap": "{EFAS_MAPS}/lon.map",
+                   "modes": ["grib_nearest", "invdist"], "nnear": 4, "power": 2, "rotated_target": false}]
+    }
+
+Sources are GRIB sample files (intertables are created for all grids found in them)
+or grid ids, read from the configured geopotential file of that grid.
+An intertable is planned for each source grid, target and interpolation mode, and it is built if it's missing.
+Tables are computed by a pool of processes and registered in intertables.json by the main process only.
+"""
+import json
+import multiprocessing
+import os
+from collections import namedtuple
+from sys import stdout
+
+import numpy as np
+from eccodes import codes_grib_new_from_file, codes_get, codes_get_double_array, codes_release
+
+from . import Interpolator, grib_interpolation_lib, intertables
+from ..context import Context
+from ..readers import GRIBReader
+from ..config import Configuration
+from ... import GribGridDetails
+from ...exceptions import (ApplicationException, WRONG_ARGS, JSON_ERROR, INVALID_INTERPOL_METHOD,
+                           NOT_EXISTING_INPUT_GRIB, NOT_EXISTING_MAPS)
+from ...util import files
+
+# rough single core seconds for each target point and each source point (to build search structures)
+SECONDS_PER_POINT = {'ecCodes': (3e-3, 0.), 'bulk': (1e-6, 1e-6), 'KD tree': (1e-6, 2e-6)}
+
+IntertableJob = namedtuple('IntertableJob', ('intertable_id', 'path', 'exists', 'mode', 'method', 'seconds',
+                                             'source_file', 'message', 'grid_id', 'source_points', 'target_points',
+                                             'target'))
+
+
+class IntertableContext(Context):
+    """
+    Execution parameters of an Interpolator creating the intertable of a source file, a catalogue target and a mode.
+    """
+
+    def __init__(self, configuration, source_file, target, mode, dirs, parallel=False, workers=None):
+        super().__init__(configuration)
+        if mode not in self.allowed_interp_methods:
+            raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, details=mode)
+        self._vars['input.file'] = source_file
+        self._vars['interpolation.mode'] = mode
+        self._vars['interpolation.latMap'] = target['latMap']
+        self._vars['interpolation.lonMap'] = target['lonMap']
+        self._vars['interpolation.rotated_target'] = target.get('rotated_target', False)
+        self._vars['interpolation.nnear'] = self._number(target.get('nnear'), int, 'Interpolation nnear')
+        self._vars['interpolation.power'] = self._number(target.get('power'), float, 'Interpolation power')
+        self._vars['interpolation.dirs'] = dirs
+        self._vars['interpolation.create'] = True
+        self._vars['interpolation.parallel'] = parallel
+        self._vars['interpolation.workers'] = workers
+        # string interpolation for custom user configurations (i.e. maps folders)
+        self.configuration.user.interpolate_strings(self)
+        if not files.exists(self._vars['interpolation.lonMap']) or not files.exists(self._vars['interpolation.latMap']):
+            raise ApplicationException.get_exc(
+                NOT_EXISTING_MAPS,
+                details=f"{self._vars['interpolation.lonMap']} - {self._vars['interpolation.latMap']}"
+            )
+
+
+class _PrebuildInterpolator(Interpolator):
+    # configuration items of created intertables are returned to the main process instead of being dumped.
+    # None if the intertable was created by another process after planning
+    created = None
+
+    def update_intertable_conf(self, intertable, intertable_id, intertable_name, source_shape):
+        self.created = intertable_id, self.intertable_conf_item(intertable_name, source_shape)
+
+
+def load_catalogue(catalogue):
+    if isinstance(catalogue, dict):
+        content = catalogue
+    else:
+        try:
+            with open(catalogue) as f:
+                content = json.load(f)
+        except OSError as e:
+            raise ApplicationException.get_exc(WRONG_ARGS, details=f'Cannot read catalogue {catalogue}: {e}')
+        except ValueError as e:
+            raise ApplicationException.get_exc(JSON_ERROR, details=f'{e} {catalogue}')
+    if not content.get('sources') or not content.get('targets'):
+        raise ApplicationException.get_exc(WRONG_ARGS, details='Catalogue must have "sources" and "targets" lists')
+    for target in content['targets']:
+        if not target.get('latMap') or not target.get('lonMap') or not target.get('modes'):
+            raise ApplicationException.get_exc(WRONG_ARGS, details=f'Catalogue target needs latMap, lonMap and modes: {target}')
+    return content
+
+
+def _messages(source_file, headers_only=True):
+    # (position, handle) of all messages in file. Handles must be released by caller
+    with open(source_file, 'rb') as f:
+        position = 0
+        while True:
+            gid = codes_grib_new_from_file(f, headers_only=headers_only)
+            if gid is None:
+                break
+            yield position, gid
+            position += 1
+
+
+def _source_grids(configuration, source, geopotential_dir=None):
+    """
+    Grids of a catalogue source, as (file, message position, grid id, number of points, bulk supported) tuples.
+    A source is a GRIB file or a grid id, whose geopotential file is used.
+    """
+    if files.exists(source):
+        source_file, grid_ids = source, None
+    else:
+        source_file, grid_ids = configuration.geopotentials.get_filepath(source, additional=geopotential_dir), (source,)
+    if not files.exists(source_file):
+        raise ApplicationException.get_exc(NOT_EXISTING_INPUT_GRIB, source_file)
+    grids = {}
+    for position, gid in _messages(source_file):
+        grid_id = GribGridDetails(gid).grid_id
+        if grid_id not in grids and (grid_ids is None or grid_id in grid_ids):
+            grids[grid_id] = (source_file, position, grid_id, codes_get(gid, 'numberOfValues'), grib_interpolation_lib.supports_bulk(gid))
+        codes_release(gid)
+    return list(grids.values())
+
+
+def _estimate(mode, bulk, source_points, target_points, nnear):
+    if mode in ('grib_nearest', 'grib_invdist'):
+        method = 'bulk' if bulk else 'ecCodes'
+    else:
+        method = 'KD tree'
+        target_points *= nnear
+    target_seconds, source_seconds = SECONDS_PER_POINT[method]
+    return method, target_points * target_seconds + source_points * source_seconds
+
+
+def plan(configuration, catalogue, dirs, geopotential_dir=None, reserve=False):
+    """
+    Intertables of all source grids, targets and modes of the catalogue, existing or to build.
+    :param reserve: reserve filenames of intertables to build
+    :return: list of IntertableJob
+    """
+    catalogue = load_catalogue(catalogue)
+    grids = [grid for source in catalogue['sources'] for grid in _source_grids(configuration, source, geopotential_dir)]
+    jobs = {}
+    reserved = set()
+    for target in catalogue['targets']:
+        for mode in target['modes']:
+            for source_file, position, grid_id, source_points, bulk in grids:
+                ctx = IntertableContext(configuration, source_file, target, mode, dirs)
+                interpolator = Interpolator(ctx, None)
+                intertable_id, path = interpolator._intertable_filename(grid_id, reserved=reserved, reserve=reserve)
+                if intertable_id in jobs:
+                    continue
+                exists = intertables.exists(path)
+                if not exists:
+                    reserved.add(path)
+                lats, mv = interpolator._target_coords.lats, interpolator._target_coords.mv
+                target_points = np.count_nonzero(lats != mv)
+                method, seconds = _estimate(mode, bulk, source_points, target_points, interpolator._nnear)
+                jobs[intertable_id] = IntertableJob(intertable_id, path, exists, mode, method, seconds,
+                                                    source_file, position, grid_id, source_points, target_points, target)
+    return list(jobs.values())
+
+
+def build(job, configuration=None, parallel=False, workers=None):
+    """
+    Creates the intertable of a job, computed with the same functions of conversion runs (and checkpointed in blocks).
+    :return: (intertable id, intertables.json item), or None if the intertable was created by another process
+    """
+    configuration = configuration or Configuration()
+    dirs = {'global': configuration.intertables.global_data_path, 'user': os.path.dirname(job.path)}
+    if not configuration.intertables.data_path:
+        configuration.intertables.data_path = dirs['user']
+    ctx = IntertableContext(configuration, job.source_file, job.target, job.mode, dirs, parallel=parallel, workers=workers)
+    messages = _messages(job.source_file, headers_only=False)
+    for position, gid in messages:
+        if position == job.message:
+            break
+        codes_release(gid)
+    messages.close()
+    try:
+        interpolator = _PrebuildInterpolator(ctx, codes_get(gid, 'missingValue'))
+        if ctx.is_with_grib_interpolation:
+            values = codes_get_double_array(gid, 'values')
+            interpolator.grib_methods[job.mode](values, gid, job.grid_id,
+                                                intertable_id=job.intertable_id, intertable_name=job.path)
+        else:
+            values = GRIBReader._read_values(gid)
+            grid_details = GribGridDetails(gid)
+            lats, lons = grid_details.latlons
+            interpolator.interpolate_scipy(lats, lons, values, job.grid_id, grid_details,
+                                           intertable_id=job.intertable_id, intertable_name=job.path)
+    finally:
+        codes_release(gid)
+    return interpolator.created
+
+
+def report(jobs, workers=1):
+    lines = []
+    for job in jobs:
+        status = 'existing' if job.exists else 'to build'
+        lines.append(f'[{status}] {job.intertable_id} ({job.mode}, {job.method})\n'
+                     f'    {job.source_file} (grid {job.grid_id}, {job.source_points} points) -> '
+                     f"{job.target['latMap']} ({job.target_points} points)\n"
+                     f'    {job.path} - estimated {job.seconds:.1f}s')
+    missing = [job for job in jobs if not job.exists]
+    seconds = sum(job.seconds for job in missing)
+    lines.append(f'{len(missing)} intertables to build out of {len(jobs)}. '
+                 f'Estimated time: {seconds:.0f}s ({seconds / workers:.0f}s with {workers} workers)')
+    return '\n'.join(lines)
+
+
+def prebuild_intertables(catalogue, configuration=None, intertable_dir=None, geopotential_dir=None, workers=None, dry_run=False):
+    """
+    Builds missing intertables of a catalogue, in parallel, and registers them in intertables.json.
+    Tables are built in a pool of processes (one table for each process), or in the main process
+    using parallel interpolation functions when there is only one table to build.
+    :param catalogue: path to JSON catalogue or dict
+    :param dry_run: only report what would be built, with estimated cost
+    :return: list of IntertableJob (intertables existing before execution have job.exists True)
+    """
+    configuration = configuration or Configuration()
+    dirs = {'global': configuration.intertables.global_data_path,
+            'user': intertable_dir or configuration.default_interpol_dir}
+    if not configuration.intertables.data_path:
+        configuration.intertables.data_path = dirs['user']
+    workers = workers or os.cpu_count()
+
+    jobs = plan(configuration, catalogue, dirs, geopotential_dir, reserve=not dry_run)
+    stdout.write(report(jobs, workers) + '\n')
+    missing = [job for job in jobs if not job.exists]
+    if dry_run or not missing:
+        return jobs
+
+    if workers > 1 and len(missing) > 1:
+        with multiprocessing.Pool(min(workers, len(missing))) as pool:
+            for i, created in enumerate(pool.imap_unordered(build, missing), start=1):
+                _register(configuration, created, i, len(missing))
+    else:
+        for i, job in enumerate(missing, start=1):
+            _register(configuration, build(job, configuration, parallel=workers > 1, workers=workers), i, len(missing))
+    return jobs
+
+
+def _register(configuration, created, i, total):
+    if created is None:
+        # another process created (and registered) the intertable after planning
+        stdout.write(f'[{i}/{total}] Intertable already created by another process\n')
+        return
+    intertable_id, item = created
+    configuration.intertables.add(intertable_id, item)
+    stdout.write(f'[{i}/{total}] Created intertable {intertable_id}: {item["filename"]}\n')
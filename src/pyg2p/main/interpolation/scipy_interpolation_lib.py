@@ -1,3 +1,5 @@
+import json
+import os
 from math import radians
 from sys import stdout
 
@@ -6,68 +8,167 @@ import numexpr as ne
 import numpy as np
 from scipy.spatial import cKDTree as KDTree
 
+from . import intertables
 from ...exceptions import ApplicationException, WEIRD_STUFF
+from pyg2p.util import files
 from pyg2p.util.numeric import mask_it, empty
 from pyg2p.util.generics import progress_step_and_backchar
 from pyg2p.util.strings import now_string
 
 
+class SourceTree(object):
+    """
+    KD tree of source grid points with the min upper bound of neighbours distances.
+    On disk, points of the tree are saved as <path>.npy and bound and sampling parameters as <path>.json:
+    the tree is built again from points when it's read, and files are ignored (and overwritten)
+    when they are unreadable or computed with different parameters.
+    """
+    def __init__(self, tree, min_upper_bound):
+        self.tree = tree
+        self.min_upper_bound = min_upper_bound
+
+    @property
+    def nbytes(self):
+        # points and their indexes (nodes are a small fraction of them)
+        return self.tree.data.nbytes + self.tree.indices.nbytes
+
+    @classmethod
+    def load(cls, path, parameters):
+        if not files.exists(path + '.json') or not files.exists(path + '.npy'):
+            return None
+        try:
+            with open(path + '.json') as f:
+                content = json.load(f)
+            if content.get('parameters') != parameters:
+                stdout.write('KDTree in {} was computed with different parameters\n'.format(path))
+                return None
+            points = np.load(path + '.npy')
+            if points.shape != (parameters['points'], 3):
+                raise ValueError('unexpected shape {}'.format(points.shape))
+            stdout.write('Reading KDTree from {}\n'.format(path))
+            return cls(KDTree(points, leafsize=parameters['leafsize']), float(content['min_upper_bound']))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            stdout.write('KDTree in {} can\'t be read: {}\n'.format(path, e))
+            return None
+
+    def save(self, path, parameters):
+        content = {'min_upper_bound': float(self.min_upper_bound), 'parameters': parameters}
+        try:
+            # points before parameters, so that a complete json always refers to complete points
+            intertables.save_atomic(path + '.npy', np.save, self.tree.data)
+            intertables.save_atomic(path + '.json', lambda f, c: f.write(json.dumps(c).encode()), content)
+        except OSError as e:
+            stdout.write('KDTree not saved to {}: {}\n'.format(path, e))
+
+
 class InverseDistance(object):
     """
     http://docs.scipy.org/doc/scipy/reference/spatial.html
     """
+    # target cells queried and processed at once
+    chunk_size = 1000000
+    # max number of source points used to estimate source grid resolution
+    bound_sample_size = 100000
+    leafsize = 30
     gribapi_version = list(map(int, eccodes.codes_get_api_version().split('.')))
     rotated_bugfix_gribapi = gribapi_version[0] > 1 or (gribapi_version[0] == 1 and gribapi_version[1] > 14) or (gribapi_version[0] == 1 and gribapi_version[1] == 14 and gribapi_version[2] >= 3)
 
-    def __init__(self, longrib, latgrib, grid_details, source_values, nnear, mv_target, mv_source, target_is_rotated=False, parallel=False):
+    def __init__(self, longrib, latgrib, grid_details, source_values, nnear, mv_target, mv_source, target_is_rotated=False, parallel=False, power=2,
+                 workers=None, chunk_size=None, cache_dir=None, cache=None):
         stdout.write('Start scipy interpolation: {}\n'.format(now_string()))
         self.geodetic_info = grid_details
         self.source_grid_is_rotated = 'rotated' in grid_details.get('gridType')
         self.target_grid_is_rotated = target_is_rotated
-        self.njobs = 1 if not parallel else -1
+        # threads used by KD tree queries (-1: all cores). Interpolator passes the -P number (processes of
+        # GRIB intertables creation) with -X option, so that the same number of cores is used by all modes
+        self.workers = workers or (1 if not parallel else -1)
+        self.chunk_size = chunk_size or self.chunk_size
         self.nnear = nnear
-        # we receive rotated coords from GRIB_API iterator before 1.14.3
-        x, y, zz = self.to_3d(longrib, latgrib, to_regular=not self.rotated_bugfix_gribapi)
-        source_locations = np.vstack((x.ravel(), y.ravel(), zz.ravel())).T
+        self.power = power
+        self.z = source_values
+        self._mv_target = mv_target
+        self._mv_source = mv_source
+        source_tree = self._source_tree(longrib, latgrib, cache_dir, cache)
+        self.tree, self.min_upper_bound = source_tree.tree, source_tree.min_upper_bound
         try:
-            assert len(source_locations) == len(source_values), "len(coordinates) {} != len(values) {}".format(len(source_locations), len(source_values))
+            assert self.tree.n == len(source_values), "len(coordinates) {} != len(values) {}".format(self.tree.n, len(source_values))
         except AssertionError as e:
             ApplicationException.get_exc(WEIRD_STUFF, details=str(e))
 
-        stdout.write('Building KDTree...\n')
-        self.tree = KDTree(source_locations, leafsize=30)  # build the tree
-        self.z = source_values
-
-        self._mv_target = mv_target
-        self._mv_source = mv_source
+    def _source_tree(self, longrib, latgrib, cache_dir=None, cache=None):
+        """
+        KD tree of source grid points and min upper bound of neighbours distances.
+        They are kept by grid id in cache (e.g. Interpolator.cache, within its memory budget) and,
+        if cache_dir is given, saved on disk (see SourceTree), so that intertables for other targets don't compute them again.
+        """
+        grid_id = getattr(self.geodetic_info, 'grid_id', None)
+        cache_key = ('kdtree', grid_id)
+        source_tree = cache.get(cache_key) if grid_id and cache is not None else None
+        if source_tree is not None:
+            stdout.write('Using KDTree of grid {}\n'.format(grid_id))
+            return source_tree
+        parameters = {'bound_sample_size': self.bound_sample_size, 'leafsize': self.leafsize, 'points': int(np.size(longrib))}
+        path = os.path.join(cache_dir, 'kdtree_{}'.format(grid_id.replace('$', '_'))) if grid_id and cache_dir else None
+        if path:
+            source_tree = SourceTree.load(path, parameters)
+        if source_tree is None:
+            # we receive rotated coords from GRIB_API iterator before 1.14.3
+            x, y, zz = self.to_3d(longrib, latgrib, to_regular=not self.rotated_bugfix_gribapi)
+            stdout.write('Building KDTree...\n')
+            tree = KDTree(np.vstack((x.ravel(), y.ravel(), zz.ravel())).T, leafsize=self.leafsize)  # build the tree
+            source_tree = SourceTree(tree, self._min_upper_bound(tree))
+            if path:
+                source_tree.save(path, parameters)
+        if grid_id and cache is not None:
+            cache.put(cache_key, source_tree)
+        return source_tree
+
+    def _min_upper_bound(self, tree):
         # we can calculate resolution in KM as described here:
         # http://math.boisestate.edu/~wright/montestigliano/NearestNeighborSearches.pdf
         # sphdist = R*acos(1-maxdist^2/2);
-        # Finding actual resolution of source GRID
-        distances, indexes = self.tree.query(source_locations, k=2, n_jobs=self.njobs)
+        # Finding actual resolution of source GRID from distances to nearest neighbours
+        # of a sample of source points, evenly taken along the grid (all points for small grids)
+        step = -(-tree.n // self.bound_sample_size)
+        distances, _ = tree.query(tree.data[::step], k=2, workers=self.workers)
         # set max of distances as min upper bound and add an empirical correction value
-        self.min_upper_bound = np.max(distances) + np.max(distances) * 4 / self.geodetic_info.get('Nj')
-
-    def interpolate(self, target_lons, target_lats):
-        # Target coordinates  HAVE to be rotated coords in case GRIB grid is rotated
-        # Example of target rotated coords are COSMO lat/lon/dem PCRASTER maps
-        x, y, z = self.to_3d(target_lons, target_lats, to_regular=self.target_grid_is_rotated)
-        efas_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
-
+        return np.max(distances) + np.max(distances) * 4 / self.geodetic_info.get('Nj')
+
+    def interpolate(self, target_lons, target_lats, with_result=True):
+        """
+        Queries the KD tree for target points in chunks of chunk_size points, using `workers` threads,
+        and builds indexes and weights of each chunk straight into the (compact) intertable arrays.
+        :param with_result: also compute interpolated values (None is returned in their place otherwise,
+                            e.g. when only the intertable is created, so memory depends on the chunk size)
+        :return: interpolated values, weights (distances for nearest neighbour) and indexes
+        """
+        target_lons = np.ravel(target_lons)
+        target_lats = np.ravel(target_lats)
+        num_cells = target_lons.size
+        z = self.z
         stdout.write('Finding indexes for nearest neighbour k={}\n'.format(self.nnear))
-
-        distances, indexes = self.tree.query(efas_locations, k=self.nnear, n_jobs=self.njobs)
-
-        if self.nnear == 1:
-            # return distances, distances, indexes
-            result, indexes = self._build_nn(distances, indexes)
-            weights = distances
-        else:
-            # return distances, distances, indexes
-            result, weights, indexes = self._build_weights(distances, indexes, self.nnear)
-
+        back_char, _ = progress_step_and_backchar(num_cells)
+        result = mask_it(np.empty((num_cells,) + np.shape(z[0])), self._mv_target, 1) if with_result else None
+        shape = (num_cells,) if self.nnear == 1 else (num_cells, self.nnear)
+        # with nearest neighbour, distances are saved in place of weights
+        weights = empty(shape, dtype=intertables.WEIGHTS_DTYPE)
+        idxs = empty(shape, fill_value=z.size, dtype=intertables.index_dtype(z.size))
+        outs = 0
+        for chunk in self._chunks(num_cells, back_char):
+            # Target coordinates  HAVE to be rotated coords in case GRIB grid is rotated
+            # Example of target rotated coords are COSMO lat/lon/dem PCRASTER maps
+            x, y, zz = self.to_3d(target_lons[chunk], target_lats[chunk], to_regular=self.target_grid_is_rotated)
+            distances, indexes = self.tree.query(np.column_stack((x, y, zz)), k=self.nnear, workers=self.workers)
+            result_chunk = result[chunk] if with_result else None
+            if self.nnear == 1:
+                weights[chunk] = distances
+                outs += self._nn_chunk(distances, indexes, result_chunk, idxs[chunk])
+            else:
+                outs += self._weights_chunk(distances, indexes, result_chunk, weights[chunk], idxs[chunk])
+        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, num_cells, num_cells, outs))
         stdout.write('End scipy interpolation: {}\n'.format(now_string()))
-        return result, weights, indexes
+        stdout.flush()
+        return result, weights, idxs
 
     def to_3d(self, lons, lats, rotate=False, to_regular=False):
         # these variables are used. Do NOT remove as they are used by numexpr
@@ -96,75 +197,50 @@ class InverseDistance(object):
             z = ne.evaluate('r * {z}'.format(z=z_formula))
         return x, y, z
 
-    def _build_nn(self, distances, indexes):
-        z = self.z
-        result = mask_it(np.empty((len(distances),) + np.shape(z[0])), self._mv_target, 1)
-        jinterpol = 0
-        num_cells = result.size
-        back_char, progress_step = progress_step_and_backchar(num_cells)
+    def _chunks(self, num_cells, back_char):
+        # slices of target cells to process at once, with progress output
         stdout.write('Skipping neighbors at distance > {}\n'.format(self.min_upper_bound))
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
-        stdout.flush()
-
-        idxs = empty((len(indexes),), fill_value=z.size, dtype=int)
-        # wsum will be saved in intertable
-        outs = 0
-        for dist, ix in zip(distances, indexes):
-            if jinterpol % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, jinterpol, num_cells, outs, jinterpol * 100. / num_cells))
-                stdout.flush()
-            if dist <= self.min_upper_bound:
-                wz = z[ix]
-                idxs[jinterpol] = ix
-            else:
-                # stdout.write('\nneighbour discarded. distance: {}\n'.format(dist))
-                outs += 1
-                wz = self._mv_target
-            result[jinterpol] = wz
-            jinterpol += 1
+        for start in range(0, num_cells, self.chunk_size):
+            stdout.write('{}Building coeffs: {}/{} ({:.2f}%)'.format(back_char, start, num_cells, start * 100. / num_cells))
+            stdout.flush()
+            yield slice(start, min(start + self.chunk_size, num_cells))
         stdout.write('{}{:>100}'.format(back_char, ' '))
-        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, jinterpol, num_cells, outs))
-        stdout.flush()
-        return result, idxs
 
-    def _build_weights(self, distances, indexes, nnear):
+    def _nn_chunk(self, dist, ix, result, idxs):
+        # fills result (if not None) and indexes of a chunk of target cells, returns number of cells out of range
+        in_range = dist <= self.min_upper_bound
+        idxs[in_range] = ix[in_range]
+        if result is not None:
+            result[:] = self._mv_target
+            result[in_range] = self.z[ix[in_range]]
+        return len(dist) - np.count_nonzero(in_range)
+
+    def _weights_chunk(self, dist, ix, result, weights, idxs):
+        # fills result (if not None), weights and indexes of a chunk of target cells, returns number of cells out of range
         z = self.z
-        result = mask_it(np.empty((len(distances),) + np.shape(z[0])), self._mv_target, 1)
-        jinterpol = 0
-        num_cells = result.size
-        back_char, progress_step = progress_step_and_backchar(num_cells)
-
-        stdout.write('Skipping neighbors at distance > {}\n'.format(self.min_upper_bound))
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
-        stdout.flush()
-
-        # weights will be saved in intertable along with indexes
-        weights = empty((len(distances),) + (nnear,))
-        idxs = empty((len(indexes),) + (nnear,), fill_value=z.size, dtype=int)
-        empty_array = empty(z[0].shape, self._mv_target)
-        outs = 0
-        for dist, ix in zip(distances, indexes):
-            if jinterpol % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, jinterpol, num_cells, outs, jinterpol * 100. / num_cells))
-                stdout.flush()
-            if dist[0] <= 1e-10:
-                wz = z[ix[0]]  # take exactly the point, weight = 1
-                idxs[jinterpol] = ix
-                weights[jinterpol] = np.array([1., 0., 0., 0.])
-            elif dist[0] <= self.min_upper_bound:
-                w = ne.evaluate('1 / dist ** 2')
-                sums = ne.evaluate('sum(w)')
-                ne.evaluate('w/sums', out=w)
-                wz = np.dot(w, z[ix])  # weighted values (result)
-                weights[jinterpol] = w
-                idxs[jinterpol] = ix
-            else:
-                outs += 1
-                weights[jinterpol] = np.array([1., 0., 0., 0.])
-                wz = empty_array
-            result[jinterpol] = wz
-            jinterpol += 1
-        stdout.write('{}{:>100}'.format(back_char, ' '))
-        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, jinterpol, num_cells, outs))
-        stdout.flush()
-        return result, weights, idxs
+        exact = dist[:, 0] <= 1e-10
+        in_range = ~exact & (dist[:, 0] <= self.min_upper_bound)
+        out_range = ~(exact | in_range)
+        # weights of exact hits and cells out of range: all on first neighbour
+        single_weight = np.zeros(dist.shape[1])
+        single_weight[0] = 1.
+
+        # take exactly the point, weight = 1
+        idxs[exact] = ix[exact]
+        weights[exact] = single_weight
+
+        # normalised 1/d**power weights (summed in neighbours order)
+        w = 1 / dist[in_range] ** self.power
+        sums = w[:, 0].copy()
+        for j in range(1, dist.shape[1]):
+            sums += w[:, j]
+        w /= sums[:, np.newaxis]
+        idxs[in_range] = ix[in_range]
+        weights[in_range] = w
+        weights[out_range] = single_weight
+
+        if result is not None:
+            result[exact] = z[ix[exact, 0]]
+            result[in_range] = np.einsum('ij,ij->i', w, z[ix[in_range]])
+            result[out_range] = self._mv_target
+        return np.count_nonzero(out_range)
@@ -8,13 +8,18 @@ import numpy as np
 from numpy import ma
 
 from ...util import numeric
-from ... import Loggable, Step
-from ...exceptions import ApplicationException, NOT_IMPLEMENTED
+from ... import Loggable, Step, LazyValues
+from ...exceptions import ApplicationException, NOT_IMPLEMENTED, WRONG_ARGS
 
 # types of manipulation
 AVERAGE = 'average'
 ACCUMULATION = 'accumulation'
 INSTANTANEOUS = 'instantaneous'
+# statistics of GRIB values in each window
+MINIMUM = 'minimum'
+MAXIMUM = 'maximum'
+SUM = 'sum'
+PERCENTILE = 'percentile'
 
 # values of key stepType from grib
 PARAM_INSTANT = 'instant'
@@ -38,6 +43,15 @@ class Aggregator(Loggable):
         self._start = int(kwargs.get('start_step'))
         self._end = int(kwargs.get('end_step'))
         self._second_t_res = kwargs.get('sec_temp_res')
+        self._percentile = kwargs.get('percentile')  # percentile (0-100) for percentile aggregation
+        if self._aggregation == PERCENTILE:
+            try:
+                percentile = float(self._percentile)
+            except (TypeError, ValueError):
+                percentile = None
+            if percentile is None or not 0 <= percentile <= 100:
+                raise ApplicationException.get_exc(WRONG_ARGS, details=f'Aggregation {PERCENTILE} needs a percentile between 0 and 100: {self._percentile}')
+            self._percentile = percentile
 
         if self._input_step != 0:
             self._usable_start = (self._start - self._aggregation_step)
@@ -49,7 +63,16 @@ class Aggregator(Loggable):
         # dict of functions. Substitutes "if then else" pattern in do_manipulation
         self._functs = {ACCUMULATION: self._accumulation,
                         AVERAGE: self._average,
-                        INSTANTANEOUS: self._instantaneous}
+                        INSTANTANEOUS: self._instantaneous,
+                        MINIMUM: self._statistics,
+                        MAXIMUM: self._statistics,
+                        SUM: self._statistics,
+                        PERCENTILE: self._statistics}
+        # reductions of a (T, N) stack of values in a window, for statistics
+        self._reductions = {MINIMUM: lambda stack: np.min(stack, axis=0),
+                            MAXIMUM: lambda stack: np.max(stack, axis=0),
+                            SUM: lambda stack: np.sum(stack, axis=0),
+                            PERCENTILE: lambda stack: np.percentile(stack, self._percentile, axis=0)}
 
     def change_end_step(self,end_first_res):
         self._log('Changing end step to {}'.format(end_first_res))
@@ -59,97 +82,161 @@ class Aggregator(Loggable):
         return self._usable_start, self._end
 
     def do_manipulation(self, values):
+        res = dict(self.iter_manipulation(values))
+        gc.collect()
+        return res
+
+    def iter_manipulation(self, values):
+        """
+        Generator of aggregated (Step, values) pairs, ordered by end step.
+        Each output is computed when requested so that, with LazyValues as input (streaming mode),
+        only messages of the current aggregation window need to be decoded.
+        """
         log_message = f'\nAggregation {self._aggregation} with step {self._aggregation_step} '\
                       f'for {self._step_type} values from {self._start} to {self._end} '\
                       f'[real start: {self._usable_start}]'
         self._log(log_message, 'INFO')
         self._log('******** **** MANIPULATION **** *************')
-        res = self._functs[self._aggregation](values)
-        gc.collect()
-        return res
+        yield from self._functs[self._aggregation](values)
+
+    @staticmethod
+    def _by_end_step(values):
+        # values keyed by end step, ordered
+        if isinstance(values, LazyValues):
+            # nothing is decoded here
+            return values.rekey(lambda k: k.end_step)
+        return collections.OrderedDict(sorted(dict((k.end_step, v_) for (k, v_) in values.items()).items(), key=lambda k: k))
 
     def _accumulation(self, values):
 
-        out_values = {}
         item_keys = list(values.keys())[0]
         resolution = item_keys.resolution
         level = item_keys.level
         shape_iter = values[item_keys].shape
-        v_ord = collections.OrderedDict(sorted(dict((k.end_step, v_) for (k, v_) in values.items()).items(), key=lambda k: k))
+        v_ord = self._by_end_step(values)
         self._log('Accumulation at resolution: {}'.format(resolution))
 
         if self._start == 0:
             self._log('start 0: change to the first timestep {}'.format(self._aggregation_step))
             self._start = self._aggregation_step
 
-        created_zero_array = False
-        for iter_ in range(self._start, self._end + 1, self._aggregation_step):
-            v_ord_keys = list(v_ord.keys())
-            if iter_ not in v_ord_keys:
-
-                ind_next_ts = bisect.bisect_left(v_ord_keys, iter_)
-                next_ts = v_ord_keys[ind_next_ts]
-                v_nts_ma = v_ord[next_ts]
-
-                ind_originalts = bisect.bisect_right(v_ord_keys, iter_)
-                if ind_originalts == ind_next_ts:
-                    ind_originalts -= 1
-                originalts = v_ord_keys[ind_originalts]
-                v_ots_ma = v_ord[originalts]
-
-                if self._logger.isEnabledFor(logging.DEBUG):
-                    self._log(f'Message {iter_} not in {v_ord_keys}.')
-                    self._log(f'Creating grib[{iter_}] as grib[{originalts}]+(grib[{next_ts}]-grib[{originalts}])*(({iter_}-{originalts})/({next_ts}-{originalts}))')
-
-                v_out = ne.evaluate('v_ots_ma + (v_nts_ma-v_ots_ma)*((iter_ - originalts)/(next_ts-originalts))')
-                v_ord[iter_] = ma.masked_where(numeric.get_masks(v_ots_ma, v_nts_ma), v_out, copy=False)
-
-            if iter_ - self._aggregation_step >= 0 and iter_ - self._aggregation_step not in v_ord_keys and not created_zero_array:
-                ind_next_ts = bisect.bisect_left(v_ord_keys, iter_ - self._aggregation_step)
-                next_ts = v_ord_keys[ind_next_ts]
-
-                if iter_ - self._aggregation_step == 0:
-                    self._log('Message 0 not in dataset. Creating it as zero values array')
-                    v_ord[0] = np.zeros(shape_iter)
-                    originalts = 0  # do not delete: used by numexpr evaluation
-                    created_zero_array = True
-                else:
-                    v_nts_ma = v_ord[next_ts]
-                    ind_originalts = bisect.bisect_right(v_ord_keys, iter_ - self._aggregation_step)
-                    if ind_originalts == ind_next_ts:
-                        ind_originalts -= 1
-                    originalts = v_ord_keys[ind_originalts]
-                    # variables needed for numexpr evaluator namespace
-                    v_ots_ma = v_ord[originalts]
-
-                    if self._logger.isEnabledFor(logging.DEBUG):
-                        self._log(f'Creating message grib[{iter_ - self._aggregation_step}]=grib[{originalts}]+(grib[{next_ts}]-grib[{originalts}])*(({iter_}-{originalts})/({next_ts}-{originalts}))')
-                    v_out = ne.evaluate('v_ots_ma + (v_nts_ma-v_ots_ma)*((iter_ - originalts)/(next_ts-originalts))')
-                    v_ord[iter_ - self._aggregation_step] = ma.masked_where(numeric.get_masks(v_ots_ma, v_nts_ma), v_out, copy=False)
-
-            if iter_ - self._aggregation_step == 0 and self._force_zero:
+        bounds, created = self._accumulation_plan(list(v_ord.keys()))
+        if not bounds:
+            return
+        keys = [Step(iter_ - self._aggregation_step, iter_, resolution, self._aggregation_step, level) for iter_ in bounds[1:]]
+        bounds_values = self._bounds_values(v_ord, bounds, created, shape_iter)
+
+        if isinstance(values, LazyValues):
+            # streaming mode: one window at a time, so that only its messages are decoded
+            v_iter_1_ma = next(bounds_values)
+            for key, v_iter_ma in zip(keys, bounds_values):
+                self._log_accumulation(key)
+                yield key, self._accumulate(v_iter_ma, v_iter_1_ma)
+                v_iter_1_ma = v_iter_ma
+        else:
+            # all windows in one operation on the (T, N) stack of values at window bounds
+            bounds_values = list(bounds_values)
+            masks = [numeric.get_masks(v) for v in bounds_values[:-1]]
+            stack = np.stack([ma.getdata(v) for v in bounds_values])
+            out_values = self._accumulate(stack[1:], stack[:-1], masked=False)
+            del stack, bounds_values
+            for key, mask, out_value in zip(keys, masks, out_values):
+                self._log_accumulation(key)
+                yield key, ma.masked_where(mask, out_value, copy=False)
+
+    def _log_accumulation(self, key):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._log(f'out[{key}] = (grib[{key.end_step}] - grib[{key.start_step}])  * ({self._unit_time}/{self._aggregation_step}))')
+
+    def _accumulation_plan(self, steps):
+        """
+        Steps used by accumulation, computed from the steps of source values only (nothing is decoded).
+        Accumulation windows are contiguous, so outputs are differences of values at consecutive window bounds.
+        :param steps: ordered end steps of source values
+        :return: (bounds, created): steps of window bounds, from the start of the first window,
+                 and ordered dict of steps to synthesise: step -> (lower step, upper step, weight) or None for zeros
+        """
+        aggr_step = self._aggregation_step
+        ends = list(range(self._start, self._end + 1, aggr_step))
+        if not ends:
+            return [], {}
+        bounds = [self._start - aggr_step] + ends
+        keys = list(steps)
+        created = collections.OrderedDict()
+
+        def interpolated(step, weight_step):
+            ind_next_ts = bisect.bisect_left(keys, step)
+            next_ts = keys[ind_next_ts]
+            originalts = keys[ind_next_ts - 1]
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._log(f'Message {step} not in {keys}.')
+                self._log(f'Creating grib[{step}] as grib[{originalts}]+(grib[{next_ts}]-grib[{originalts}])*(({weight_step}-{originalts})/({next_ts}-{originalts}))')
+            return originalts, next_ts, (weight_step - originalts) / (next_ts - originalts)
+
+        first_start, first_end = bounds[0], bounds[1]
+        present = set(keys)
+        if first_end not in present:
+            created[first_end] = interpolated(first_end, first_end)
+        if first_start >= 0 and first_start not in present:
+            if first_start == 0:
+                self._log('Message 0 not in dataset. Creating it as zero values array')
+                created[0] = None
+            else:
+                # weight is computed with the end of the window, as in previous versions
+                created[first_start] = interpolated(first_start, first_end)
+        for step in created:
+            bisect.insort(keys, step)
+
+        for iter_ in ends[1:]:
+            if iter_ not in present:
+                created[iter_] = interpolated(iter_, iter_)
+                bisect.insort(keys, iter_)
+        return bounds, created
+
+    def _bounds_values(self, v_ord, bounds, created, shape_iter):
+        """
+        Generator of values at accumulation window bounds.
+        Synthesised steps are computed when needed and kept only until the next bound is reached.
+        """
+        synthesised = {}
+
+        def get(step):
+            if step in synthesised:
+                return synthesised[step]
+            if step not in created:
+                return v_ord[step]
+            if created[step] is None:
+                v_out = np.zeros(shape_iter)
+            else:
+                originalts, next_ts, weight = created[step]
+                # variables needed for numexpr evaluator namespace
+                v_ots_ma, v_nts_ma = get(originalts), get(next_ts)
+                v_out = ne.evaluate('v_ots_ma + (v_nts_ma-v_ots_ma)*weight')
+                v_out = ma.masked_where(numeric.get_masks(v_ots_ma, v_nts_ma), v_out, copy=False)
+            synthesised[step] = v_out
+            return v_out
+
+        for i, bound in enumerate(bounds):
+            if i == 0 and bound == 0 and self._force_zero:
                 # forced ZERO array...instead of taking the grib
-                v_iter_1_ma = np.zeros(shape_iter)
+                yield np.zeros(shape_iter)
             else:
-                # Take the 0 step grib.
-                # It could be created before as zero-array,
-                # if 0 step is not present in the grib dataset (see line 117)
-                v_iter_1_ma = v_ord[iter_ - self._aggregation_step]
-
-            # variables needed for numexpr evaluator namespace. DO NOT DELETE!!!
-            # need to create the out array first as zero array, for issue in missing values for certain gribs
-            v_iter_ma = np.zeros(shape_iter)
-            v_iter_ma += v_ord[iter_]
-            _unit_time = self._unit_time
-            _aggr_step = self._aggregation_step
-            key = Step(iter_ - self._aggregation_step, iter_, resolution, self._aggregation_step, level)
-            out_value = ne.evaluate('(v_iter_ma-v_iter_1_ma)*_unit_time/_aggr_step')
-            out_values[key] = ma.masked_where(numeric.get_masks(v_iter_ma, v_iter_1_ma), out_value, copy=False)
-
-            if self._logger.isEnabledFor(logging.DEBUG):
-                self._log(f'out[{key}] = (grib[{iter_}] - grib[{(iter_ - self._aggregation_step)}])  * ({self._unit_time}/{self._aggregation_step}))')
-
-        return out_values
+                yield get(bound)
+            for step in [step for step in synthesised if step < bound]:
+                del synthesised[step]
+
+    def _accumulate(self, v_iter_ma, v_iter_1_ma, masked=True):
+        # out = (grib[end] - grib[start]) * unit_time / aggr_step, masked as values at start of the window.
+        # Values at end of the window are taken without mask, for issue in missing values for certain gribs
+        v_iter = ma.getdata(v_iter_ma)
+        v_iter_1 = ma.getdata(v_iter_1_ma)
+        # variables needed for numexpr evaluator namespace. DO NOT DELETE!!!
+        _unit_time = self._unit_time
+        _aggr_step = self._aggregation_step
+        out_value = ne.evaluate('(v_iter-v_iter_1)*_unit_time/_aggr_step')
+        if not masked:
+            return out_value
+        return ma.masked_where(numeric.get_masks(v_iter_1_ma), out_value, copy=False)
 
     def _average(self, values):
 
@@ -157,57 +244,142 @@ class Aggregator(Loggable):
             raise ApplicationException.get_exc(NOT_IMPLEMENTED, details=f'Manipulation {self._aggregation} for parameter type: {self._step_type}')
         else:
 
-            out_values = {}
             first_key = list(values.keys())[0]
             resolution_1 = first_key.resolution
             level = first_key.level
-            shape_iter = values[first_key].shape
-
-            v_ord = collections.OrderedDict(sorted(dict((k.end_step, v_) for (k, v_) in values.items()).items(), key=lambda k: k))
-            if self._start > 0 and not self._second_t_res:
-                iter_start = self._start - self._aggregation_step + 1
-            elif self._second_t_res:
-                iter_start = self._start
-            else:
-                iter_start = 0
-
-            for iter_ in range(iter_start, self._end - self._aggregation_step + 2, self._aggregation_step):
 
-                if self._start == 0:
-                    iter_from = iter_ + 1
-                    iter_to = iter_ + self._aggregation_step + 1
-                else:
-                    iter_from = iter_
-                    iter_to = iter_ + self._aggregation_step
-
-                temp_sum = np.zeros(shape_iter)
-                v_ord_keys = list(v_ord.keys())
-
-                for iterator_avg in range(iter_from, iter_to, 1):
-                    if iterator_avg in v_ord_keys:
-                        if self._logger.isEnabledFor(logging.DEBUG):
-                            self._log(f'temp_sum += grib[{iterator_avg}]')
-                        v_ma = v_ord[iterator_avg]
-                    else:
-                        ind_next_ = bisect.bisect_left(list(v_ord_keys), iterator_avg)
-                        next_ = list(v_ord_keys)[ind_next_]
-                        if self._logger.isEnabledFor(logging.DEBUG):
-                            self._log(f'temp_sum += grib[{iterator_avg}] from -> grib[{next_}]')
-                        v_ma = v_ord[next_]
-                    ne.evaluate('temp_sum + v_ma', out=temp_sum)
-
-                # mask result with all maskes from GRIB original values used in average (if existing any)
-                # temp_sum = ma.masked_where(pyg2p.util.numeric.get_masks(v_ord.values()), temp_sum, copy=False)
+            v_ord = self._by_end_step(values)
+            windows = self._window_plan(list(v_ord.keys()))
+            if not windows:
+                return
+            # used with numexpress that doesn't access self. DO NOT DELETE!
+            aggregation_step = self._aggregation_step
+            # windows are contiguous: each one is the difference of cumulative sums at its bounds
+            first_hour = self._window_hours(windows[0][0])[0]
+            bounds = [first_hour - 1 + i * self._aggregation_step for i in range(len(windows) + 1)]
+            sums = self._cumulative_sums(v_ord, bounds, isinstance(values, LazyValues))
+            lower_sum = next(sums)
+            for (iter_, steps_hours), upper_sum in zip(windows, sums):
                 key = Step(iter_, iter_ + self._aggregation_step, resolution_1, self._aggregation_step, level)
-                # used with numexpress that doesn't access self. DO NOT DELETE!
-                aggregation_step = self._aggregation_step
-                res = ne.evaluate('temp_sum/aggregation_step')
-                # mask result with all maskes from GRIB original values used in average (if existing any)
-                out_values[key] = ma.masked_where(numeric.get_masks(v_ord.values()), res, copy=False)
+                res = ne.evaluate('(upper_sum - lower_sum)/aggregation_step')
                 if self._logger.isEnabledFor(logging.DEBUG):
-                    self._log(f'out[{key}] = temp_sum/{self._aggregation_step}')
+                    self._log(f'out[{key}] = ({" + ".join(f"{hours}*grib[{step}]" for step, hours in steps_hours)})/{self._aggregation_step}')
+                # as in previous versions, result is not masked with masks of GRIB values
+                yield key, ma.masked_array(res, copy=False)
+                lower_sum = upper_sum
+
+    @staticmethod
+    def _cumulative_sums(v_ord, bounds, streaming=False):
+        """
+        Generator of sums of hourly values from bounds[0] (excluded) to each bound, in order.
+        As in _window_plan, each hour takes values of its step or of the next available step,
+        so values of a step count once for each hour from the previous step (excluded).
+        Sums are a np.cumsum over the (T, N) stack of weighted values of all steps used,
+        plus the hours of the step after the bound when a bound falls between two steps.
+        In streaming mode, sums are accumulated one step at a time, with the same operations,
+        so that only messages of the current window need to be decoded.
+        """
+        steps = list(v_ord.keys())
+        rows = steps[bisect.bisect_right(steps, bounds[0]):bisect.bisect_left(steps, bounds[-1]) + 1]
+        weights = np.diff([bounds[0]] + rows)
+
+        def weighted(row, hours, out=None):
+            return np.multiply(ma.getdata(v_ord[rows[row]]), hours, out=out, dtype=np.float64)
+
+        yield 0
+        if streaming:
+            cum_sum = None
+            added = 0
+        else:
+            cum = np.empty((len(rows),) + ma.getdata(v_ord[rows[0]]).shape)
+            for row, hours in enumerate(weights):
+                weighted(row, hours, out=cum[row])
+            np.cumsum(cum, axis=0, out=cum)
+        for bound in bounds[1:]:
+            row = bisect.bisect_left(rows, bound)
+            full_rows = row + 1 if rows[row] == bound else row
+            if streaming:
+                for i in range(added, full_rows):
+                    values = weighted(i, weights[i])
+                    cum_sum = values if cum_sum is None else np.add(cum_sum, values, out=cum_sum)
+                added = full_rows
+                previous = cum_sum if full_rows else None
+            else:
+                previous = cum[full_rows - 1] if full_rows else None
+            if full_rows > row:
+                yield previous.copy() if streaming else previous
+            else:
+                partial = weighted(row, bound - (rows[row - 1] if row else bounds[0]))
+                yield partial if previous is None else np.add(previous, partial, out=partial)
+
+    def _window_hours(self, iter_):
+        # first hour and end hour (excluded) of the window starting at iter_
+        if self._start == 0:
+            return iter_ + 1, iter_ + self._aggregation_step + 1
+        return iter_, iter_ + self._aggregation_step
+
+    def _window_plan(self, steps):
+        """
+        Windows of average and statistics, computed from the steps of source values only (nothing is decoded).
+        Each hour of a window takes values of its step or, if missing, of the next available step,
+        so a window is a list of (step, number of hours).
+        :param steps: ordered end steps of source values
+        :return: list of (window start, [(step, hours), ...])
+        """
+        if self._start > 0 and not self._second_t_res:
+            iter_start = self._start - self._aggregation_step + 1
+        elif self._second_t_res:
+            iter_start = self._start
+        else:
+            iter_start = 0
+
+        windows = []
+        for iter_ in range(iter_start, self._end - self._aggregation_step + 2, self._aggregation_step):
+            iter_from, iter_to = self._window_hours(iter_)
+            steps_hours = []
+            hour = iter_from
+            while hour < iter_to:
+                step = steps[bisect.bisect_left(steps, hour)]
+                last_hour = min(step, iter_to - 1)
+                steps_hours.append((step, last_hour - hour + 1))
+                hour = last_hour + 1
+            windows.append((iter_, steps_hours))
+        return windows
+
+    def _statistics(self, values):
+        # minimum, maximum, sum or percentile of GRIB values of each window (each message counts once)
+        if self._step_type in [PARAM_CUM]:
+            raise ApplicationException.get_exc(NOT_IMPLEMENTED, details=f'Manipulation {self._aggregation} for parameter type: {self._step_type}')
 
-            return out_values
+        first_key = list(values.keys())[0]
+        resolution_1 = first_key.resolution
+        level = first_key.level
+        v_ord = self._by_end_step(values)
+        steps = list(v_ord.keys())
+        windows = self._window_plan(steps)
+        if not windows:
+            return
+        reduce = self._reductions[self._aggregation]
+        rows = {step: i for i, step in enumerate(steps)}
+        streaming = isinstance(values, LazyValues)
+        if not streaming:
+            # steps of a window are contiguous: windows are slices (views) of the stack of all steps used
+            first_row, last_row = rows[windows[0][1][0][0]], rows[windows[-1][1][-1][0]]
+            stack = np.stack([ma.getdata(v_ord[step]) for step in steps[first_row:last_row + 1]])
+
+        for iter_, steps_hours in windows:
+            window_steps = [step for step, _ in steps_hours]
+            window_values = [v_ord[step] for step in window_steps]
+            if streaming:
+                # only messages of the window are decoded and stacked
+                window_stack = np.stack([ma.getdata(v) for v in window_values])
+            else:
+                window_stack = stack[rows[window_steps[0]] - first_row:rows[window_steps[-1]] - first_row + 1]
+            key = Step(iter_, iter_ + self._aggregation_step, resolution_1, self._aggregation_step, level)
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._log(f'out[{key}] = {self._aggregation}({", ".join(f"grib[{step}]" for step in window_steps)})')
+            # mask result with masks of GRIB values of the window (if existing any)
+            yield key, ma.masked_where(numeric.get_masks(*window_values), reduce(window_stack), copy=False)
 
     def _find_start(self):
         start = self._start - self._aggregation_step if self._start - self._aggregation_step > 0 else self._start
@@ -219,35 +391,34 @@ class Aggregator(Loggable):
         if self._step_type in [PARAM_CUM]:
             raise ApplicationException.get_exc(NOT_IMPLEMENTED, details=f'Manipulation {self._aggregation} for parameter type: {self._step_type}')
         else:
-            out_values = {}
             start = self._find_start()
 
             # sets a new dict with different key (using only endstep)
-            v_ord = collections.OrderedDict(sorted(dict((k.end_step, v_) for (k, v_) in values.items()).items(), key=lambda k: k))
+            v_ord = self._by_end_step(values)
             v_ord_keys = list(v_ord.keys())
+            v_ord_steps = set(v_ord_keys)
             values_keys = list(values.keys())
             resolution_1 = values_keys[0].resolution
             level = values_keys[0].level
             shape_iter = values[values_keys[0]].shape
+            zeros = None
             for iter_ in range(start, self._end + 1, self._aggregation_step):
-                res_inst = np.zeros(shape_iter)
                 key = Step(iter_, iter_, resolution_1, self._aggregation_step, level)
-                if iter_ in v_ord_keys:
+                # outputs are the GRIB values themselves (with their mask), not copies
+                if iter_ in v_ord_steps:
                     if self._logger.isEnabledFor(logging.DEBUG):
                         self._log(f'out[{key}] = grib[{iter_}]')
-                    res_inst += v_ord[iter_]
+                    res_inst = v_ord[iter_]
+                elif iter_ == 0:
+                    # left out as zero arrays if 0 step is not in the grib
+                    if self._logger.isEnabledFor(logging.DEBUG):
+                        self._log(f'out[{key}] = zeros')
+                    if zeros is None:
+                        zeros = np.zeros(shape_iter)
+                    res_inst = zeros
                 else:
-                    if iter_ == 0:
-                        # left out as zero arrays if 0 step is not in the grib
-                        if self._logger.isEnabledFor(logging.DEBUG):
-                            self._log(f'out[{key}] = zeros')
-                        pass
-                    else:
-                        ind_next_ = bisect.bisect_right(v_ord_keys, iter_)
-                        next_ = list(v_ord_keys)[ind_next_]
-                        if self._logger.isEnabledFor(logging.DEBUG):
-                            self._log(f'out[{key}] = grib[{next_}]')
-                        res_inst += v_ord[next_]
-                out_values[key] = res_inst
-
-            return out_values
+                    next_ = v_ord_keys[bisect.bisect_right(v_ord_keys, iter_)]
+                    if self._logger.isEnabledFor(logging.DEBUG):
+                        self._log(f'out[{key}] = grib[{next_}]')
+                    res_inst = v_ord[next_]
+                yield key, res_inst
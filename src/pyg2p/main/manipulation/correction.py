@@ -14,8 +14,8 @@ import pyg2p.util.numeric
 
 
 class Corrector(Loggable):
-
-    instances = {}
+    # correctors are kept in the same cache of intertables
+    cache = Interpolator.cache
 
     def __repr__(self):
         return f'Corrector<{self.grid_id} {self.geo_file}>'
@@ -24,13 +24,12 @@ class Corrector(Loggable):
     def get_instance(cls, ctx, grid_id):
         geo_file_ = ctx.geo_file(grid_id)
         dem_map = ctx.get('correction.demMap')
-        key = f'{grid_id}{dem_map}'
-        if key in cls.instances:
-            return cls.instances[key]
-        else:
+        key = ('corrector', f'{grid_id}{dem_map}')
+        instance = cls.cache.get(key)
+        if instance is None:
             instance = Corrector(ctx, grid_id, geo_file_)
-            cls.instances[key] = instance
-            return instance
+            cls.cache.put(key, instance)
+        return instance
 
     def __init__(self, ctx, grid_id, geo_file):
         super().__init__()
@@ -53,6 +52,10 @@ class Corrector(Loggable):
 
         self._gem_missing_value, self._gem_values = self._read_geo(geo_file, ctx)
 
+    @property
+    def nbytes(self):
+        return self._dem_values.nbytes + self._gem_values.nbytes
+
     def correct(self, values):
         with np.errstate(over='ignore'):
             # variables below are used by numexpr evaluation namespace
@@ -1,19 +1,28 @@
 import os
 import logging
+from functools import partial
+from itertools import product
 
 from eccodes import (codes_is_defined,
                      codes_index_new_from_file, codes_new_from_index, codes_new_from_file, codes_index_select,
-                     codes_index_release, codes_release,
-                     codes_get, codes_get_double_array, codes_get_double,
+                     codes_index_release, codes_release, codes_index_get,
+                     codes_get, codes_get_double_array,
                      GribInternalError, codes_get_array, CODES_PRODUCT_GRIB)
+import numpy as np
 from numpy import ma
 
 from ...util import generics as utils
 from ...exceptions import ApplicationException, NO_MESSAGES
-from ... import Loggable, Step, GRIBInfo, GribGridDetails, Messages
+from ... import Loggable, Step, GRIBInfo, GribGridDetails, Messages, LazyValues
+from .index import GRIBIndex
 
 
 class GRIBReader(Loggable):
+    # keys whose conditions are pushed down to ecCodes indexes, when the persistent index can't be used.
+    # Conditions on startStep and endStep are pushed down as one condition on stepRange,
+    # so that only existing pairs of steps are selected
+    pushdown_keys = ('level', 'dataDate', 'dataTime', 'startStep', 'endStep')
+    step_keys = ('startStep', 'endStep')
 
     def __repr__(self):
         return f'GRIBReader<{self._grib_file}>'
@@ -21,24 +30,42 @@ class GRIBReader(Loggable):
     def __str__(self):
         return self.__repr__()
 
-    def __init__(self, grib_file, w_perturb=False):
+    def __init__(self, grib_file, w_perturb=False, max_memory=None):
         # codes_no_fail_on_wrong_length(True)
         super().__init__()
         self._grib_file = os.path.abspath(grib_file)
+        # streaming mode: values are decoded when used, keeping at most max_memory bytes of decoded arrays
+        self._max_memory = max_memory
         self._file_handler = None
         self._grbindx = None
+        self._index_keys = None
+        # ecCodes indexes with keys of pushed down conditions, created when first needed
+        self._pushdown_indexes = {}
+        self._index = None
         self._logger = logging.getLogger()
         self._log(f'Opening GRIBReader for {self._grib_file}')
 
         try:
-            index_keys = ['shortName']
-            if w_perturb:
-                index_keys.append('perturbationNumber')
-            self._grbindx = codes_index_new_from_file(str(self._grib_file), index_keys)
-        except GribInternalError:
-            self._log(f"Can't use index on {self._grib_file}", 'WARN')
-            self._file_handler = open(self._grib_file, 'rb')
+            # persistent index with byte offsets of messages, reused by following executions
+            self._index = GRIBIndex(self._grib_file)
+        except (GribInternalError, OSError, ValueError) as e:
+            # e.g. unreadable GRIB, index not writable or corrupt index file: ecCodes index is used instead
+            self._log(f"Can't use persistent index on {self._grib_file}: {e}", 'WARN')
+            try:
+                index_keys = ['shortName']
+                if w_perturb:
+                    index_keys.append('perturbationNumber')
+                self._index_keys = index_keys
+                self._grbindx = codes_index_new_from_file(str(self._grib_file), index_keys)
+            except GribInternalError:
+                self._log(f"Can't use index on {self._grib_file}", 'WARN')
+                self._file_handler = open(self._grib_file, 'rb')
         self._selected_grbs = []
+        # handles kept in memory by scan_messages (single pass mode)
+        self._scanned_grbs = None
+        # positions in persistent index of scanned messages, and handles created for them on selection
+        self._scanned_positions = None
+        self._handles = {}
         self._mv = -1
         self._step_grib = -1
         self._step_grib2 = -1
@@ -49,31 +76,36 @@ class GRIBReader(Loggable):
     @classmethod
     def get_id(cls, grib_file, reader_args):
         reader = GRIBReader(grib_file)
-        gribs_for_id = reader._get_gids(**reader_args)
+        # grid keys are all in header sections
+        gribs_for_id = reader._get_gids(headers_only=True, **reader_args)
         grid = GribGridDetails(gribs_for_id[0])
+        for g in gribs_for_id:
+            codes_release(g)
         reader.close()
         return grid.grid_id
 
     @staticmethod
     def _find(gid, **kwargs):
         for k, v in kwargs.items():
-            if not codes_is_defined(gid, k):
-                return False
-            iscontainer = utils.is_container(v)
-            iscallable = utils.is_callable(v)
-            if (not iscontainer and not iscallable and codes_get(gid, k) == v) or\
-                    (iscontainer and codes_get(gid, k) in v) or \
-                    (iscallable and v(codes_get(gid, k))):
-                continue
-            else:
+            if not codes_is_defined(gid, k) or not utils.matches(codes_get(gid, k), v):
                 return False
         return True
 
     def close(self):
         self._log(f'Closing gribs messages from {self._grib_file}')
-        for g in self._selected_grbs:
-            codes_release(g)
+        # selected messages are a subset of scanned ones, when single pass mode is used
+        self._release_scanned()
+        if self._selected_grbs:
+            for g in self._selected_grbs:
+                codes_release(g)
         self._selected_grbs = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        for index in self._pushdown_indexes.values():
+            if index is not None:
+                codes_index_release(index)
+        self._pushdown_indexes = {}
         if self._grbindx:
             codes_index_release(self._grbindx)
             self._grbindx = None
@@ -85,48 +117,122 @@ class GRIBReader(Loggable):
         has_geo = False
         from pyg2p.main.config import GeopotentialsConfiguration
         v_selected = GeopotentialsConfiguration.short_names
-        if self._grbindx:
-            for v in v_selected:
-                codes_index_select(self._grbindx, 'shortName', str(v))
-                while 1:
-                    gid = codes_new_from_index(self._grbindx)
-                    if gid is None:
-                        break
+        if self._index is not None:
+            has_geo = len(self._index.select(shortName=v_selected)) > 0
+        elif self._grbindx:
+            for _ in self._index_selections(self._grbindx, self._index_keys, {'shortName': v_selected}):
+                gid = codes_new_from_index(self._grbindx)
+                if gid is not None:
                     has_geo = True
                     codes_release(gid)
+                    break
 
         elif self._file_handler:
-            while 1:
-                gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB)
+            self._file_handler.seek(0)
+            while not has_geo:
+                gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB, headers_only=True)
                 if gid is None:
                     break
-                has_geo = True
+                has_geo = GRIBReader._find(gid, shortName=v_selected)
                 codes_release(gid)
         return has_geo
 
-    def scan_grib(self, **kwargs):
-        gribs = []
+    def _pushdown_index(self, kwargs):
+        """
+        ecCodes index to select messages matching kwargs, with index keys (a list).
+        Only keys with a condition in kwargs are added to the keys of the main ecCodes index,
+        as each key multiplies the number of selections by the number of its accepted values.
+        """
+        keys = tuple(key for key in self.pushdown_keys if key in kwargs and key not in self.step_keys)
+        if any(key in kwargs for key in self.step_keys):
+            keys += ('stepRange',)
+        if not keys:
+            return self._grbindx, self._index_keys
+        if keys not in self._pushdown_indexes:
+            try:
+                self._pushdown_indexes[keys] = codes_index_new_from_file(str(self._grib_file), self._index_keys + list(keys))
+            except GribInternalError:
+                self._log(f"Can't use index on {self._grib_file} with keys {keys}", 'WARN')
+                self._pushdown_indexes[keys] = None
+        if self._pushdown_indexes[keys] is None:
+            return self._grbindx, self._index_keys
+        return self._pushdown_indexes[keys], self._index_keys + list(keys)
+
+    @staticmethod
+    def _matches_step_range(step_range, kwargs):
+        # stepRange is 'end' or 'start-end'. Values that can't be parsed are accepted and checked on handles
+        start, _, end = step_range.partition('-')
+        try:
+            start, end = int(start), int(end or start)
+        except ValueError:
+            return True
+        return all(utils.matches(step, kwargs[key]) for key, step in zip(GRIBReader.step_keys, (start, end)) if key in kwargs)
+
+    def _index_selections(self, index, index_keys, kwargs):
+        """
+        Generator selecting on ecCodes index all combinations of key values satisfying conditions in kwargs.
+        Each iteration leaves the index ready for codes_new_from_index.
+        """
+        accepted = []
+        for key in index_keys:
+            values = codes_index_get(index, key, ktype=str)
+            if key == 'shortName':
+                # keep order of requested shortNames
+                condition = kwargs[key]
+                variants = condition if utils.is_container(condition) else [condition]
+                values = [str(v) for v in variants if str(v) in values]
+            elif key == 'stepRange':
+                values = [v for v in values if self._matches_step_range(v, kwargs)]
+            elif key in kwargs:
+                values = [v for v in values if v != 'undef' and utils.matches(int(v), kwargs[key])]
+            accepted.append(values)
+        for combination in product(*accepted):
+            for key, value in zip(index_keys, combination):
+                codes_index_select(index, key, value)
+            yield combination
+
+    def _scan_positions(self, kwargs):
+        # positions of messages in persistent index, ordered as requested shortNames
         v_selected = kwargs['shortName']
-        v_pert = kwargs.get('perturbationNumber', -1)
         if not utils.is_container(v_selected):
             v_selected = [v_selected]
-        if self._grbindx:
-            for v in v_selected:
-                codes_index_select(self._grbindx, 'shortName', str(v))
-                if v_pert != -1:
-                    codes_index_select(self._grbindx, 'perturbationNumber', int(v_pert))
+        return np.concatenate([self._index.select(**dict(kwargs, shortName=str(v))) for v in v_selected]).astype(int)
+
+    def scan_grib(self, headers_only=False, **kwargs):
+        """
+        Returns handles of messages matching kwargs.
+        With headers_only=True, handles don't hold data sections (values can't be read), which is enough for metadata.
+        """
+        gribs = []
+        # conditions not already evaluated by indexes, to check on handles
+        residual = kwargs
+        if self._index is not None:
+            residual = GRIBIndex.not_indexed(kwargs)
+            for position in self._scan_positions(kwargs):
+                gid = self._index.new_handle(position, headers_only)
+                if GRIBReader._find(gid, **residual):
+                    gribs.append(gid)
+                else:
+                    # release unused grib
+                    codes_release(gid)
+        elif self._grbindx:
+            index, index_keys = self._pushdown_index(kwargs)
+            # conditions on steps are also checked on handles (stepRange may have units)
+            residual = {k: v for k, v in kwargs.items() if k not in index_keys}
+            for _ in self._index_selections(index, index_keys, kwargs):
                 while 1:
-                    gid = codes_new_from_index(self._grbindx)
+                    gid = codes_new_from_index(index)
                     if gid is None:
                         break
-                    if GRIBReader._find(gid, **kwargs):
+                    if GRIBReader._find(gid, **residual):
                         gribs.append(gid)
                     else:
                         # release unused grib
                         codes_release(gid)
         elif self._file_handler:
+            self._file_handler.seek(0)
             while 1:
-                gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB)
+                gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB, headers_only=headers_only)
                 if gid is None:
                     break
                 if GRIBReader._find(gid, **kwargs):
@@ -136,13 +242,87 @@ class GRIBReader(Loggable):
                     codes_release(gid)
         return gribs
 
-    def _get_gids(self, **kwargs):
+    def scan_messages(self, **kwargs):
+        """
+        Single pass mode: reads the file once and keeps handles of all messages matching kwargs.
+        Following calls to get_grib_info and select_messages filter these handles in memory
+        instead of reading the file again. Handles are released on close().
+        When the persistent index can evaluate all conditions, only positions of messages are kept:
+        get_grib_info is computed from the index and handles are created only for selected messages.
+        """
+        self._release_scanned()
+        if self._index is not None and not GRIBIndex.not_indexed(kwargs):
+            self._scanned_positions = self._scan_positions(kwargs)
+            self._log(f'Scanned {len(self._scanned_positions)} grib messages')
+        else:
+            self._scanned_grbs = self.scan_grib(**kwargs)
+            self._log(f'Scanned {len(self._scanned_grbs)} grib messages')
+
+    def _release_scanned(self):
+        for g in self._scanned_grbs or ():
+            codes_release(g)
+        for g in self._handles.values():
+            codes_release(g)
+        if self._scanned_grbs is not None or self._scanned_positions is not None:
+            # selected handles are among released ones
+            self._selected_grbs = []
+        self._scanned_grbs = None
+        self._scanned_positions = None
+        self._handles = {}
+
+    def release_selected(self):
+        """
+        Releases handles of the last selected messages (e.g. after an ensemble member is written),
+        so that handles of following selections don't pile up until close().
+        """
+        selected = set(self._selected_grbs or ())
+        if self._scanned_grbs is not None:
+            # selected handles are among scanned ones
+            self._scanned_grbs = [g for g in self._scanned_grbs if g not in selected]
+        elif self._scanned_positions is not None:
+            self._handles = {p: g for p, g in self._handles.items() if g not in selected}
+        for g in selected:
+            codes_release(g)
+        self._selected_grbs = []
+        self._gid_main_res = None
+        self._gid_ext_res = None
+
+    def _select_positions(self, **kwargs):
+        # positions of messages matching conditions on indexed keys (among scanned ones, in single pass mode)
+        if self._scanned_positions is None:
+            return self._scan_positions(kwargs)
+        return self._scanned_positions[np.isin(self._scanned_positions, self._index.select(**kwargs))]
+
+    def _scanned_handle(self, position):
+        if position not in self._handles:
+            self._handles[position] = self._index.new_handle(position)
+        return self._handles[position]
+
+    def _filter_scanned(self, **kwargs):
+        if self._scanned_grbs is not None:
+            return [g for g in self._scanned_grbs if GRIBReader._find(g, **kwargs)]
+        # conditions on indexed keys are evaluated on index table; only the others on handles
+        residual = GRIBIndex.not_indexed(kwargs)
+        gribs = [self._scanned_handle(p) for p in self._select_positions(**kwargs)]
+        return [g for g in gribs if GRIBReader._find(g, **residual)]
+
+    @staticmethod
+    def _steps_fallback(scan, kwargs):
+        gribs = scan(**kwargs)
+        if (len(gribs) == 0) and ('startStep' in kwargs and utils.is_callable(kwargs['startStep']) and not kwargs['startStep'](0)):
+            # caller's selection is not changed
+            kwargs = dict(kwargs, startStep=utils.Range(min_=0))
+            gribs = scan(**kwargs)
+        return gribs
+
+    def _get_gids(self, headers_only=False, **kwargs):
+        if self._scanned_grbs is None and self._scanned_positions is None:
+            def scan(**kw):
+                return self.scan_grib(headers_only=headers_only, **kw)
+        else:
+            scan = self._filter_scanned
         try:
-            gribs = self.scan_grib(**kwargs)
-            if (len(gribs) == 0) and ('startStep' in kwargs and utils.is_callable(kwargs['startStep']) and not kwargs['startStep'](0)):
-                kwargs['startStep'] = lambda s: s >= 0
-                gribs = self.scan_grib(**kwargs)
-            return gribs
+            return self._steps_fallback(scan, kwargs)
         except ValueError:
             raise ApplicationException.get_exc(NO_MESSAGES, details=f'using {kwargs}')
 
@@ -184,17 +364,7 @@ class GRIBReader(Loggable):
                     # found second resolution messages
                     grid2 = GribGridDetails(g)
                     self._gid_ext_res = g
-                values = codes_get_double_array(g, 'values')
-
-                # Handling missing grib values.
-                # If bitmap is present, array will be a masked_array
-                # and array.mask will be used later
-                # in interpolation and manipulation
-                bitmap_present = codes_get(g, 'bitmapPresent')
-                if bitmap_present:
-                    # Get the bitmap array which contains 0s and 1s
-                    bitmap = codes_get_array(g, 'bitmap', int)
-                    values = ma.masked_where(bitmap == 0, values, copy=False)
+                values = partial(self._read_values, g) if self._max_memory else self._read_values(g)
 
                 if not grid2:
                     all_values[step_key] = values
@@ -204,18 +374,35 @@ class GRIBReader(Loggable):
             if grid2:
                 key_2nd_spatial_res = min(all_values_second_res.keys())
                 grid.set_2nd_resolution(grid2, key_2nd_spatial_res)
+            if self._max_memory:
+                cache = utils.SizedLRUCache(self._max_memory)
+                all_values = LazyValues(all_values, cache)
+                all_values_second_res = LazyValues(all_values_second_res, cache)
             return Messages(all_values, missing_value, unit, type_of_level, type_of_step, grid, all_values_second_res, data_date=data_date)
         # no messages found
         else:
             raise ApplicationException.get_exc(NO_MESSAGES, details=f'using {kwargs}')
 
     @staticmethod
-    def _find_start_end_steps(gribs):
+    def _read_values(gid):
+        values = codes_get_double_array(gid, 'values')
+
+        # Handling missing grib values.
+        # If bitmap is present, array will be a masked_array
+        # and array.mask will be used later
+        # in interpolation and manipulation
+        bitmap_present = codes_get(gid, 'bitmapPresent')
+        if bitmap_present:
+            # Get the bitmap array which contains 0s and 1s
+            bitmap = codes_get_array(gid, 'bitmap', int)
+            values = ma.masked_where(bitmap == 0, values, copy=False)
+        return values
+
+    @staticmethod
+    def _find_start_end_steps(start_steps, end_steps):
         # return input_steps,
         # change step if a second time resolution is found
 
-        start_steps = [codes_get(gribs[i], 'startStep') for i in range(len(gribs))]
-        end_steps = [codes_get(gribs[i], 'endStep') for i in range(len(gribs))]
         start_grib = min(start_steps)
         end_grib = max(end_steps)
         ord_end_steps = sorted(end_steps)
@@ -236,19 +423,44 @@ class GRIBReader(Loggable):
                     change_step_at = f'{ord_start_steps[i]}-{ord_end_steps[i]}'
         return start_grib, end_grib, step, step2, change_step_at
 
+    def _header_values(self, select_args, keys=('startStep', 'endStep', 'stepType', 'missingValue')):
+        """
+        Values of keys (by default, the ones needed by get_grib_info) for messages matching select_args.
+        Read from persistent index when possible, otherwise from headers only handles.
+        Values of keys not defined in a message are None.
+        """
+        if self._index is not None and self._scanned_grbs is None and not GRIBIndex.not_indexed(select_args):
+            try:
+                positions = self._steps_fallback(self._select_positions, select_args)
+            except ValueError:
+                raise ApplicationException.get_exc(NO_MESSAGES, details=f'using {select_args}')
+            return {k: self._index.get(positions, k) for k in keys}
+        # handles from a single pass scan are reused later by select_messages
+        headers_only = self._scanned_grbs is None
+        gribs = self._get_gids(headers_only=headers_only, **select_args)
+        values = {k: [codes_get(g, k) if codes_is_defined(g, k) else None for g in gribs] for k in keys}
+        if headers_only:
+            for g in gribs:
+                codes_release(g)
+        return values
+
+    def members(self, select_args):
+        """
+        Ensemble members (values of perturbationNumber) of messages matching select_args, ordered.
+        Read from persistent index when possible, without creating handles.
+        """
+        numbers = self._header_values(select_args, keys=('perturbationNumber',))['perturbationNumber']
+        return sorted({int(n) for n in numbers if n is not None})
+
     def get_grib_info(self, select_args):
-        _gribs_for_utils = self._get_gids(**select_args)
-        if len(_gribs_for_utils) > 0:
+        header_values = self._header_values(select_args)
+        if len(header_values['stepType']) > 0:
             # instant, avg, cumul. get last stepType available because first one is sometimes misleading
-            type_of_step = codes_get(_gribs_for_utils[-1], 'stepType')
-            self._mv = codes_get_double(_gribs_for_utils[0], 'missingValue')
-            start_grib, end_grib, self._step_grib, self._step_grib2, self._change_step_at = self._find_start_end_steps(_gribs_for_utils)
+            type_of_step = header_values['stepType'][-1]
+            self._mv = float(header_values['missingValue'][0])
+            start_grib, end_grib, self._step_grib, self._step_grib2, self._change_step_at = self._find_start_end_steps(header_values['startStep'], header_values['endStep'])
             self._log("Grib input step %d [type of step: %s]" % (self._step_grib, type_of_step))
             self._log('Gribs from %d to %d' % (start_grib, end_grib))
-            for g in _gribs_for_utils:
-                codes_release(g)
-            _gribs_for_utils = None
-            del _gribs_for_utils
             info = GRIBInfo(input_step=self._step_grib, input_step2=self._step_grib2,
                             change_step_at=self._change_step_at, type_of_param=type_of_step,
                             start=start_grib, end=end_grib, mv=self._mv)
@@ -0,0 +1,163 @@
+import json
+import os
+from hashlib import md5
+
+import numpy as np
+from eccodes import (codes_new_from_file, codes_new_from_message, codes_release, codes_is_defined, codes_get,
+                     codes_get_message_offset, codes_get_message_size, CODES_PRODUCT_GRIB)
+
+from ... import Loggable
+from ...util import files
+from ...util import generics as utils
+
+
+class GRIBIndex(Loggable):
+    """
+    Persistent index of messages in a GRIB file.
+    For each message it stores main header keys, byte offset and length, so that
+    following executions on the same file can seek directly to selected messages.
+    The index is written next to the GRIB file (or into user cache folder if that is not writable)
+    and it's rebuilt when size or modification time of the GRIB file change.
+    Selections are evaluated as vectorised filters over the columns of the index (one array per key).
+    Messages are indexed reading headers only, without decoding data sections.
+    """
+    keys = ('shortName', 'perturbationNumber', 'level', 'dataDate', 'dataTime', 'startStep', 'endStep', 'stepType',
+            'missingValue')
+    suffix = '.pyg2p.idx'
+    cache_dir = os.path.join(os.path.expanduser('~'), '.pyg2p', 'indexes')
+    version = 2
+
+    def __init__(self, grib_file):
+        super().__init__()
+        self.grib_file = grib_file
+        stat = os.stat(grib_file)
+        self._signature = {'version': self.version, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        self._file_handler = None
+        self.messages = self._load()
+        if self.messages is None:
+            self.messages = self._build()
+            self._dump()
+        self._columns = {k: self._column(k) for k in self.keys}
+
+    @property
+    def index_files(self):
+        # candidates: next to the GRIB file, then user cache folder
+        cached_name = f'{md5(self.grib_file.encode("utf-8")).hexdigest()}_{files.filename(self.grib_file)}{self.suffix}'
+        return self.grib_file + self.suffix, os.path.join(self.cache_dir, cached_name)
+
+    def _load(self):
+        for index_file in self.index_files:
+            if not files.exists(index_file):
+                continue
+            try:
+                with open(index_file) as f:
+                    content = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if not isinstance(content, dict) or content.get('signature') != self._signature or tuple(content.get('keys', ())) != self.keys:
+                continue
+            columns = self.keys + ('offset', 'length')
+            messages = content.get('messages')
+            if not isinstance(messages, list) or any(not isinstance(m, list) or len(m) != len(columns) for m in messages):
+                self._log(f'Corrupt GRIB index {index_file}', 'WARN')
+                continue
+            self._log(f'Using GRIB index {index_file}')
+            return [dict(zip(columns, m)) for m in messages]
+        return None
+
+    def _build(self):
+        self._log(f'Indexing {self.grib_file}')
+        messages = []
+        with open(self.grib_file, 'rb') as f:
+            while 1:
+                gid = codes_new_from_file(f, product_kind=CODES_PRODUCT_GRIB, headers_only=True)
+                if gid is None:
+                    break
+                message = {k: codes_get(gid, k) if codes_is_defined(gid, k) else None for k in self.keys}
+                message['offset'] = codes_get_message_offset(gid)
+                message['length'] = codes_get_message_size(gid)
+                messages.append(message)
+                codes_release(gid)
+        return messages
+
+    def _dump(self):
+        content = {'signature': self._signature, 'keys': self.keys,
+                   'messages': [[m[k] for k in self.keys + ('offset', 'length')] for m in self.messages]}
+        for index_file in self.index_files:
+            folder = os.path.dirname(index_file)
+            if not files.exists(folder, is_folder=True):
+                try:
+                    files.create_dir(folder)
+                except OSError:
+                    continue
+            if not files.can_write(folder):
+                continue
+            # write to a temporary file and rename, so that concurrent readers never see a partial index
+            tmp_file = f'{index_file}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(content, f)
+                os.replace(tmp_file, index_file)
+            except OSError:
+                files.delete_file(tmp_file)
+                continue
+            self._log(f'GRIB index written to {index_file}')
+            return
+        self._log(f'Could not write GRIB index for {self.grib_file}', 'WARN')
+
+    def _column(self, key):
+        # values of key for all messages, and mask of messages where key is defined
+        values = [m[key] for m in self.messages]
+        defined = np.array([v is not None for v in values], dtype=bool)
+        fill = '' if any(isinstance(v, str) for v in values) else 0
+        return np.array([fill if v is None else v for v in values]), defined
+
+    @staticmethod
+    def _evaluate(values, condition):
+        if utils.is_container(condition):
+            return np.isin(values, list(condition))
+        if isinstance(condition, utils.Range):
+            return condition(values)
+        if utils.is_callable(condition):
+            # generic predicates can't be vectorised
+            return np.fromiter((bool(condition(v)) for v in values), dtype=bool, count=values.size)
+        return values == condition
+
+    @classmethod
+    def not_indexed(cls, kwargs):
+        return {k: v for k, v in kwargs.items() if k not in cls.keys}
+
+    def select(self, **kwargs):
+        """
+        Positions (in file order) of messages satisfying conditions on indexed keys.
+        Conditions on other keys are ignored here and must be checked on handles (see not_indexed).
+        """
+        mask = np.ones(len(self.messages), dtype=bool)
+        for key, condition in kwargs.items():
+            if key not in self._columns:
+                continue
+            values, defined = self._columns[key]
+            mask &= defined & self._evaluate(values, condition)
+        return np.flatnonzero(mask)
+
+    def message(self, position):
+        return self.messages[position]
+
+    def get(self, positions, key):
+        # values of an indexed key for messages at positions, without creating handles
+        return [self.messages[p][key] for p in positions]
+
+    def new_handle(self, position, headers_only=False):
+        # seek directly to the message and create the handle from its bytes (or from its header sections only)
+        message = self.messages[position]
+        if not self._file_handler:
+            self._file_handler = open(self.grib_file, 'rb')
+        self._file_handler.seek(message['offset'])
+        if headers_only:
+            return codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB, headers_only=True)
+        return codes_new_from_message(self._file_handler.read(message['length']))
+
+    def close(self):
+        if self._file_handler:
+            self._file_handler.close()
+            self._file_handler = None
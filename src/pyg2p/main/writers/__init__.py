@@ -1,12 +1,14 @@
 import os
 import abc
-import collections
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 from pyg2p import Loggable
 from pyg2p.main.interpolation import Interpolator
 from pyg2p.main.manipulation.correction import Corrector
+from pyg2p.util import files
 
 
 class Writer(Loggable, metaclass=abc.ABCMeta):
@@ -35,81 +37,112 @@ class OutputWriter(Loggable):
         self.ctx = ctx
         self.interpolator = Interpolator(ctx, mv_input=grib_info.mv)
         self.writer = self.get_writer()  # instance of PCRasterWriter or NetCDFWriter
+        self.workers = ctx.get('execution.workers') or 1
+        self.out_dir = ctx.get('outMaps.outDir')
         self._logger.setLevel(ctx['logger.level'])
 
+    def set_member(self, member):
+        # ensemble batch mode: outputs of each eps member are written in <outDir>/<member>/
+        self.out_dir = os.path.join(self.ctx.get('outMaps.outDir'), str(member))
+        files.create_dir(self.out_dir)
+
     def aux_for_intertable_generation(self, aux_g, aux_v, aux_g2, aux_v2):
         self.interpolator.aux_for_intertable_generation(aux_g, aux_v, aux_g2, aux_v2)
 
-    def _write_maps_netcdf(self, values, messages, change_res_step):
+    def _interpolate(self, lats, longs, v, grid_id, geodetic_info, is_second_res, prepare=None):
+        out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
+        if self.ctx.must_do_correction:
+            corrector = Corrector.get_instance(self.ctx, grid_id)
+            out_v = corrector.correct(out_v)
+        return out_v if prepare is None else prepare(out_v)
+
+    def _interpolated_values(self, values, messages, change_res_step, prepare=None):
         """
-        Prepare values for netCDF file writing (time and values)
-        Note that lats and lons values are prepared from netcdf writer init_dataset method
-        They come from latitude/longitude pcraster maps values
+        Generator of (timestep, interpolated and corrected values), in the same order of input values.
+        With more than one worker, timesteps are processed by a pool of threads
+        (NumPy and numexpr release the GIL) with at most 2 * workers timesteps in flight.
+        The first timestep of each grid is processed alone, so that its intertable
+        and corrector are read (or created) only once.
         """
         is_second_res = False
         lats, longs = messages.latlons
         geodetic_info = messages.grid_details
         grid_id = messages.grid_id
-        time_values = []
-        out_values = []
-        for i, (timestep, v) in enumerate(values.items()):
-            # note: timestep and change_res_step are instances of domain.step.Step class
-            # writing map i
-            if messages.have_resolution_change() and timestep == change_res_step:
-                # Switching to second resolution
-                lats, longs = messages.latlons_2nd
-                geodetic_info = messages.grid_details.get_2nd_resolution()
-                grid_id = messages.grid2_id
-                is_second_res = True
-            out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
-            if self.ctx.must_do_correction:
-                corrector = Corrector.get_instance(self.ctx, grid_id)
-                out_v = corrector.correct(out_v)
-            out_v[out_v == self.interpolator.mv_output] = np.nan
-            out_values.append(out_v)
-            time_values.append(timestep.end_step)
-        # prepare values for netcdf writing
-        time_values = np.array(time_values, dtype=np.int32)
-        out_values = np.array(out_values, dtype=np.float64)
+        executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        pending = collections.deque()
+        try:
+            for i, (timestep, v) in enumerate(values):
+                # note: timestep and change_res_step are instances of pyg2p.Step class
+                first_of_grid = i == 0
+                if messages.have_resolution_change() and timestep == change_res_step:
+                    # Switching to second resolution
+                    lats, longs = messages.latlons_2nd
+                    geodetic_info = messages.grid_details.get_2nd_resolution()
+                    grid_id = messages.grid2_id
+                    is_second_res = True
+                    first_of_grid = True
+                args = (lats, longs, v, grid_id, geodetic_info, is_second_res, prepare)
+                if executor is None or first_of_grid:
+                    while pending:
+                        ts, future = pending.popleft()
+                        yield ts, future.result()
+                    yield timestep, self._interpolate(*args)
+                    continue
+                pending.append((timestep, executor.submit(self._interpolate, *args)))
+                if len(pending) >= 2 * self.workers:
+                    ts, future = pending.popleft()
+                    yield ts, future.result()
+            while pending:
+                ts, future = pending.popleft()
+                yield ts, future.result()
+        finally:
+            if executor is not None:
+                for _, future in pending:
+                    future.cancel()
+                executor.shutdown(wait=True)
+
+    def _nan_missing(self, out_v):
+        out_v[out_v == self.interpolator.mv_output] = np.nan
+        return np.asarray(out_v, dtype=np.float64)
+
+    def _write_maps_netcdf(self, values, messages, change_res_step):
+        """
+        Prepare values for netCDF file writing (time and values)
+        Note that lats and lons values are prepared from netcdf writer init_dataset method
+        They come from latitude/longitude pcraster maps values
+        """
         out_filename = self._name_netcdf_file()
         var_args = dict(prefix=self.ctx.get('outMaps.namePrefix'),
                         unit=self.ctx.get('parameter.conversionUnit'),
                         var_long_name=self.ctx.get('parameter.description'),
                         data_date=messages.data_date)
         self.writer.init_dataset(out_filename)
-
-        self.writer.write(out_values, time_values, **var_args)
+        self.writer.init_variables(**var_args)
+        # values are written one timestep at a time, without keeping the whole output in memory
+        interpolated = self._interpolated_values(values, messages, change_res_step, prepare=self._nan_missing)
+        for i, (timestep, out_v) in enumerate(interpolated):
+            self.writer.write_step(i, out_v, timestep.end_step)
 
     def _write_maps_pcraster(self, values, messages, change_res_step):
-        is_second_res = False
-        lats, longs = messages.latlons
-        geodetic_info = messages.grid_details
-        grid_id = messages.grid_id
-
-        for i, (timestep, v) in enumerate(values.items(), start=1):
-            # note: timestep and change_res_step are instances of pyg2p.Step class
-            # writing map i
-            if messages.have_resolution_change() and timestep == change_res_step:
-                # Switching to second resolution
-                lats, longs = messages.latlons_2nd
-                geodetic_info = messages.grid_details.get_2nd_resolution()
-                grid_id = messages.grid2_id
-                is_second_res = True
-            out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
-            if self.ctx.must_do_correction:
-                corrector = Corrector.get_instance(self.ctx, grid_id)
-                out_v = corrector.correct(out_v)
+        # maps are written by this thread, as the writer reuses the same in-memory dataset
+        interpolated = self._interpolated_values(values, messages, change_res_step)
+        for i, (timestep, out_v) in enumerate(interpolated, start=1):
             self.writer.write(self._name_pcr_map(i), out_v)
 
     def write_maps(self, values, messages, change_res_step=None):
+        """
+        values: dict of Step -> values, or iterable of (Step, values) pairs ordered by end step (streaming mode)
+        """
         write_method = getattr(self, f"_write_maps_{self.ctx.get('outMaps.format')}")
         # Ordering values happens only here now - 12/04/2015
         # values = collections.OrderedDict(sorted(values.items(), key=lambda k: int(k[0].end_step)))
+        if isinstance(values, collections.abc.Mapping):
+            values = values.items()
         write_method(values, messages, change_res_step)
 
     def _name_netcdf_file(self):
         filename = f"{self.ctx.get('outMaps.namePrefix')}_{self.ctx.get('aggregation.type')}.nc"
-        out_filename = os.path.join(self.ctx.get('outMaps.outDir'), filename)
+        out_filename = os.path.join(self.out_dir, filename)
         return out_filename
 
     def _name_pcr_map(self, i_map):
@@ -122,7 +155,7 @@ class OutputWriter(Loggable):
             filename += '0'
         filename += str(map_number)
         filename = filename[0:8] + '.' + filename[8:11]
-        filename = os.path.join(self.ctx.get('outMaps.outDir'), filename)
+        filename = os.path.join(self.out_dir, filename)
         return filename
 
     def close(self):
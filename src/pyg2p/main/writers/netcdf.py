@@ -15,6 +15,8 @@ class NetCDFWriter(Writer):
         super().__init__(*args)
         self.nf = None
         self.filepath = None
+        self.time_nc = None
+        self.values_nc = None
         lats_map, lons_map = args[1], args[2]
         area = PCRasterReader(self._clone_map)
         self.area = area.values
@@ -26,6 +28,8 @@ class NetCDFWriter(Writer):
         self.lons[self.lons == self.coordinates_mv] = np.nan
 
     def init_dataset(self, out_filename):
+        # in ensemble batch mode, the same writer writes a file for each member
+        self.close()
         self.nf = Dataset(out_filename, 'w', format='NETCDF4')
         self.filepath = out_filename
         time_created = time.ctime(time.time())
@@ -41,6 +45,11 @@ class NetCDFWriter(Writer):
         self.nf.createDimension('time', None)
 
     def write(self, values, time_values, **varargs):
+        self.init_variables(**varargs)
+        self.time_nc[:] = time_values
+        self.values_nc[:, :] = values
+
+    def init_variables(self, **varargs):
         # Variables
         longitude = self.nf.createVariable('lon', 'f4', ('lat', 'lon'))
         longitude.standard_name = 'longitude'
@@ -56,7 +65,6 @@ class NetCDFWriter(Writer):
         time_nc.standard_name = 'time'
         time_nc.units = f'hours since {varargs.get("data_date")}'
         time_nc.calendar = 'proleptic_gregorian'
-        time_nc[:] = time_values
 
         values_nc = self.nf.createVariable(varargs.get('prefix', ''), 'f8',
                                            ('time', 'lat', 'lon'), zlib=False,
@@ -66,10 +74,18 @@ class NetCDFWriter(Writer):
         values_nc.standard_name = varargs.get('prefix', '')
         values_nc.long_name = varargs.get('var_long_name', '')
         values_nc.units = varargs.get('unit', '')
-        values_nc[:, :] = values
         longitude[:] = self.lons
         latitude[:] = self.lats
+        self.time_nc = time_nc
+        self.values_nc = values_nc
+
+    def write_step(self, i, values, time_value):
+        # append values of a single timestep, along the unlimited time dimension
+        self.time_nc[i] = time_value
+        self.values_nc[i, :, :] = values
 
     def close(self):
+        if self.nf is None or not self.nf.isopen():
+            return
         self.nf.close()
         self._log(f'{self.filepath} written!', 'INFO')
@@ -1,5 +1,10 @@
+import mmap
+from collections import OrderedDict
+from threading import RLock
 from sys import stdout
 
+import numpy as np
+
 ENDC = '\033[0m'
 BOLD = '\033[1m'
 GREEN = '\033[92m' + BOLD
@@ -27,3 +32,130 @@ def progress_step_and_backchar(num_cells):
         back_char = '\n'
         progress_step *= 10
     return back_char, progress_step
+
+
+def matches(value, condition):
+    # condition can be a single value, a container of accepted values or a predicate
+    if is_container(condition):
+        return value in condition
+    if is_callable(condition):
+        return condition(value)
+    return value == condition
+
+
+class Range:
+    """
+    Condition selecting values between min_ and max_ (both included, both optional).
+    As other predicates, it's callable on single values but it works on numpy arrays as well,
+    and bounds can be used to push the condition down to indexes.
+    """
+    def __init__(self, min_=None, max_=None):
+        self.min_ = min_
+        self.max_ = max_
+
+    def __call__(self, value):
+        res = True
+        if self.min_ is not None:
+            res = res & (value >= self.min_)
+        if self.max_ is not None:
+            res = res & (value <= self.max_)
+        return res
+
+    def __repr__(self):
+        return f'Range({self.min_}, {self.max_})'
+
+
+class SizedLRUCache:
+    """
+    Least recently used cache limited by total size (in bytes) of cached items (numpy arrays or objects with nbytes).
+    Memory mapped arrays are charged 0 bytes: their pages are in the OS cache (shared with other processes)
+    and they are not read in memory as a whole. They are counted in stats as mapped items and bytes.
+    The most recent item is always kept, even if it's bigger than max_bytes.
+    Hits, misses and evictions are counted. Operations are thread safe.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.mapped_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        # bytes charged for each item and whether it's memory mapped
+        self._sizes = {}
+        self._lock = RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    @staticmethod
+    def is_mapped(value):
+        base = value
+        while isinstance(base, np.ndarray):
+            if isinstance(base, np.memmap):
+                return True
+            base = base.base
+        return isinstance(base, mmap.mmap)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self.pop(key)
+            self._items[key] = value
+            mapped = self.is_mapped(value)
+            self._sizes[key] = (0 if mapped else value.nbytes, value.nbytes if mapped else 0)
+            self._charge(key, 1)
+            self._evict()
+
+    def _charge(self, key, sign):
+        size, mapped_size = self._sizes[key]
+        self.size += sign * size
+        self.mapped_size += sign * mapped_size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._items) > 1:
+            key, _ = self._items.popitem(last=False)
+            self._charge(key, -1)
+            del self._sizes[key]
+            self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if key in self._sizes:
+                self._charge(key, -1)
+                del self._sizes[key]
+            return value
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.size = 0
+            self.mapped_size = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            mapped_items = sum(1 for _, mapped_size in self._sizes.values() if mapped_size)
+            return {'items': len(self._items), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'mapped_items': mapped_items, 'mapped_bytes': self.mapped_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
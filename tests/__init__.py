@@ -2,6 +2,8 @@ import os
 import sys
 import logging
 
+from eccodes import (codes_grib_new_from_file, codes_clone, codes_set, codes_get_values, codes_set_values,
+                     codes_write, codes_release)
 from lisfloodutilities.compare import PCRComparator, NetCDFComparator
 from pyg2p.main import Configuration
 
@@ -45,6 +47,23 @@ config_dict = {
             'input.file': 'tests/data/input.grib',
 }
 
+def ensemble_grib(out_file, members=(0, 1, 5), src='tests/data/input.grib'):
+    """Writes an eps file with a copy of each message in src for each member, values shifted by member number"""
+    with open(src, 'rb') as f, open(out_file, 'wb') as out:
+        while True:
+            gid = codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            for member in members:
+                clone = codes_clone(gid)
+                codes_set(clone, 'perturbationNumber', member)
+                codes_set_values(clone, codes_get_values(clone) + member)
+                codes_write(clone, out)
+                codes_release(clone)
+            codes_release(gid)
+    return out_file
+
+
 api_config_dict = {
 
 }
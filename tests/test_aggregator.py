@@ -1,7 +1,10 @@
 import numpy as np
+import pytest
 
-from pyg2p import Step
-from pyg2p.main.manipulation.aggregator import Aggregator, INSTANTANEOUS, ACCUMULATION, AVERAGE
+from pyg2p import Step, LazyValues
+from pyg2p.main import ApplicationException
+from pyg2p.main.manipulation.aggregator import (Aggregator, INSTANTANEOUS, ACCUMULATION, AVERAGE,
+                                               MINIMUM, MAXIMUM, SUM, PERCENTILE)
 from pyg2p.main.readers import GRIBReader
 
 from tests import MockedExecutionContext, config_dict
@@ -71,3 +74,112 @@ class TestAggregator:
         keys_res = list(values.keys())
         assert keys_res[0] == Step(0, 6, 415, 6, 2)
         assert keys_res[-1] == Step(18, 24, 415, 6, 2)
+
+    def test_streaming(self):
+        ctx = MockedExecutionContext(config_dict, False)
+        grib_reader = GRIBReader(ctx.get('input.file'))
+        grib_info = grib_reader.get_grib_info({'shortName': '2t'})
+        values_orig = grib_reader.select_messages(shortName='2t').first_resolution_values()
+        # decoded values are bounded by a memory ceiling of two messages
+        grib_reader_stream = GRIBReader(ctx.get('input.file'), max_memory=2 * next(iter(values_orig.values())).nbytes)
+        grib_reader_stream.get_grib_info({'shortName': '2t'})
+        values_lazy = grib_reader_stream.select_messages(shortName='2t').first_resolution_values()
+        for aggr_type, aggr_step in ((INSTANTANEOUS, 6), (AVERAGE, 12), (ACCUMULATION, 6), (MAXIMUM, 12), (PERCENTILE, 24)):
+            kwargs = dict(aggr_step=aggr_step, aggr_type=aggr_type, input_step=grib_info.input_step,
+                          step_type=grib_info.type_of_param, start_step=0, mv_grib=grib_info.mv, end_step=24,
+                          unit_time=24, force_zero_array=False, percentile=90)
+            values = Aggregator(**kwargs).do_manipulation(values_orig)
+            values_stream = list(Aggregator(**kwargs).iter_manipulation(values_lazy))
+            assert [k for k, _ in values_stream] == list(values.keys())
+            for k, v in values_stream:
+                assert np.array_equal(v, values[k])
+        grib_reader.close()
+        grib_reader_stream.close()
+
+    def test_accumulation_synthesised_steps(self):
+        # 3 hourly accumulations of 6 hourly cumulated values: missing steps are linearly interpolated
+        values = {Step(0, step, 10, 6, 0): np.full(4, float(step * step)) for step in (0, 6, 12, 18)}
+        aggregator = Aggregator(aggr_step=3, aggr_type=ACCUMULATION, input_step=6, step_type='accum',
+                                start_step=3, mv_grib=-1, end_step=18, unit_time=3, force_zero_array=False)
+        plan = aggregator._accumulation_plan([0, 6, 12, 18])
+        assert plan[0] == [0, 3, 6, 9, 12, 15, 18]
+        assert dict(plan[1]) == {3: (0, 6, 0.5), 9: (6, 12, 0.5), 15: (12, 18, 0.5)}
+        aggregator = Aggregator(aggr_step=3, aggr_type=ACCUMULATION, input_step=6, step_type='accum',
+                                start_step=0, mv_grib=-1, end_step=18, unit_time=3, force_zero_array=False)
+        res = aggregator.do_manipulation(values)
+        assert list(res.keys()) == [Step(s - 3, s, 10, 3, 0) for s in (3, 6, 9, 12, 15, 18)]
+        expected = [18, 36 - 18, 90 - 36, 144 - 90, 234 - 144, 324 - 234]
+        assert [v[0] for v in res.values()] == expected
+
+    def test_window_plan(self):
+        # hours of a window without values take the next available step
+        aggregator = Aggregator(aggr_step=24, aggr_type=AVERAGE, input_step=6, step_type='instant',
+                                start_step=0, mv_grib=-1, end_step=48, unit_time=24, force_zero_array=False)
+        windows = aggregator._window_plan([0, 6, 12, 18, 24, 36, 48])
+        assert windows == [(0, [(6, 6), (12, 6), (18, 6), (24, 6)]), (24, [(36, 12), (48, 12)])]
+        values = {Step(0, step, 10, 6, 0): np.full(3, float(step)) for step in (0, 6, 12, 18, 24, 36, 48)}
+        res = aggregator.do_manipulation(values)
+        assert list(res.keys()) == [Step(0, 24, 10, 24, 0), Step(24, 48, 10, 24, 0)]
+        assert np.allclose(res[Step(0, 24, 10, 24, 0)], 15) and np.allclose(res[Step(24, 48, 10, 24, 0)], 42)
+
+    def test_average_cumulative_sums(self):
+        # hourly values up to step 12, then 3 hourly and 6 hourly: windows are differences of cumulative sums
+        steps = list(range(0, 13)) + [15, 18, 24, 30, 36, 42, 48]
+        rng = np.random.default_rng(0)
+        fields = {step: rng.random(5).astype(np.float32) * 300 for step in steps}
+        values = {Step(0, step, 10, 1, 0): fields[step] for step in steps}
+
+        def lazy():
+            return LazyValues({k: (lambda v=v: v) for k, v in values.items()}, 10 ** 6)
+
+        for start, aggr_step in ((0, 24), (0, 6), (12, 12), (19, 6), (7, 3)):
+            aggregator = Aggregator(aggr_step=aggr_step, aggr_type=AVERAGE, input_step=1, step_type='instant',
+                                    start_step=start, mv_grib=-1, end_step=48, unit_time=24, force_zero_array=False)
+            res = aggregator.do_manipulation(values)
+            assert res
+            for key, out in res.items():
+                first_hour, end_hour = aggregator._window_hours(key.start_step)
+                hourly = [fields[steps[np.searchsorted(steps, hour)]] for hour in range(first_hour, end_hour)]
+                assert np.allclose(out, np.mean(np.array(hourly, dtype=np.float64), axis=0), rtol=1e-12)
+            res_stream = list(aggregator.iter_manipulation(lazy()))
+            assert [k for k, _ in res_stream] == list(res.keys())
+            assert all(np.array_equal(v, res[k]) for k, v in res_stream)
+
+    def test_instant_no_copies(self):
+        values = {Step(0, step, 10, 6, 0): np.ma.masked_array(np.full(3, float(step)), mask=[0, 1, 0]) for step in (6, 12)}
+        aggregator = Aggregator(aggr_step=3, aggr_type=INSTANTANEOUS, input_step=6, step_type='instant',
+                                start_step=0, mv_grib=-1, end_step=12, unit_time=24, force_zero_array=False)
+        res = aggregator.do_manipulation(values)
+        assert list(res.keys()) == [Step(s, s, 10, 3, 0) for s in (0, 3, 6, 9, 12)]
+        assert np.array_equal(res[Step(0, 0, 10, 3, 0)], np.zeros(3))
+        # values are the GRIB values themselves, masks included
+        assert res[Step(3, 3, 10, 3, 0)] is values[Step(0, 6, 10, 6, 0)]
+        assert res[Step(6, 6, 10, 3, 0)] is values[Step(0, 6, 10, 6, 0)]
+        assert res[Step(9, 9, 10, 3, 0)] is values[Step(0, 12, 10, 6, 0)]
+        assert res[Step(12, 12, 10, 3, 0)].mask[1]
+
+    def test_statistics(self):
+        values = {Step(0, step, 10, 6, 0): np.array([step, -step, 1.]) for step in (0, 6, 12, 18, 24, 30, 36, 42, 48)}
+        values[Step(0, 30, 10, 6, 0)] = np.ma.masked_array(values[Step(0, 30, 10, 6, 0)], mask=[0, 0, 1])
+        expected = {MINIMUM: [[6, -24, 1], [30, -48, 1]],
+                    MAXIMUM: [[24, -6, 1], [48, -30, 1]],
+                    SUM: [[60, -60, 4], [156, -156, 4]],
+                    PERCENTILE: [[15, -15, 1], [39, -39, 1]]}
+        for aggr_type, expected_values in expected.items():
+            aggregator = Aggregator(aggr_step=24, aggr_type=aggr_type, input_step=6, step_type='instant', percentile=50,
+                                    start_step=0, mv_grib=-1, end_step=48, unit_time=24, force_zero_array=False)
+            res = aggregator.do_manipulation(values)
+            assert list(res.keys()) == [Step(0, 24, 10, 24, 0), Step(24, 48, 10, 24, 0)]
+            for v, expected_v in zip(res.values(), expected_values):
+                assert np.allclose(v.data, expected_v)
+            # masked values mask the result of their window
+            assert not res[Step(0, 24, 10, 24, 0)].mask.any()
+            assert list(res[Step(24, 48, 10, 24, 0)].mask) == [False, False, True]
+
+    def test_percentile_args(self):
+        kwargs = dict(aggr_step=24, aggr_type=PERCENTILE, input_step=6, step_type='instant',
+                      start_step=0, mv_grib=-1, end_step=48, unit_time=24, force_zero_array=False)
+        assert Aggregator(percentile='90', **kwargs)._percentile == 90.
+        for percentile in (None, 'ninety', [90], 101, -1):
+            with pytest.raises(ApplicationException, match='needs a percentile between 0 and 100'):
+                Aggregator(percentile=percentile, **kwargs)
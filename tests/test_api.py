@@ -1,3 +1,4 @@
+import glob
 import os
 from copy import deepcopy
 
@@ -6,7 +7,9 @@ import numpy as np
 import pytest
 
 from pyg2p.main.api import Pyg2pApi, ApiContext
+from pyg2p.main.interpolation import Interpolator
 from pyg2p.main.readers import PCRasterReader
+from tests import ensemble_grib
 
 
 @pytest.mark.usefixtures("options")
@@ -222,4 +225,88 @@ class TestApi:
         out_values = api.execute()
         shape_target = PCRasterReader(config['OutMaps']['Interpolation']['latMap']).values.shape
         assert shape_target == list(out_values.values())[0].shape
-        os.unlink('tests/data/tbl_pf10tp_550800_scipy_invdist.npy.gz')
+        os.unlink('tests/data/tbl_pf10tp_550800_scipy_invdist.npy')
+        for kdtree_file in glob.glob('tests/data/kdtree_*'):
+            os.unlink(kdtree_file)
+
+
+class TestApiMembers:
+    config = {
+        'loggerLevel': 'ERROR',
+        'inputFile': '',
+        'fmap': 1,
+        'start': None,
+        'end': None,
+        'intertableDir': os.path.abspath('tests/data'),
+        'OutMaps': {
+            'unitTime': 24,
+            'cloneMap': os.path.abspath('tests/data/dem.map'),
+            'Interpolation': {
+                "latMap": os.path.abspath('tests/data/lat.map'),
+                "lonMap": os.path.abspath('tests/data/lon.map'),
+                "mode": "nearest"
+            }
+        },
+        'Aggregation': {
+            'step': 12,
+            'type': 'average'
+        },
+        'Parameter': {
+            'shortName': '2t',
+            'applyConversion': 'k2c',
+        },
+    }
+
+    def test_members(self, tmp_path):
+        config = deepcopy(self.config)
+        config['inputFile'] = ensemble_grib(tmp_path.joinpath('ens.grib').as_posix())
+        single = {}
+        for member in (0, 1, 5):
+            member_config = deepcopy(config)
+            member_config['perturbationNumber'] = member
+            single[member] = Pyg2pApi(ApiContext(member_config)).execute()
+
+        for members, expected in (('all', [0, 1, 5]), ([1, 5], [1, 5]), ('0-1', [0, 1])):
+            batch_config = deepcopy(config)
+            batch_config['members'] = members
+            values = Pyg2pApi(ApiContext(batch_config)).execute()
+            assert list(values) == expected
+            for member in expected:
+                assert list(values[member]) == list(single[member])
+                for step in single[member]:
+                    assert np.array_equal(values[member][step], single[member][step], equal_nan=True)
+        assert not np.array_equal(values[0][step], values[1][step], equal_nan=True)
+
+
+class TestApiStreaming:
+
+    def test_interpolation_stacks(self, monkeypatch):
+        config = deepcopy(TestApiMembers.config)
+        config['inputFile'] = 'tests/data/input.grib'
+        config['Aggregation']['step'] = 6
+        stacks = []
+        interpolate_many = Interpolator.interpolate_many
+
+        def spy(interpolator, values_stack, *args, **kwargs):
+            stacks.append(len(values_stack))
+            return interpolate_many(interpolator, values_stack, *args, **kwargs)
+
+        monkeypatch.setattr(Interpolator, 'interpolate_many', spy)
+        values = Pyg2pApi(ApiContext(config)).execute()
+        assert len(values) > 1 and stacks == [len(values)]
+
+        # with maxMemory (MB), values are streamed and interpolated in stacks within the memory budget
+        stacks.clear()
+        streaming_config = deepcopy(config)
+        streaming_config['maxMemory'] = 1
+        streamed = Pyg2pApi(ApiContext(streaming_config)).execute()
+        assert stacks == [1] * len(values)
+        assert list(streamed) == list(values)
+        assert all(np.array_equal(streamed[k], values[k], equal_nan=True) for k in values)
+
+        stacks.clear()
+        # each timestep takes about 8 MB (source values, their stack and interpolated values)
+        monkeypatch.setattr(Pyg2pApi, 'stack_max_memory', 20 * 1024 ** 2)
+        stacked = Pyg2pApi(ApiContext(config)).execute()
+        assert stacks == [2, 2]
+        assert all(np.array_equal(stacked[k], values[k], equal_nan=True) for k in values)
@@ -0,0 +1,82 @@
+import json
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pyg2p.main import Controller, ExecutionContext
+from pyg2p.main.writers import OutputWriter
+from pyg2p.main.writers.netcdf import NetCDFWriter
+from tests import ensemble_grib
+
+
+class TestController:
+    command = {'Execution': {
+        '@name': 'eps batch',
+        'Aggregation': {'@step': 12, '@type': 'average'},
+        'OutMaps': {'@cloneMap': os.path.abspath('tests/data/dem.map'), '@ext': 1, '@fmap': 1,
+                    '@namePrefix': 't2', '@unitTime': 24,
+                    'Interpolation': {'@latMap': os.path.abspath('tests/data/lat.map'),
+                                      '@lonMap': os.path.abspath('tests/data/lon.map'),
+                                      '@mode': 'nearest'}},
+        'Parameter': {'@applyConversion': 'k2c', '@shortName': '2t'}}}
+
+    @staticmethod
+    def run(*args):
+        ctrl = Controller(ExecutionContext(['-F', 'netcdf', '-N', os.path.abspath('tests/data'), '-l', 'ERROR', *args]))
+        try:
+            ctrl.execute()
+        finally:
+            ctrl.close()
+
+    @staticmethod
+    def read(path):
+        with Dataset(path) as nc:
+            return nc.variables['time'][:], np.ma.getdata(nc.variables['t2'][:])
+
+    def test_ensemble_batch(self, tmp_path, monkeypatch):
+        grib = ensemble_grib(tmp_path.joinpath('ens.grib').as_posix())
+        command = tmp_path.joinpath('command.json').as_posix()
+        with open(command, 'w') as f:
+            json.dump(self.command, f)
+        io_args = ['-c', command, '-i', grib]
+
+        # single member executions
+        for member in (0, 1, 5):
+            out = tmp_path.joinpath(f'm{member}')
+            out.mkdir()
+            self.run(*io_args, '-o', out.as_posix(), '-m', str(member))
+
+        calls = []
+        set_member = OutputWriter.set_member
+        init_dataset = NetCDFWriter.init_dataset
+
+        def spy_set_member(writer, member):
+            calls.append(('set_member', id(writer), member))
+            set_member(writer, member)
+
+        def spy_init_dataset(writer, out_filename):
+            calls.append(('init_dataset', id(writer), out_filename))
+            init_dataset(writer, out_filename)
+
+        monkeypatch.setattr(OutputWriter, 'set_member', spy_set_member)
+        monkeypatch.setattr(NetCDFWriter, 'init_dataset', spy_init_dataset)
+        out = tmp_path.joinpath('batch')
+        out.mkdir()
+        self.run(*io_args, '-o', out.as_posix(), '-E', 'all')
+
+        assert sorted(os.listdir(out)) == ['0', '1', '5']
+        for member in (0, 1, 5):
+            assert os.listdir(out.joinpath(str(member))) == ['t2_average.nc']
+            batch_time, batch_values = self.read(out.joinpath(str(member), 't2_average.nc'))
+            single_time, single_values = self.read(tmp_path.joinpath(f'm{member}', 't2_average.nc'))
+            assert np.array_equal(batch_time, single_time)
+            assert np.array_equal(batch_values, single_values, equal_nan=True)
+        assert not np.array_equal(self.read(out.joinpath('0', 't2_average.nc'))[1],
+                                  self.read(out.joinpath('5', 't2_average.nc'))[1], equal_nan=True)
+
+        # same writers for all members, a new dataset is initialised in member's folder after each set_member
+        assert [c[0] for c in calls] == ['set_member', 'init_dataset'] * 3
+        assert len({c[1] for c in calls[::2]}) == 1 and len({c[1] for c in calls[1::2]}) == 1
+        for (_, _, member), (_, _, out_filename) in zip(calls[::2], calls[1::2]):
+            assert out_filename == out.joinpath(str(member), 't2_average.nc').as_posix()
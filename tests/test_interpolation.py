@@ -1,10 +1,20 @@
+import json
 import os
+import shutil
 from copy import deepcopy
 
+import numpy as np
+import numpy.ma as ma
 import pytest
+from scipy.spatial import cKDTree
 
-from pyg2p.main.interpolation import Interpolator
+from pyg2p.main import Configuration
+from pyg2p.main.interpolation import Interpolator, intertables, grib_interpolation_lib, prebuild
+from pyg2p.main.interpolation.latlong import LatLong
+from pyg2p.main.interpolation.operators import SparseInterpolation
+from pyg2p.main.interpolation.scipy_interpolation_lib import InverseDistance
 from pyg2p.main.readers import GRIBReader, PCRasterReader
+from pyg2p.util.generics import SizedLRUCache
 
 from tests import MockedExecutionContext, config_dict
 
@@ -25,6 +35,403 @@ class TestInterpolation:
         shape_target = PCRasterReader(config_dict['interpolation.latMap']).values.shape
         assert shape_target == values_resampled.shape
 
+    def test_interpolation_mmap_intertable(self, tmp_path):
+        tbl = 'tbl_pf10slhf_550800_scipy_nearest.npy.gz'
+        shutil.copy(os.path.join('tests/data', tbl), tmp_path)
+        converted = intertables.convert(tmp_path.joinpath(tbl).as_posix())
+        assert converted == tmp_path.joinpath(tbl[:-3]).as_posix()
+        assert isinstance(intertables.load(converted), np.memmap)
+
+        file = config_dict['input.file']
+        reader = GRIBReader(file)
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        lats, lons = messages.latlons
+        ctx = MockedExecutionContext(config_dict, False)
+        values_gz = Interpolator(ctx, messages.missing_value).interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+        d = deepcopy(config_dict)
+        d['interpolation.dirs'] = {'user': tmp_path.as_posix(), 'global': tmp_path.as_posix()}
+        ctx = MockedExecutionContext(d, False)
+        values_mmap = Interpolator(ctx, messages.missing_value).interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+        assert isinstance(Interpolator.cache.get(('intertable', converted)), np.memmap)
+        assert np.array_equal(values_gz, values_mmap)
+        reader.close()
+
+    def test_interpolation_compact_intertable(self, tmp_path):
+        tbl = 'tbl_pf10slhf_550800_scipy_nearest.npy.gz'
+        intertable = intertables.load(os.path.join('tests/data', tbl))
+        compact = intertables.scipy_table(intertable['indexes'], intertable['coeffs'])
+        assert compact['indexes'].dtype == np.int32 and compact['coeffs'].dtype == np.float32
+        intertables.save(tmp_path.joinpath(tbl).as_posix(), compact)
+
+        file = config_dict['input.file']
+        reader = GRIBReader(file)
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        lats, lons = messages.latlons
+        ctx = MockedExecutionContext(config_dict, False)
+        values = Interpolator(ctx, messages.missing_value).interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+        d = deepcopy(config_dict)
+        d['interpolation.dirs'] = {'user': tmp_path.as_posix(), 'global': tmp_path.as_posix()}
+        ctx = MockedExecutionContext(d, False)
+        values_compact = Interpolator(ctx, messages.missing_value).interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+        assert values_compact.dtype == values.dtype
+        assert np.array_equal(values, values_compact)
+        reader.close()
+
+        # grib inverse distance table without padding rows
+        indexes = np.arange(12).reshape(6, 2)
+        coeffs = np.full((4, 2), 0.25)
+        intertable = intertables.grib_invdist_table(indexes, coeffs)
+        assert intertable['indexes'].shape == (6, 2) and intertable['coeffs'].shape == (4, 2)
+        assert intertable.nbytes == 6 * 2 * 4 + 4 * 2 * 4
+
+    def test_intertable_checkpoint(self, tmp_path):
+        path = tmp_path.joinpath('tbl.npy').as_posix()
+        computed = []
+
+        def compute_block(start, end):
+            if start == interrupt_at:
+                raise KeyboardInterrupt
+            computed.append(start)
+            return np.arange(start, end), np.ones((end - start, 2))
+
+        interrupt_at = 4
+        with pytest.raises(KeyboardInterrupt):
+            intertables.build_in_blocks(path, 'key', 10, 2, compute_block)
+        assert computed == [0, 2]
+
+        # creation resumes from saved blocks
+        interrupt_at = None
+        computed.clear()
+        indexes, coeffs = intertables.build_in_blocks(path, 'key', 10, 2, compute_block)
+        assert computed == [4, 6, 8]
+        assert np.array_equal(indexes, np.arange(10)) and coeffs.shape == (10, 2)
+
+        # blocks of another creation are discarded
+        computed.clear()
+        intertables.build_in_blocks(path, 'other key', 10, 3, compute_block)
+        assert computed == [0, 3, 6, 9]
+        intertables.save(path, intertables.scipy_table(indexes, coeffs[:, 0]))
+        assert not os.path.exists(path + intertables.PARTIAL_EXT)
+
+    def test_prebuild_intertables(self, tmp_path, monkeypatch):
+        conf = Configuration()
+        conf.intertables.config_file = tmp_path.joinpath('intertables.json').as_posix()
+        conf.intertables.user_vars = {}
+        catalogue = {'sources': [config_dict['input.file']],
+                     'targets': [{'latMap': config_dict['interpolation.latMap'], 'lonMap': config_dict['interpolation.lonMap'],
+                                  'modes': ['grib_nearest', 'nearest']}]}
+        jobs = prebuild.prebuild_intertables(catalogue, configuration=conf, intertable_dir=tmp_path.as_posix(), dry_run=True)
+        assert [(job.mode, job.method, job.exists) for job in jobs] == [('grib_nearest', 'bulk', False), ('nearest', 'KD tree', False)]
+        assert all(job.seconds > 0 and job.target_points == 259024 for job in jobs)
+        assert not list(tmp_path.glob('*.npy'))
+
+        prebuild.prebuild_intertables(catalogue, configuration=conf, intertable_dir=tmp_path.as_posix(), workers=2)
+        for job in jobs:
+            assert os.path.exists(job.path)
+            assert conf.intertables.user_vars[job.intertable_id]['method'] == job.mode
+        jobs_built = prebuild.plan(conf, catalogue, {'user': tmp_path.as_posix(), 'global': tmp_path.as_posix()})
+        assert all(job.exists for job in jobs_built)
+
+        # intertables planned as missing and created by another process are not built nor registered again
+        registry = deepcopy(conf.intertables.user_vars)
+        assert all(prebuild.build(job, conf) is None for job in jobs)
+        monkeypatch.setattr(prebuild, 'plan', lambda *args, **kwargs: jobs)
+        for workers in (2, 1):
+            prebuild.prebuild_intertables(catalogue, configuration=conf, intertable_dir=tmp_path.as_posix(), workers=workers)
+            assert conf.intertables.user_vars == registry
+
+    def test_intertables_registry(self, tmp_path):
+        # two processes reading configuration before any of them adds an intertable
+        confs = [Configuration(), Configuration()]
+        for conf in confs:
+            conf.intertables.config_file = tmp_path.joinpath('intertables.json').as_posix()
+            conf.intertables.user_vars = {}
+        confs[0].intertables.add('id1', {'filename': 'tbl1.npy'})
+        confs[1].intertables.add('id2', {'filename': 'tbl2.npy'})
+        assert set(Configuration().intertables._load(open(confs[0].intertables.config_file))) == {'id1', 'id2'}
+        assert confs[0].intertables.get('id2') == {'filename': 'tbl2.npy'}
+        assert confs[0].intertables.get('id3') is None
+
+        # filenames of new intertables are reserved, also while they are created
+        d = deepcopy(config_dict)
+        d['interpolation.dirs'] = {'user': tmp_path.as_posix(), 'global': tmp_path.as_posix()}
+        d['interpolation.create'] = True
+        interpolator = Interpolator(MockedExecutionContext(d, False), -1)
+        _, name1 = interpolator._intertable_filename('grid1')
+        _, name2 = interpolator._intertable_filename('grid2')
+        assert name1.endswith('tbl_input_550800_scipy_nearest.npy') and name2.endswith('tbl_1_input_550800_scipy_nearest.npy')
+        with intertables.CreationLock(name1, 'id'):
+            assert not intertables.reserve(name1, 'other id')
+        assert not os.path.exists(name1 + intertables.LOCK_EXT)
+        assert intertables.reserve(name1, 'other id')
+
+    def test_intertables_cache(self):
+        from pyg2p.main.manipulation.correction import Corrector
+        assert Corrector.cache is Interpolator.cache
+        cache = Interpolator.cache
+        cache.clear()
+        reader = GRIBReader(config_dict['input.file'])
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        lats, lons = messages.latlons
+        interpolator = Interpolator(MockedExecutionContext(config_dict, False), messages.missing_value)
+        hits, misses = cache.hits, cache.misses
+        values = interpolator.interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+        assert len(cache) == 2 and cache.misses == misses + 2 and cache.hits == hits
+        assert cache.size == sum(item.nbytes for item in cache._items.values())
+        assert np.array_equal(values, interpolator.interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details))
+        assert cache.hits == hits + 1
+
+        # operator is kept, intertable is evicted
+        evictions, max_bytes = cache.evictions, cache.max_bytes
+        cache.resize(1)
+        assert len(cache) == 1 and cache.evictions == evictions + 1
+        cache.resize(max_bytes)
+        cache.clear()
+        assert len(cache) == 0 and cache.size == 0
+        reader.close()
+
+    def test_cache_mapped_intertables(self, tmp_path):
+        # memory mapped intertables are not charged to the memory budget
+        cache = SizedLRUCache(100)
+        path = intertables.save(tmp_path.joinpath('tbl.npy').as_posix(), np.arange(1000, dtype=np.int32))
+        mapped = intertables.load(path)
+        cache.put('mapped', mapped)
+        cache.put('view', mapped[10:])
+        assert cache.size == 0 and cache.stats['mapped_items'] == 2
+        assert cache.stats['mapped_bytes'] == mapped.nbytes + mapped[10:].nbytes
+        cache.put('array', np.zeros(10))
+        assert len(cache) == 3 and cache.size == 80 and cache.evictions == 0
+        # least recently used items are evicted when memory budget is exceeded
+        cache.put('array2', np.zeros(10))
+        assert 'array2' in cache and len(cache) == 1 and cache.evictions == 3
+        assert cache.size == 80 and cache.mapped_size == 0
+
+    def test_interpolate_many(self):
+        file = config_dict['input.file']
+        reader = GRIBReader(file)
+        messages = reader.select_messages(shortName='2t')
+        values = messages.values_first_or_single_res
+        lats, lons = messages.latlons
+        interpolator = Interpolator(MockedExecutionContext(config_dict, False), messages.missing_value)
+        stack = np.stack([values[step] for step in values])
+        values_resampled = interpolator.interpolate_many(stack, messages.grid_id)
+        assert values_resampled.shape == (len(values),) + interpolator._target_coords.lons.shape
+        for i, step in enumerate(values):
+            expected = interpolator.interpolate_scipy(lats, lons, values[step], messages.grid_id, messages.grid_details)
+            assert np.array_equal(values_resampled[i], expected)
+        reader.close()
+
+    def test_sparse_interpolation(self):
+        rng = np.random.default_rng(0)
+        source_size, mv = 50, -9999.
+        indexes = rng.integers(0, source_size, size=(20, 4))
+        weights = rng.random((20, 4))
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+        # target points without neighbours
+        indexes[:3] = source_size
+        weights[:3] = [1., 0., 0., 0.]
+        values = rng.random((6, source_size))
+
+        operator = SparseInterpolation(indexes, weights, source_size)
+        expected = np.einsum('ij,tij->ti', weights, np.append(values, np.full((6, 1), mv), axis=1)[:, indexes])
+        assert np.allclose(operator.apply(values, mv), expected)
+        assert np.allclose(operator.apply(values[0], mv), expected[0])
+        assert np.all(operator.apply(values, mv)[:, :3] == mv)
+
+        # float32 weights of intertables are not widened in the matrix, results are float64
+        operator32 = SparseInterpolation(indexes, weights.astype(np.float32), source_size)
+        assert operator32.matrix.dtype == np.float32 and operator32.nbytes < operator.nbytes
+        result = operator32.apply(values.astype(np.float32), mv)
+        assert result.dtype == np.float64
+        assert np.allclose(result, expected, rtol=1e-6)
+
+        # nearest neighbour copies source values
+        nearest = SparseInterpolation(indexes[:, 0], weights[:, 0], source_size)
+        result = nearest.apply(values, mv)
+        assert np.array_equal(result[:, 3:], values[:, indexes[3:, 0]]) and np.all(result[:, :3] == mv)
+
+        # targets with weight on masked source values are masked
+        masked = ma.masked_array(values, mask=np.zeros(values.shape, dtype=bool))
+        masked.mask[:, indexes[5, 1]] = True
+        result = operator.apply(masked, mv)
+        assert result.mask[:, 5].all() and result[:, 5].data.tolist() == [mv] * 6
+        assert np.array_equal(result.mask.any(axis=0), np.isin(indexes, indexes[5, 1]).any(axis=1))
+
+    def test_inverse_distance_chunks(self):
+        # 1 degree lat/lon source grid on unit sphere
+        lons, lats = np.meshgrid(np.arange(0., 10.), np.arange(40., 45.))
+        invdist = object.__new__(InverseDistance)
+        invdist.geodetic_info = {'radius': 1.}
+        invdist.target_grid_is_rotated = False
+        invdist.z = np.arange(lons.size, dtype=float)
+        invdist.tree = cKDTree(np.column_stack(invdist.to_3d(lons.ravel(), lats.ravel())))
+        invdist.min_upper_bound = 0.02
+        invdist._mv_target = -1.
+        invdist.workers = 1
+        invdist.power = 2
+        invdist.nnear = 4
+        # exact hit, four neighbours, out of range
+        target_lons, target_lats = np.array([3., 3.5, 20.]), np.array([42., 42.5, 42.])
+        invdist.chunk_size = 2
+        result, weights, idxs = invdist.interpolate(target_lons, target_lats)
+        assert weights.dtype == np.float32 and idxs.dtype == np.int32
+        assert weights[0].tolist() == [1., 0., 0., 0.] and idxs[0, 0] == 23 and result[0] == 23.
+        assert sorted(idxs[1]) == [23, 24, 33, 34] and np.isclose(weights[1].sum(), 1.)
+        assert np.isclose(result[1], np.dot(weights[1], invdist.z[idxs[1]]))
+        assert weights[2].tolist() == [1., 0., 0., 0.] and idxs[2].tolist() == [50] * 4 and result[2] == -1.
+        # chunks don't change the table
+        invdist.chunk_size = 1000
+        _, weights_one_chunk, idxs_one_chunk = invdist.interpolate(target_lons, target_lats)
+        assert np.array_equal(weights, weights_one_chunk) and np.array_equal(idxs, idxs_one_chunk)
+        # same table without interpolated values
+        no_result, weights_only, idxs_only = invdist.interpolate(target_lons, target_lats, with_result=False)
+        assert no_result is None and np.array_equal(weights, weights_only) and np.array_equal(idxs, idxs_only)
+
+        invdist.power = 1
+        _, weights, _ = invdist.interpolate(target_lons[1:2], target_lats[1:2])
+        distances, _ = invdist.tree.query(np.column_stack(invdist.to_3d(target_lons[1:2], target_lats[1:2])), k=4)
+        assert np.allclose(weights[0], (1 / distances[0]) / (1 / distances[0]).sum())
+
+        invdist.nnear = 1
+        result, distances, idxs = invdist.interpolate(target_lons, target_lats)
+        assert idxs.tolist() == [23, idxs[1], 50] and idxs[1] in (23, 24, 33, 34)
+        assert result.tolist() == [23., float(idxs[1]), -1.]
+        no_result, distances_only, idxs_only = invdist.interpolate(target_lons, target_lats, with_result=False)
+        assert no_result is None and np.array_equal(distances, distances_only) and np.array_equal(idxs, idxs_only)
+
+    def test_source_tree_cache(self, tmp_path, monkeypatch):
+        class Grid(dict):
+            grid_id = 'test$grid'
+        grid = Grid(gridType='regular_ll', Nj=5, radius=1.)
+        lons, lats = np.meshgrid(np.arange(0., 10.), np.arange(40., 45.))
+        values = np.arange(lons.size, dtype=float)
+        cache = SizedLRUCache(1024 ** 2)
+        invdist = InverseDistance(lons, lats, grid, values, 4, -1., -1., cache_dir=tmp_path.as_posix(), cache=cache)
+        path = tmp_path.joinpath('kdtree_test_grid')
+        assert path.with_suffix('.npy').exists() and path.with_suffix('.json').exists()
+        assert InverseDistance(lons, lats, grid, values, 1, -1., -1., cache=cache).tree is invdist.tree
+        assert cache.size == invdist.tree.data.nbytes + invdist.tree.indices.nbytes
+
+        # tree and bound are read from disk by a new process
+        from_disk = InverseDistance(lons, lats, grid, values, 4, -1., -1., cache_dir=tmp_path.as_posix())
+        assert from_disk.tree is not invdist.tree and from_disk.min_upper_bound == invdist.min_upper_bound
+        assert np.array_equal(from_disk.tree.data, invdist.tree.data)
+
+        # unreadable files are ignored and overwritten
+        path.with_suffix('.npy').write_bytes(path.with_suffix('.npy').read_bytes()[:100])
+        rebuilt = InverseDistance(lons, lats, grid, values, 4, -1., -1., cache_dir=tmp_path.as_posix())
+        assert rebuilt.min_upper_bound == invdist.min_upper_bound
+        assert np.array_equal(np.load(path.with_suffix('.npy')), invdist.tree.data)
+
+        # bound estimated from one point per row gives the same value on a regular grid,
+        # and it's not read from files saved with a different sample size
+        monkeypatch.setattr(InverseDistance, 'bound_sample_size', 5)
+        path.with_suffix('.json').write_text(path.with_suffix('.json').read_text().replace(str(invdist.min_upper_bound), '1.0'))
+        sampled = InverseDistance(lons, lats, grid, values, 4, -1., -1., cache_dir=tmp_path.as_posix())
+        assert np.isclose(sampled.min_upper_bound, invdist.min_upper_bound)
+        with open(path.with_suffix('.json')) as f:
+            assert json.load(f)['parameters']['bound_sample_size'] == 5
+
+    def test_invdist_neighbours_and_power(self):
+        d = deepcopy(config_dict)
+        d['interpolation.mode'] = 'invdist'
+        d['interpolation.create'] = True
+        interpolator = Interpolator(MockedExecutionContext(d, False), -1)
+        default_id, default_name = interpolator._intertable_filename('grid', reserve=False)
+        assert default_name.endswith('_scipy_invdist.npy')
+        d['interpolation.nnear'] = 8
+        d['interpolation.power'] = 1.5
+        interpolator = Interpolator(MockedExecutionContext(d, False), -1)
+        intertable_id, intertable_name = interpolator._intertable_filename('grid', reserve=False)
+        assert intertable_id == default_id + '_k8_p1.5' and intertable_name.endswith('_scipy_invdist_k8_p1.5.npy')
+
+    @pytest.mark.parametrize('file, short_name', [('tests/data/input.grib', '2t'), ('tests/data/test.grib', 'spdiff')])
+    def test_grib_bulk_nearest(self, file, short_name):
+        # bulk tables are the same as the ones computed querying ecCodes for each target point
+        reader = GRIBReader(file)
+        reader.select_messages(shortName=short_name)
+        gid = reader._selected_grbs[0]
+        target = LatLong(config_dict['interpolation.latMap'], config_dict['interpolation.lonMap'])
+        lats, lons = target.lats[::20, ::20], target.lons[::20, ::20]
+        assert grib_interpolation_lib.supports_bulk(gid)
+
+        expected = grib_interpolation_lib.grib_nearest(gid, lats, lons, target.mv)
+        result = grib_interpolation_lib.grib_nearest_bulk(gid, lats, lons, target.mv)
+        for expected_array, array in zip(expected, result):
+            assert np.array_equal(expected_array, array)
+
+        expected = grib_interpolation_lib.grib_invdist(gid, lats, lons, target.mv)
+        result = grib_interpolation_lib.grib_invdist_bulk(gid, lats, lons, target.mv)
+        for expected_array, array in zip(expected[:6], result[:6]):
+            assert np.array_equal(expected_array, array)
+        for expected_array, array in zip(expected[6:], result[6:]):
+            assert np.allclose(expected_array, array)
+        reader.close()
+
+    def test_grib_parallel_nearest(self):
+        # process pool backend gives the same tables as the serial one
+        reader = GRIBReader('tests/data/input.grib')
+        reader.select_messages(shortName='2t')
+        gid = reader._selected_grbs[0]
+        target = LatLong(config_dict['interpolation.latMap'], config_dict['interpolation.lonMap'])
+        lats, lons = target.lats[::40, ::40], target.lons[::40, ::40]
+
+        expected = grib_interpolation_lib.grib_nearest(gid, lats, lons, target.mv)
+        result = grib_interpolation_lib.grib_nearest_parallel(gid, lats, lons, target.mv, workers=2)
+        for expected_array, array in zip(expected, result):
+            assert np.array_equal(expected_array, array)
+
+        expected = grib_interpolation_lib.grib_invdist(gid, lats, lons, target.mv)
+        result = grib_interpolation_lib.grib_invdist_parallel(gid, lats, lons, target.mv, workers=2)
+        for expected_array, array in zip(expected, result):
+            assert np.array_equal(expected_array, array)
+        reader.close()
+
+    def test_grib_parallel_checkpointed(self, tmp_path, monkeypatch):
+        # parallel creation in checkpointed blocks uses one pool for all blocks, and it resumes from saved blocks
+        reader = GRIBReader('tests/data/input.grib')
+        reader.select_messages(shortName='2t')
+        gid = reader._selected_grbs[0]
+        d = deepcopy(config_dict)
+        d['interpolation.parallel'] = True
+        d['interpolation.workers'] = 2
+        interpolator = Interpolator(MockedExecutionContext(d, True), -1)
+        target = interpolator._target_coords
+        target.lats, target.lons = target.lats[::40, ::40], target.lons[::40, ::40]
+        monkeypatch.setattr(Interpolator, 'checkpoint_cells', 3 * target.lons.shape[1])
+        monkeypatch.setattr(grib_interpolation_lib, 'supports_bulk', lambda _: False)
+        path = tmp_path.joinpath('tbl.npy').as_posix()
+        pools = []
+        start_pool = grib_interpolation_lib.ParallelNearest._start
+        monkeypatch.setattr(grib_interpolation_lib.ParallelNearest, '_start', lambda pool: pools.append(pool) or start_pool(pool))
+        found = []
+        find = grib_interpolation_lib.ParallelNearest.find
+
+        def interrupted_find(pool, *args, **kwargs):
+            if len(found) == 2:
+                raise KeyboardInterrupt()
+            found.append(args[0].shape[0])
+            return find(pool, *args, **kwargs)
+        monkeypatch.setattr(grib_interpolation_lib.ParallelNearest, 'find', interrupted_find)
+        with pytest.raises(KeyboardInterrupt):
+            interpolator._grib_intertable_arrays('grib_nearest', gid, 'id', path)
+        assert len(pools) == 1 and found == [3, 3] and pools[0]._pool is None
+
+        # resumed creation computes the remaining blocks only
+        monkeypatch.setattr(grib_interpolation_lib.ParallelNearest, 'find', find)
+        result = interpolator._grib_intertable_arrays('grib_nearest', gid, 'id', path)
+        assert len(pools) == 2
+        expected = grib_interpolation_lib.grib_nearest(gid, target.lats, target.lons, target.mv)
+        for expected_array, array in zip(expected, result):
+            assert np.array_equal(expected_array, array)
+        # no pool is started when all blocks are saved
+        interpolator._grib_intertable_arrays('grib_nearest', gid, 'id', path)
+        assert len(pools) == 2
+        reader.close()
+
     @pytest.mark.slow
     def test_interpolation_create_scipy_invdist(self):
         d = deepcopy(config_dict)
@@ -43,7 +450,9 @@ class TestInterpolation:
         values_resampled = interpolator.interpolate_scipy(lats, lons, values_in, grid_id, messages.grid_details)
         shape_target = PCRasterReader(d['interpolation.latMap']).values.shape
         assert shape_target == values_resampled.shape
-        os.unlink('tests/data/tbl_pf10tp_550800_scipy_invdist.npy.gz')
+        os.unlink('tests/data/tbl_pf10tp_550800_scipy_invdist.npy')
+        for ext in ('.npy', '.json'):
+            os.unlink('tests/data/kdtree_{}{}'.format(grid_id.replace('$', '_'), ext))
 
     @pytest.mark.slow
     def test_interpolation_create_eccodes_nearest(self):
@@ -62,4 +471,4 @@ class TestInterpolation:
         values_resampled = interpolator.interpolate_grib(values_in, reader._selected_grbs[0], grid_id)
         shape_target = PCRasterReader(d['interpolation.latMap']).values.shape
         assert shape_target == values_resampled.shape
-        os.unlink('tests/data/tbl_cos2t_550800_grib_nearest.npy.gz')
+        os.unlink('tests/data/tbl_input_550800_grib_nearest.npy')
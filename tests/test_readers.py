@@ -1,10 +1,19 @@
+import json
+import os
+import shutil
+
 import numpy as np
 
 import pytest
+from eccodes import GribInternalError
 
 from pyg2p.main import ApplicationException
 from pyg2p.main.readers import GRIBReader, PCRasterReader
+from pyg2p.main.readers import grib
+from pyg2p.main.readers.index import GRIBIndex
+from pyg2p.util.generics import Range
 from pyg2p import GRIBInfo
+from tests import ensemble_grib
 
 
 class TestGribReader:
@@ -33,6 +42,80 @@ class TestGribReader:
         assert gribinfo == GRIBInfo(input_step=0, input_step2=-1, change_step_at='',
                                     type_of_param='instant', start=0, end=0, mv=9999.0)
 
+    def test_scan_messages(self):
+        file = 'tests/data/input.grib'
+        reader = GRIBReader(file)
+        gribinfo = reader.get_grib_info({'shortName': '2t'})
+        messages = reader.select_messages(shortName='2t', startStep=lambda s: s >= 6)
+        reader.close()
+
+        # single pass: messages are read once and then filtered in memory
+        reader = GRIBReader(file)
+        reader.scan_messages(shortName=['2t', '2T', '2tvar'])
+        assert reader.get_grib_info({'shortName': '2t'}) == gribinfo
+        messages_scanned = reader.select_messages(shortName='2t', startStep=lambda s: s >= 6)
+        assert len(messages_scanned) == len(messages) == 4
+        assert set(messages_scanned.first_resolution_values().keys()) == set(messages.first_resolution_values().keys())
+        reader.close()
+
+    def test_pushdown(self, monkeypatch):
+        file = 'tests/data/input.grib'
+        reader = GRIBReader(file)
+        reader.scan_messages(shortName=['2t', '2T', '2tvar'])
+        messages = reader.select_messages(shortName='2t', startStep=Range(min_=6), endStep=Range(max_=18))
+        assert len(messages) == 3
+        reader.close()
+
+        # same selection pushed down to ecCodes index, when persistent index is not available
+        def no_index(*args):
+            raise GribInternalError(-1)
+        monkeypatch.setattr('pyg2p.main.readers.grib.GRIBIndex', no_index)
+        selections = []
+        codes_index_select = grib.codes_index_select
+
+        def spy_select(index, key, value):
+            selections.append((key, value))
+            codes_index_select(index, key, value)
+        monkeypatch.setattr('pyg2p.main.readers.grib.codes_index_select', spy_select)
+        reader = GRIBReader(file)
+        assert reader._index is None and reader._grbindx is not None
+        messages_eccodes = reader.select_messages(shortName='2t', startStep=Range(min_=6), endStep=Range(max_=18))
+        assert set(messages_eccodes.first_resolution_values().keys()) == set(messages.first_resolution_values().keys())
+        # only keys with conditions are selected, steps on existing step ranges
+        assert sorted(selections) == sorted([('shortName', '2t')] * 3 + [('stepRange', '6'), ('stepRange', '12'), ('stepRange', '18')])
+        reader.close()
+        assert GRIBReader._matches_step_range('0-24', {'startStep': 0, 'endStep': Range(max_=24)})
+        assert not GRIBReader._matches_step_range('6-12', {'startStep': Range(min_=12)})
+        assert GRIBReader._matches_step_range('30m', {'endStep': 1})
+
+    def test_steps_fallback(self):
+        # no messages with startStep > 0: fallback selects from startStep 0, without changing caller's selection
+        file = 'tests/data/test.grib'
+        reader = GRIBReader(file)
+        select_args = {'shortName': 'ediff', 'startStep': Range(min_=6)}
+        start_step = select_args['startStep']
+        assert len(reader._header_values(select_args)['startStep']) == 4
+        assert select_args == {'shortName': 'ediff', 'startStep': start_step}
+        reader.close()
+
+    def test_headers_only(self, monkeypatch):
+        file = 'tests/data/test.grib'
+        reader = GRIBReader(file)
+        gribinfo = reader.get_grib_info({'shortName': 'ediff'})
+        reader.close()
+
+        # metadata from headers only handles, scanning the file without any index
+        def no_index(*args):
+            raise GribInternalError(-1)
+        monkeypatch.setattr('pyg2p.main.readers.grib.GRIBIndex', no_index)
+        monkeypatch.setattr('pyg2p.main.readers.grib.codes_index_new_from_file', no_index)
+        reader = GRIBReader(file)
+        assert reader._file_handler is not None
+        assert reader.get_grib_info({'shortName': 'ediff'}) == gribinfo
+        assert not reader.has_geopotential()
+        reader.close()
+        assert GRIBReader.get_id(file, {'shortName': 'ediff'}) == '-71$M$1$1$1$lambert'
+
     def test_aux(self):
         file = 'tests/data/test.grib'
         reader = GRIBReader(file)
@@ -44,6 +127,71 @@ class TestGribReader:
         assert val2 is None
         assert val == np.array([100.])
 
+    def test_members(self, tmp_path):
+        # ensemble file with members 0, 1 and 5 of all messages in input.grib
+        file = ensemble_grib(tmp_path.joinpath('ens.grib').as_posix())
+        reader = GRIBReader(file, w_perturb=True)
+        assert reader.members({'shortName': '2t'}) == [0, 1, 5]
+        reader.scan_messages(shortName=['2t', '2T', '2tvar'], perturbationNumber=[1, 5])
+        assert reader.members({'shortName': '2t'}) == [1, 5]
+        for member in (1, 5):
+            messages = reader.select_messages(shortName='2t', perturbationNumber=member)
+            assert len(messages) == 5
+            reader.release_selected()
+            assert not reader._selected_grbs and reader.get_main_aux() is None
+        reader.close()
+
+
+class TestGRIBIndex:
+    def test_index(self, tmp_path):
+        file = tmp_path.joinpath('test.grib').as_posix()
+        shutil.copy('tests/data/test.grib', file)
+        index = GRIBIndex(file)
+        assert os.path.exists(file + GRIBIndex.suffix)
+        assert len(index.select(shortName='ediff')) == 4
+        message = index.message(index.select(shortName='ediff', level=100)[0])
+        assert message['length'] == 119
+
+        # reused until grib file changes
+        reader = GRIBReader(file)
+        messages = reader.select_messages(**{'shortName': 'ediff', 'level': 100})
+        assert len(messages) == 1
+        reader.close()
+        os.utime(file, ns=(0, 0))
+        with open(file + GRIBIndex.suffix) as f:
+            previous = f.read()
+        GRIBIndex(file)
+        with open(file + GRIBIndex.suffix) as f:
+            assert f.read() != previous
+
+    def test_corrupt_index(self, tmp_path, monkeypatch):
+        file = tmp_path.joinpath('test.grib').as_posix()
+        shutil.copy('tests/data/test.grib', file)
+        GRIBIndex(file)
+        with open(file + GRIBIndex.suffix) as f:
+            content = json.load(f)
+
+        # partially written index and index with truncated messages are rebuilt
+        for corrupt in (json.dumps(content)[:100], json.dumps(dict(content, messages=[m[:3] for m in content['messages']]))):
+            with open(file + GRIBIndex.suffix, 'w') as f:
+                f.write(corrupt)
+            reader = GRIBReader(file)
+            assert reader._index is not None
+            assert len(reader.select_messages(shortName='ediff', level=100)) == 1
+            reader.close()
+        with open(file + GRIBIndex.suffix) as f:
+            assert json.load(f) == content
+
+        # errors of persistent index fall back to ecCodes index
+        for error in (OSError(13, 'Permission denied'), ValueError('corrupt index')):
+            def failing_index(*args):
+                raise error
+            monkeypatch.setattr('pyg2p.main.readers.grib.GRIBIndex', failing_index)
+            reader = GRIBReader(file)
+            assert reader._index is None and reader._grbindx is not None
+            assert len(reader.select_messages(shortName='ediff', level=100)) == 1
+            reader.close()
+
 
 class TestPCRasterReader:
     def test_read(self):
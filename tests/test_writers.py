@@ -1,3 +1,40 @@
+import threading
+import time
+from copy import deepcopy
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pyg2p.main.readers import GRIBReader
+from pyg2p.main.writers import OutputWriter
+
+from tests import MockedExecutionContext, config_dict
+
+
+class WriterContext(MockedExecutionContext):
+    must_do_correction = False
+
+    def __getitem__(self, param):
+        return self._vars[param]
+
+
+class TwoResolutions:
+    # messages of input.grib, as if steps from change_res_step were at a second resolution (of the same grid)
+    def __init__(self, messages, change_res_step):
+        self._messages = messages
+        self.change_res_step = change_res_step
+        self.latlons = self.latlons_2nd = messages.latlons
+        self.grid_id = self.grid2_id = messages.grid_id
+        self.grid_details = self
+        self.data_date = messages.data_date
+
+    def have_resolution_change(self):
+        return True
+
+    def get_2nd_resolution(self):
+        return self._messages.grid_details
+
+
 # TODO
 
 
@@ -8,3 +45,51 @@ class TestNetCDFWriter:
 class PCRasterWriter:
     pass
 
+
+class TestOutputWriter:
+    def test_workers(self, tmp_path, monkeypatch):
+        # maps interpolated by a pool of threads are the same of serial execution, written in the same order
+        reader = GRIBReader(config_dict['input.file'])
+        grib_info = reader.get_grib_info({'shortName': '2t'})
+        messages = reader.select_messages(shortName='2t')
+        values = sorted(messages.first_resolution_values().items(), key=lambda item: int(item[0].end_step))
+        messages = TwoResolutions(messages, values[2][0])
+        in_flight = []
+        max_in_flight = []
+        first_of_grid = []
+        lock = threading.Lock()
+        interpolate = OutputWriter._interpolate
+
+        def tracked_interpolate(writer, *args):
+            with lock:
+                in_flight.append(id(args[2]))
+                max_in_flight[-1] = max(max_in_flight[-1], len(in_flight))
+                if any(args[2] is v for v in (values[0][1], values[2][1])):
+                    first_of_grid.append(len(in_flight))
+            time.sleep(0.01)
+            try:
+                return interpolate(writer, *args)
+            finally:
+                with lock:
+                    in_flight.remove(id(args[2]))
+        monkeypatch.setattr(OutputWriter, '_interpolate', tracked_interpolate)
+
+        results = {}
+        for workers in (1, 4):
+            max_in_flight.append(0)
+            d = deepcopy(config_dict)
+            d.update({'logger.level': 'ERROR', 'execution.workers': workers, 'outMaps.format': 'netcdf',
+                      'outMaps.clone': 'tests/data/dem.map', 'outMaps.namePrefix': 't2', 'aggregation.type': 'none',
+                      'parameter.conversionUnit': 'K', 'parameter.description': '2 metre temperature',
+                      'outMaps.outDir': tmp_path.joinpath(str(workers)).as_posix()})
+            tmp_path.joinpath(str(workers)).mkdir()
+            writer = OutputWriter(WriterContext(d), grib_info)
+            writer.write_maps(dict(values), messages, change_res_step=messages.change_res_step)
+            writer.close()
+            with Dataset(tmp_path.joinpath(str(workers), 't2_none.nc')) as nf:
+                results[workers] = nf['time'][:].tolist(), nf['t2'][:].filled(np.nan)
+        # first step of each grid is interpolated alone, the others in parallel
+        assert first_of_grid == [1, 1, 1, 1] and max_in_flight[0] == 1 and max_in_flight[1] > 1
+        assert results[1][0] == results[4][0] == [int(step.end_step) for step, _ in values]
+        assert np.array_equal(results[1][1], results[4][1], equal_nan=True)
+        reader.close()